@@ -6,12 +6,21 @@ from soxs.background import \
     InstrumentalBackground
 
 from soxs.cosmology import \
-    make_cosmological_sources_file
+    make_cosmological_sources_file, \
+    make_tiled_halo_catalog
 
 from soxs.events import \
+    EventFile, \
     write_spectrum, \
     write_image, \
+    write_image_cube, \
     write_radial_profile, \
+    write_products, \
+    make_tile_index, \
+    ImageProduct, \
+    ImageCubeProduct, \
+    SpectrumProduct, \
+    RadialProfileProduct, \
     plot_spectrum, \
     make_exposure_map, \
     plot_image
@@ -19,7 +28,8 @@ from soxs.events import \
 from soxs.instrument import \
     instrument_simulator, \
     make_background_file, \
-    simulate_spectrum
+    simulate_spectrum, \
+    make_expected_counts
 
 from soxs.instrument_registry import \
     add_instrument_to_registry, \
@@ -55,12 +65,16 @@ from soxs.spatial import \
     DoubleBetaModel, \
     FillFOVModel, \
     RectangleModel, \
-    SpatialModel
+    SpatialModel, \
+    generate_beta_model_coords, \
+    generate_point_source_coords
 
 from soxs.spectra import \
     Spectrum, \
     ApecGenerator, \
-    ConvolvedSpectrum
+    ConvolvedSpectrum, \
+    SpectrumStack, \
+    ConvolvedSpectrumStack
 
 from soxs.utils import soxs_cfg
 
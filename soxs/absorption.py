@@ -0,0 +1,159 @@
+import numpy as np
+import os
+import h5py
+from collections import OrderedDict
+from scipy.interpolate import InterpolatedUnivariateSpline
+from soxs.utils import soxs_files_path
+
+
+def wabs_cross_section(E):
+    emax = np.array([0.0, 0.1, 0.284, 0.4, 0.532, 0.707, 0.867, 1.303, 1.840, 
+                     2.471, 3.210, 4.038, 7.111, 8.331, 10.0])
+    c0 = np.array([17.3, 34.6, 78.1, 71.4, 95.5, 308.9, 120.6, 141.3,
+                   202.7,342.7,352.2,433.9,629.0,701.2])
+    c1 = np.array([608.1, 267.9, 18.8, 66.8, 145.8, -380.6, 169.3,
+                   146.8, 104.7, 18.7, 18.7, -2.4, 30.9, 25.2]) 
+    c2 = np.array([-2150., -476.1 ,4.3, -51.4, -61.1, 294.0, -47.7,
+                   -31.5, -17.0, 0.0, 0.0, 0.75, 0.0, 0.0])
+    idxs = np.minimum(np.searchsorted(emax, E)-1, 13)
+    sigma = (c0[idxs]+c1[idxs]*E+c2[idxs]*E*E)*1.0e-24/E**3
+    return sigma
+
+
+_tbabs_emid = None
+_tbabs_sigma = None
+_tbabs_spline = None
+
+
+def tbabs_cross_section(E):
+    global _tbabs_emid
+    global _tbabs_sigma
+    global _tbabs_spline
+    if _tbabs_spline is None:
+        filename = os.path.join(soxs_files_path, "tbabs_table.h5")
+        f = h5py.File(filename, "r")
+        _tbabs_sigma = f["cross_section"][:]
+        nbins = _tbabs_sigma.size
+        ebins = np.linspace(f["emin"][()], f["emax"][()], nbins+1)
+        f.close()
+        _tbabs_emid = 0.5*(ebins[1:]+ebins[:-1])
+        _tbabs_spline = InterpolatedUnivariateSpline(_tbabs_emid,
+                                                     _tbabs_sigma, k=5, 
+                                                     ext=1)
+    return _tbabs_spline(E)
+
+
+absorb_models = {"wabs": wabs_cross_section,
+                 "tbabs": tbabs_cross_section}
+
+# Cross sections for spectral energy grids are cached, keyed on
+# the contents of the grid
+_max_cache_entries = 32
+_xsect_cache = OrderedDict()
+
+
+def get_cross_section(e, model="wabs", cache=False):
+    r"""
+    Get the photoelectric absorption cross section per
+    hydrogen atom for an array of energies.
+
+    Parameters
+    ----------
+    e : array-like
+        The energies in keV.
+    model : string, optional
+        The model for absorption to use. Options are "wabs"
+        (Wisconsin, Morrison and McCammon; ApJ 270, 119) or
+        "tbabs" (Tuebingen-Boulder, Wilms, J., Allen, A., & 
+        McCray, R. 2000, ApJ, 542, 914). Default: "wabs".
+    cache : boolean, optional
+        If True, *e* is a spectral energy grid which will be used
+        again, and the cross sections are cached for it, so that 
+        repeated calls with the same grid are cheap. Arrays which 
+        will not be seen again, such as photon energies, should 
+        not be cached. Default: False
+
+    Returns
+    -------
+    An array of cross sections in cm**2, which is read-only if
+    *cache* is True.
+    """
+    if model not in absorb_models:
+        raise NotImplementedError(f"Absorption model '{model}' "
+                                  f"not implemented!")
+    e = np.asarray(e, dtype="float64")
+    if not cache:
+        return absorb_models[model](e)
+    key = (model, e.shape, e.tobytes())
+    if key in _xsect_cache:
+        _xsect_cache.move_to_end(key)
+        return _xsect_cache[key]
+    sigma = np.asarray(absorb_models[model](e), dtype="float64")
+    sigma.flags.writeable = False
+    _xsect_cache[key] = sigma
+    if len(_xsect_cache) > _max_cache_entries:
+        _xsect_cache.popitem(last=False)
+    return sigma
+
+
+def get_absorb(e, nH, model="wabs", redshift=0.0, cache=False):
+    r"""
+    Get the transmission fraction due to foreground absorption
+    for an array of energies, for one or many hydrogen columns
+    and redshifts of the absorber.
+
+    Parameters
+    ----------
+    e : array-like
+        The energies in keV, in the observer frame.
+    nH : float or array-like
+        The hydrogen column in units of 10**22 atoms/cm**2.
+    model : string, optional
+        The model for absorption to use. Options are "wabs"
+        (Wisconsin, Morrison and McCammon; ApJ 270, 119) or
+        "tbabs" (Tuebingen-Boulder, Wilms, J., Allen, A., & 
+        McCray, R. 2000, ApJ, 542, 914). Default: "wabs".
+    redshift : float or array-like, optional
+        The redshift of the absorbing material. Default: 0.0
+    cache : boolean, optional
+        If True, *e* is a spectral energy grid and the cross 
+        sections are cached for it. See 
+        :func:`~soxs.absorption.get_cross_section`. Default: False
+
+    Returns
+    -------
+    If *nH* and *redshift* are both scalars, an array of the same 
+    shape as *e*. Otherwise, *nH* and *redshift* are broadcast 
+    against each other and an array of shape (N, e.size) is 
+    returned, with one row for each column density and redshift.
+    """
+    e = np.asarray(e, dtype="float64")
+    nH = np.asarray(nH, dtype="float64")
+    redshift = np.asarray(redshift, dtype="float64")
+    if nH.ndim == 0 and redshift.ndim == 0:
+        if redshift == 0.0:
+            sigma = get_cross_section(e, model=model, cache=cache)
+        else:
+            sigma = get_cross_section(e*(1.0+redshift), model=model,
+                                      cache=cache)
+        return np.exp(-nH*1.0e22*sigma)
+    nH, redshift = np.broadcast_arrays(np.atleast_1d(nH), 
+                                       np.atleast_1d(redshift))
+    absorb = np.empty((nH.size, e.size))
+    zs, inv = np.unique(redshift, return_inverse=True)
+    for i, z in enumerate(zs):
+        sigma = get_cross_section(e.ravel()*(1.0+z), model=model,
+                                  cache=cache)
+        idxs = inv == i
+        absorb[idxs, :] = np.exp(-1.0e22*np.outer(nH[idxs], sigma))
+    return absorb
+
+
+def get_wabs_absorb(e, nH):
+    sigma = get_cross_section(e, model="wabs")
+    return np.exp(-nH*1.0e22*sigma)
+
+
+def get_tbabs_absorb(e, nH):
+    sigma = get_cross_section(e, model="tbabs")
+    return np.exp(-nH*1.0e22*sigma)
@@ -1,7 +1,6 @@
 import numpy as np
 import os
-import astropy.io.fits as pyfits
-from soxs.utils import mylog, get_rot_mat
+from soxs.utils import mylog, get_rot_mat, parse_value, parse_prng
 
 key_map = {"telescope": "TELESCOP",
            "mission": "MISSION",
@@ -10,80 +9,88 @@ key_map = {"telescope": "TELESCOP",
            "nchan": "PHA_BINS"}
 
 
-def add_background_from_file(events, event_params, bkg_file):
+def add_background_from_file(events, event_params, bkg_file, 
+                             time_offset=0.0, prng=None):
     from soxs.instrument import perform_dither
-    f = pyfits.open(bkg_file)
-
-    hdu = f["EVENTS"]
-
-    dither_params = {}
-    if "DITHXAMP" in hdu.header:
-        dither_params["x_amp"] = hdu.header["DITHXAMP"]
-        dither_params["y_amp"] = hdu.header["DITHYAMP"]
-        dither_params["x_period"] = hdu.header["DITHXPER"]
-        dither_params["y_period"] = hdu.header["DITHYPER"]
-        dither_params["plate_scale"] = hdu.header["TCDLT3"]*3600.0
-        dither_params["dither_on"] = True
-    else:
-        dither_params["dither_on"] = False
+    from soxs.events import EventFile
+    ef = EventFile(bkg_file)
+
+    header = ef.header
+    dither_params = ef.dither_params
 
     sexp = event_params["exposure_time"]
-    bexp = hdu.header["EXPOSURE"]
+    bexp = header["EXPOSURE"]
 
-    if event_params["exposure_time"] > hdu.header["EXPOSURE"]:
+    if event_params["exposure_time"] > header["EXPOSURE"]:
         raise RuntimeError(f"The background file does not have sufficient "
                            f"exposure! Source exposure time {sexp}, background "
                            f" exposure time {bexp}.")
 
+    if isinstance(time_offset, str) and time_offset == "random":
+        prng = parse_prng(prng)
+        time_offset = prng.uniform(0.0, bexp-sexp)
+    else:
+        time_offset = parse_value(time_offset, "s")
+        if time_offset < 0.0 or time_offset+sexp > bexp:
+            raise RuntimeError(f"The time window from {time_offset} s to "
+                               f"{time_offset+sexp} s is not within the "
+                               f"background exposure time {bexp}!")
+
     for k1, k2 in key_map.items():
-        if event_params[k1] != hdu.header[k2]:
+        if event_params[k1] != header[k2]:
             raise RuntimeError(f"'{k1}' keyword does not match! "
-                               f"{event_params[k1]} vs. {hdu.header[k2]}")
+                               f"{event_params[k1]} vs. {header[k2]}")
     rmf1 = os.path.split(event_params["rmf"])[-1]
-    rmf2 = hdu.header["RESPFILE"]
+    rmf2 = header["RESPFILE"]
     arf1 = os.path.split(event_params["arf"])[-1]
-    arf2 = hdu.header["ANCRFILE"]
+    arf2 = header["ANCRFILE"]
     if rmf1 != rmf2:
         raise RuntimeError(f"RMFs do not match! {rmf1} vs. {rmf2}")
     if arf1 != arf2:
         raise RuntimeError(f"ARFs do not match! {arf1} vs. {arf2}")
 
-    idxs = hdu.data["TIME"] < sexp
+    columns = ["DETX", "DETY", "TIME", "CCD_ID", "ENERGY",
+               event_params["channel_type"].upper()]
+    same_roll = event_params["roll_angle"] == header["ROLL_PNT"]
+    if same_roll:
+        columns += ["X", "Y"]
+    bkg = ef.read(columns, tmin=time_offset, tmax=time_offset+sexp)
+    ef.close()
 
-    mylog.info(f"Adding {idxs.sum()} background events from {bkg_file}.")
+    mylog.info(f"Adding {bkg['TIME'].size} background events from {bkg_file}"
+               f" between {time_offset} s and {time_offset+sexp} s.")
 
-    if event_params["roll_angle"] == hdu.header["ROLL_PNT"]:
-        xpix = hdu.data["X"][idxs]
-        ypix = hdu.data["Y"][idxs]
+    if same_roll:
+        xpix = bkg["X"]
+        ypix = bkg["Y"]
     else:
         rot_mat = get_rot_mat(event_params["roll_angle"])
         if dither_params["dither_on"]:
-            t = hdu.data["TIME"][idxs]
-            x_off, y_off = perform_dither(t, dither_params)
+            x_off, y_off = perform_dither(bkg["TIME"], dither_params)
         else:
             x_off = 0.0
             y_off = 0.0
-        det = np.array([hdu.data["DETX"][idxs] + x_off -
+        det = np.array([bkg["DETX"] + x_off -
                         event_params["aimpt_coords"][0] -
                         event_params["aimpt_shift"][0],
-                        hdu.data["DETY"][idxs] + y_off -
+                        bkg["DETY"] + y_off -
                         event_params["aimpt_coords"][1] -
                         event_params["aimpt_shift"][1]])
         xpix, ypix = np.dot(rot_mat.T, det)
 
-        xpix += hdu.header["TCRPX2"]
-        ypix += hdu.header["TCRPX3"]
+        xpix += header["TCRPX2"]
+        ypix += header["TCRPX3"]
+
+    bkg["TIME"] = bkg["TIME"]-time_offset
 
     all_events = {}
-    for key in ["detx", "dety", "time", "ccd_id", event_params["channel_type"]]:
-        all_events[key] = np.concatenate([events[key], 
-                                          hdu.data[key.upper()][idxs]])
+    for key in ["detx", "dety", "time", "chip_id", event_params["channel_type"]]:
+        col = "CCD_ID" if key == "chip_id" else key.upper()
+        all_events[key] = np.concatenate([events[key], bkg[col]])
     all_events["xpix"] = np.concatenate([events["xpix"], xpix])
     all_events["ypix"] = np.concatenate([events["ypix"], ypix])
     all_events["energy"] = np.concatenate([events["energy"],
-                                           hdu.data["ENERGY"][idxs]*1.0e-3])
-
-    f.close()
+                                           bkg["ENERGY"]*1.0e-3])
 
     return all_events
 
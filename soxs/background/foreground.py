@@ -13,12 +13,21 @@ from regions import PixCoord
 hm_bkgnd_file = os.path.join(soxs_files_path, "hm_cxb_bkgnd.h5")
 hm_astro_bkgnd = BackgroundSpectrum.from_file(hm_bkgnd_file)
 
+# The foreground spectrum convolved with each ARF it has been used with
+_conv_frgnd_specs = {}
+
 
 def make_foreground(event_params, arf, rmf, prng=None):
 
     prng = parse_prng(prng)
 
-    conv_frgnd_spec = ConvolvedBackgroundSpectrum.convolve(hm_astro_bkgnd, arf)
+    conv_frgnd_spec = _conv_frgnd_specs.get(arf._cache_key, None)
+    if conv_frgnd_spec is None:
+        conv_frgnd_spec = ConvolvedBackgroundSpectrum.convolve(hm_astro_bkgnd, 
+                                                               arf)
+        if len(_conv_frgnd_specs) >= 8:
+            _conv_frgnd_specs.pop(next(iter(_conv_frgnd_specs)))
+        _conv_frgnd_specs[arf._cache_key] = conv_frgnd_spec
 
     bkg_events = {"energy": [], "detx": [], "dety": [], "chip_id": []}
     pixel_area = (event_params["plate_scale"]*60.0)**2
@@ -44,7 +44,8 @@ class InstrumentalBackground:
         return cls(channel, count_rate, focal_length)
 
     def generate_channel_spectrum(self, t_exp, solid_angle, 
-                                  focal_length=None, prng=None):
+                                  focal_length=None, prng=None, 
+                                  noisy=True):
         """
         Generate photon energy channels from this instrumental
         background spectrum given an exposure time,
@@ -65,6 +66,9 @@ class InstrumentalBackground:
             be specified if you have a reason to generate the same 
             set of random numbers, such as for a test. Default is None, 
             which sets the seed based on the system time. 
+        noisy : boolean, optional
+            If False, the expected number of counts in each channel
+            is returned instead of a Poisson realization. Default: True
         """
         t_exp = parse_value(t_exp, "s")
         solid_angle = parse_value(solid_angle, "arcmin**2")
@@ -75,6 +79,8 @@ class InstrumentalBackground:
             focal_length = parse_value(focal_length, "m")
         fac = t_exp * solid_angle # Backgrounds are normalized to 1 arcmin**2
         fac *= (focal_length / self.default_focal_length) ** 2
+        if not noisy:
+            return self.count_rate*fac
         return prng.poisson(lam=self.count_rate*fac)
 
     def generate_channels(self, t_exp, solid_angle, focal_length=None,
@@ -1,7 +1,8 @@
 import numpy as np
 from soxs.constants import keV_per_erg, erg_per_keV
 from soxs.simput import SimputCatalog, SimputPhotonList
-from soxs.spectra import get_wabs_absorb, get_tbabs_absorb
+from soxs.absorption import get_absorb
+from soxs.spatial import generate_point_source_coords
 from soxs.utils import mylog, parse_prng, parse_value
 from scipy.interpolate import InterpolatedUnivariateSpline
 from scipy.special import erf
@@ -202,32 +203,21 @@ def make_ptsrc_background(exp_time, fov, sky_center, absorb_model="wabs",
     # Now determine the number of photons we will generate
     n_photons = prng.poisson(ref_ph_flux*exp_time*area)
 
-    all_energies = []
-    all_ra = []
-    all_dec = []
-
-    for i, nph in enumerate(n_photons):
-        if nph > 0:
-            # Generate the energies in the source frame
-            u = prng.uniform(size=nph)
-            if ind[i] == 1.0:
-                energies = spec_emin*(eratio**u)
-            else:
-                energies = fac1[i] + u*fac2[i]
-                energies **= invoma[i]
-            # Assign positions for this source
-            ra = ra0[i]*np.ones(nph)
-            dec = dec0[i]*np.ones(nph)
-
-            all_energies.append(energies)
-            all_ra.append(ra)
-            all_dec.append(dec)
+    # Generate the energies in the source frame for all of the
+    # sources at once
+    src_idxs = np.repeat(np.arange(n_photons.size), n_photons)
+    u = prng.uniform(size=src_idxs.size)
+    all_energies = fac1[src_idxs] + u*fac2[src_idxs]
+    all_energies **= invoma[src_idxs]
+    flat = ind[src_idxs] == 1.0
+    all_energies[flat] = spec_emin*(eratio**u[flat])
 
-    mylog.debug("Finished generating spectra.")
+    # Assign positions for the sources
+    all_ra, all_dec = generate_point_source_coords(ra0, dec0, n_photons)
+    all_ra = all_ra.value
+    all_dec = all_dec.value
 
-    all_energies = np.concatenate(all_energies)
-    all_ra = np.concatenate(all_ra)
-    all_dec = np.concatenate(all_dec)
+    mylog.debug("Finished generating spectra.")
 
     all_nph = all_energies.size
 
@@ -235,10 +225,7 @@ def make_ptsrc_background(exp_time, fov, sky_center, absorb_model="wabs",
     # We will throw a lot of stuff away, but this is more general and still
     # faster.
     if nH is not None:
-        if absorb_model == "wabs":
-            absorb = get_wabs_absorb(all_energies, nH)
-        elif absorb_model == "tbabs":
-            absorb = get_tbabs_absorb(all_energies, nH)
+        absorb = get_absorb(all_energies, nH, model=absorb_model)
         randvec = prng.uniform(size=all_energies.size)
         all_energies = all_energies[randvec < absorb]
         all_ra = all_ra[randvec < absorb]
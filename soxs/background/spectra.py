@@ -28,11 +28,11 @@ class BackgroundSpectrum(Spectrum):
             arcminutes.
         """
         fov = parse_value(fov, "arcmin")
-        flux = spec.flux.value/fov/fov
-        return cls(spec.flux.ebins.value, flux)
+        flux = spec._flux/fov/fov
+        return cls(spec._ebins, flux)
 
     def generate_energies(self, t_exp, area, fov, prng=None, 
-                          quiet=False):
+                          quiet=False, ordered=False):
         """
         Generate photon energies from this background 
         spectrum given an exposure time, effective area, 
@@ -59,27 +59,33 @@ class BackgroundSpectrum(Spectrum):
             If True, log messages will not be displayed when 
             creating energies. Useful if you have to loop over 
             a lot of spectra. Default: False
+        ordered : boolean, optional
+            If True, the energies will be returned sorted in 
+            increasing order. Otherwise, they are grouped by 
+            energy bin but not sorted within each bin, which is 
+            faster. Default: False
         """
         t_exp = parse_value(t_exp, "s")
         fov = parse_value(fov, "arcmin")
         area = parse_value(area, "cm**2")
         prng = parse_prng(prng)
         rate = area*fov*fov*self.total_flux.value
-        energy = _generate_energies(self, t_exp, rate, prng, quiet=quiet)
+        energy = _generate_energies(self, t_exp, rate, prng, quiet=quiet,
+                                    ordered=ordered)
         flux = np.sum(energy)*erg_per_keV/t_exp/area
         energies = Energies(energy, flux)
         return energies
 
     def to_spectrum(self, fov):
         fov = parse_value(fov, "arcmin")
-        flux = self.flux.value*fov*fov
-        return Spectrum(self.ebins.value, flux)
+        flux = self._flux*fov*fov
+        return Spectrum(self._ebins, flux)
 
     def __mul__(self, other):
         if isinstance(other, AuxiliaryResponseFile):
             return ConvolvedBackgroundSpectrum.convolve(self, other)
         else:
-            return BackgroundSpectrum(self.ebins, other*self.flux)
+            return BackgroundSpectrum(self._ebins, other*self._flux)
 
     __rmul__ = __mul__
 
@@ -88,7 +94,7 @@ class ConvolvedBackgroundSpectrum(ConvolvedSpectrum):
     _units = "photon/(s*keV*arcmin**2)"
 
     def generate_energies(self, t_exp, fov, prng=None, 
-                          quiet=False):
+                          quiet=False, ordered=False):
         """
         Generate photon energies from this convolved 
         background spectrum given an exposure time and 
@@ -110,12 +116,18 @@ class ConvolvedBackgroundSpectrum(ConvolvedSpectrum):
             If True, log messages will not be displayed when 
             creating energies. Useful if you have to loop over 
             a lot of spectra. Default: False
+        ordered : boolean, optional
+            If True, the energies will be returned sorted in 
+            increasing order. Otherwise, they are grouped by 
+            energy bin but not sorted within each bin, which is 
+            faster. Default: False
         """
         t_exp = parse_value(t_exp, "s")
         fov = parse_value(fov, "arcmin")
         prng = parse_prng(prng)
         rate = fov*fov*self.total_flux.value
-        energy = _generate_energies(self, t_exp, rate, prng, quiet=quiet)
+        energy = _generate_energies(self, t_exp, rate, prng, quiet=quiet,
+                                    ordered=ordered)
         earea = self.arf.interpolate_area(energy).value
         flux = np.sum(energy)*erg_per_keV/t_exp/earea.sum()
         energies = Energies(energy, flux)
@@ -2,12 +2,12 @@ import os
 import numpy as np
 import h5py
 
-from tqdm.auto import tqdm
-
 from astropy.cosmology import FlatLambdaCDM
 from astropy.table import Table
 
-from soxs.spatial import BetaModel, construct_wcs
+from soxs.absorption import get_absorb
+from soxs.constants import erg_per_keV
+from soxs.spatial import construct_wcs, generate_beta_model_coords
 from soxs.spectra import ApecGenerator
 from soxs.utils import soxs_files_path, mylog, parse_prng, \
     parse_value
@@ -27,6 +27,11 @@ emax = 2.0
 abund = 0.3
 conc = 10.0
 
+# Energy binning of the halo spectra in the observer frame
+spec_emin = 0.1
+spec_emax = 10.0
+spec_nbins = 10000
+
 lum_table_file = os.path.join(soxs_files_path, "lum_table.h5")
 halos_cat_file = os.path.join(soxs_files_path, "halo_catalog.h5")
 
@@ -53,10 +58,198 @@ def flux2lum(kT, z):
     return flux2lum
 
 
+def _interp_rows(cum, rows, e, ebins):
+    # Linearly interpolate row rows[i] of the cumulative 
+    # distributions cum, defined on the bin edges ebins, 
+    # at the energy e[i]
+    e = np.clip(e, ebins[0], ebins[-1])
+    idxs = np.clip(np.searchsorted(ebins, e), 1, ebins.size-1)
+    f = (e-ebins[idxs-1])/(ebins[idxs]-ebins[idxs-1])
+    return cum[rows, idxs-1]*(1.0-f)+cum[rows, idxs]*f
+
+
+def _generate_halo_energies(kT, z, flux_kcorr, exp_time, area, nH,
+                            absorb_model, prng):
+    # Generate the photon energies for all of the halos at once. 
+    # Rest-frame spectra are tabulated once for the temperatures 
+    # which bracket those of the halos, on a grid extending high 
+    # enough to cover the redshifted band of every halo. Each halo 
+    # is the interpolation between two of these in temperature, 
+    # so the photons for each table spectrum are drawn together 
+    # from its cumulative distribution, restricted to the band of 
+    # each halo, and then redshifted.
+    n_halos = kT.size
+    zp1 = 1.0+z
+    erest_max = spec_emax*zp1.max() if n_halos > 0 else spec_emax
+    nbins = int(np.ceil(spec_nbins*(erest_max-spec_emin)/(spec_emax-spec_emin)))
+    agen = ApecGenerator(spec_emin, erest_max, nbins, broadening=False)
+
+    tindex = np.searchsorted(agen.Tvals, kT)-1
+    valid = (tindex >= 0) & (tindex < agen.Tvals.size-1)
+    if not valid.all():
+        mylog.warning(f"{(~valid).sum()} halos have temperatures outside "
+                      f"the range of the APEC tables ({agen.Tvals[0]} - "
+                      f"{agen.Tvals[-1]} keV), and will not emit photons.")
+    tindex[~valid] = 0
+    dT = (kT-agen.Tvals[tindex])/agen.dTvals[tindex]
+    indices = np.unique(np.concatenate([tindex[valid], tindex[valid]+1]))
+    if indices.size == 0:
+        return np.zeros(0), np.zeros(0, dtype="int64")
+
+    mylog.info(f"Tabulating spectra for {indices.size} temperatures.")
+    cspec, mspec, _ = agen._get_table(indices, 0.0, 0.0)
+    spec = cspec+abund*mspec
+    ebins = agen.ebins
+    cum_ph = np.zeros((indices.size, nbins+1))
+    cum_en = np.zeros((indices.size, nbins+1))
+    np.cumsum(spec, axis=1, out=cum_ph[:, 1:])
+    np.cumsum(spec*agen.emid, axis=1, out=cum_en[:, 1:])
+
+    # Each halo is a weighted sum of two table spectra
+    k = np.searchsorted(indices, tindex)
+    comps = [(k, np.where(valid, 1.0-dT, 0.0)), 
+             (np.minimum(k+1, indices.size-1), np.where(valid, dT, 0.0))]
+
+    # Normalize each halo by its energy flux in the observer-frame band
+    eflux = np.zeros(n_halos)
+    for kk, wgt in comps:
+        eflux += wgt*(_interp_rows(cum_en, kk, emax*zp1, ebins) -
+                      _interp_rows(cum_en, kk, emin*zp1, ebins))
+    eflux *= erg_per_keV/zp1
+    norm = np.zeros(n_halos)
+    np.divide(flux_kcorr, eflux, out=norm, where=eflux > 0.0)
+
+    energies = []
+    halo_ids = []
+    for kk, wgt in comps:
+        plo = _interp_rows(cum_ph, kk, spec_emin*zp1, ebins)
+        phi = _interp_rows(cum_ph, kk, spec_emax*zp1, ebins)
+        n_ph = prng.poisson(lam=norm*wgt*(phi-plo)*exp_time*area)
+        halo_id = np.repeat(np.arange(n_halos), n_ph)
+        ee = np.empty(halo_id.size)
+        comp = kk[halo_id]
+        for ic in np.unique(comp):
+            idxs = np.nonzero(comp == ic)[0]
+            h = halo_id[idxs]
+            u = plo[h]+prng.uniform(size=idxs.size)*(phi[h]-plo[h])
+            ib = np.clip(np.searchsorted(cum_ph[ic], u), 1, nbins)
+            f = (u-cum_ph[ic, ib-1])/(cum_ph[ic, ib]-cum_ph[ic, ib-1])
+            ee[idxs] = (ebins[ib-1]+f*agen.de[ib-1])/zp1[h]
+        energies.append(ee)
+        halo_ids.append(halo_id)
+    ee = np.concatenate(energies)
+    halo_id = np.concatenate(halo_ids)
+
+    # Foreground absorption, applied by thinning the photons
+    if nH is not None:
+        absorb = get_absorb(ee, nH, model=absorb_model)
+        keep = prng.uniform(size=ee.size) < absorb
+        ee = ee[keep]
+        halo_id = halo_id[keep]
+
+    # Group the photons by halo
+    sort_idxs = np.argsort(halo_id, kind="stable")
+
+    return ee[sort_idxs], halo_id[sort_idxs]
+
+
+def _read_halo_tiles(halo_data, xlo, xhi, ylo, yhi):
+    # Read only the halos in the tiles of a tiled catalog which 
+    # intersect the box, with one contiguous read per row of tiles
+    tile_size = halo_data.attrs["tile_size"]
+    nx = int(halo_data.attrs["nx"])
+    ny = int(halo_data.attrs["ny"])
+    ix0, ix1 = np.clip(np.floor((np.array([xlo, xhi]) -
+                                 halo_data.attrs["xmin"])/tile_size), 
+                       0, nx-1).astype("int")
+    iy0, iy1 = np.clip(np.floor((np.array([ylo, yhi]) -
+                                 halo_data.attrs["ymin"])/tile_size),
+                       0, ny-1).astype("int")
+    offsets = halo_data["tile_offsets"][()]
+    slabs = []
+    for iy in range(iy0, iy1+1):
+        start = offsets[iy*nx+ix0]
+        stop = offsets[iy*nx+ix1+1]
+        if stop > start:
+            slabs.append(slice(start, stop))
+    halos = {}
+    for field in ["x", "y", "redshift", "M500c"]:
+        ds = halo_data[field]
+        halos[field] = np.concatenate([ds[sl] for sl in slabs] +
+                                      [np.zeros(0, dtype=ds.dtype)])
+    return halos
+
+
+def make_tiled_halo_catalog(in_file, out_file, tile_size=30.0, 
+                            overwrite=False):
+    r"""
+    Convert a halo catalog into one where the halos are sorted
+    into square tiles on the sky, with a table of the offsets of 
+    each tile, so that :func:`~soxs.cosmology.make_cosmological_sources`
+    only reads the halos in the tiles which intersect the field 
+    of view.
+
+    Parameters
+    ----------
+    in_file : string
+        The HDF5 halo catalog to convert. It must have the "x", 
+        "y", "redshift", and "M500c" datasets, in the same units
+        and cosmology as the catalog supplied with SOXS.
+    out_file : string
+        The HDF5 file to write the tiled catalog to.
+    tile_size : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`, optional
+        The width of the tiles in arcminutes. Default: 30.0
+    overwrite : boolean, optional
+        Whether or not to overwrite an existing file with the 
+        same name. Default: False
+    """
+    tile_size = parse_value(tile_size, "arcmin")
+    if os.path.exists(out_file) and not overwrite:
+        raise IOError(f"File {out_file} exists and overwrite=False!")
+    cosmo = FlatLambdaCDM(H0=100.0*h0, Om0=omega_m)
+
+    with h5py.File(in_file, "r") as f:
+        fields = {field: f[field][()] for field in f
+                  if isinstance(f[field], h5py.Dataset)}
+
+    # Tiles are laid out in the angular coordinates that 
+    # make_cosmological_sources uses to select halos
+    scale = cosmo.kpc_comoving_per_arcmin(fields["redshift"])
+    scale = scale.to_value("Mpc/arcmin")
+    halo_x = fields["x"].astype("float64")/(h0*scale)
+    halo_y = fields["y"].astype("float64")/(h0*scale)
+    xmin, xmax = halo_x.min(), halo_x.max()
+    ymin, ymax = halo_y.min(), halo_y.max()
+    nx = max(int(np.ceil((xmax-xmin)/tile_size)), 1)
+    ny = max(int(np.ceil((ymax-ymin)/tile_size)), 1)
+    ix = np.minimum(((halo_x-xmin)/tile_size).astype("int"), nx-1)
+    iy = np.minimum(((halo_y-ymin)/tile_size).astype("int"), ny-1)
+    tile_id = iy*nx+ix
+
+    sort_idxs = np.argsort(tile_id, kind="stable")
+    offsets = np.zeros(nx*ny+1, dtype="int64")
+    np.cumsum(np.bincount(tile_id, minlength=nx*ny), out=offsets[1:])
+
+    mylog.info(f"Writing {halo_x.size} halos in {nx}x{ny} tiles "
+               f"to {out_file}.")
+
+    with h5py.File(out_file, "w") as f:
+        for field, data in fields.items():
+            f.create_dataset(field, data=data[sort_idxs])
+        f.create_dataset("tile_offsets", data=offsets)
+        f.attrs["tile_size"] = tile_size
+        f.attrs["nx"] = nx
+        f.attrs["ny"] = ny
+        f.attrs["xmin"] = xmin
+        f.attrs["xmax"] = xmax
+        f.attrs["ymin"] = ymin
+        f.attrs["ymax"] = ymax
+
+
 def make_cosmological_sources(exp_time, fov, sky_center, cat_center=None,
                               absorb_model="wabs", nH=0.05, area=40000.0,
                               output_sources=None, write_regions=None,
-                              prng=None):
+                              prng=None, halo_catalog=None):
     r"""
     Make an X-ray source made up of contributions from
     galaxy clusters, galaxy groups, and galaxies. 
@@ -95,6 +288,13 @@ def make_cosmological_sources(exp_time, fov, sky_center, cat_center=None,
         be specified if you have a reason to generate the same 
         set of random numbers, such as for a test. Default is None, 
         which sets the seed based on the system time.
+    halo_catalog : string, optional
+        The path to an HDF5 halo catalog to use instead of the 
+        one supplied with SOXS. It may have been tiled using 
+        :func:`~soxs.cosmology.make_tiled_halo_catalog`, in 
+        which case only the tiles which intersect the field of
+        view are read. Default: None, which uses the catalog
+        supplied with SOXS.
     """
     exp_time = parse_value(exp_time, "s")
     fov = parse_value(fov, "arcmin")
@@ -103,29 +303,33 @@ def make_cosmological_sources(exp_time, fov, sky_center, cat_center=None,
     area = parse_value(area, "cm**2")
     prng = parse_prng(prng)
     cosmo = FlatLambdaCDM(H0=100.0*h0, Om0=omega_m)
-    agen = ApecGenerator(0.1, 10.0, 10000, broadening=False)
 
     mylog.info("Creating photons from cosmological sources.")
 
-    mylog.info("Loading halo data from catalog: %s" % halos_cat_file)
-    halo_data = h5py.File(halos_cat_file, "r")
+    if halo_catalog is None:
+        halo_catalog = halos_cat_file
 
-    scale = cosmo.kpc_comoving_per_arcmin(halo_data["redshift"][()]).to("Mpc/arcmin")
+    mylog.info("Loading halo data from catalog: %s" % halo_catalog)
+    halo_data = h5py.File(halo_catalog, "r")
+    tiled = "tile_offsets" in halo_data
 
-    # 600. arcmin = 10 degrees (total FOV of catalog = 100 deg^2)
-    fov_cat = 10.0*60.0
+    if tiled:
+        cat_xmin, cat_xmax, cat_ymin, cat_ymax = \
+            [halo_data.attrs[k] for k in ["xmin", "xmax", "ymin", "ymax"]]
+    else:
+        # 600. arcmin = 10 degrees (total FOV of catalog = 100 deg^2)
+        fov_cat = 10.0*60.0
+        cat_xmin = cat_ymin = -0.5*fov_cat
+        cat_xmax = cat_ymax = 0.5*fov_cat
     w = construct_wcs(*sky_center)
 
-    cat_min = -0.5*fov_cat
-    cat_max = 0.5*fov_cat
-
     if cat_center is None:
-        xc, yc = prng.uniform(low=cat_min+0.5*fov, high=cat_max-0.5*fov, size=2)
+        xc = prng.uniform(low=cat_xmin+0.5*fov, high=cat_xmax-0.5*fov)
+        yc = prng.uniform(low=cat_ymin+0.5*fov, high=cat_ymax-0.5*fov)
     else:
         xc, yc = cat_center
-        xc *= 60.0
-        yc *= 60.0
-        xc, yc = np.clip([xc, yc], cat_min+0.5*fov, cat_max-0.5*fov)
+        xc = np.clip(xc*60.0, cat_xmin+0.5*fov, cat_xmax-0.5*fov)
+        yc = np.clip(yc*60.0, cat_ymin+0.5*fov, cat_ymax-0.5*fov)
 
     mylog.info("Coordinates of the FOV within the catalog are (%g, %g) deg." %
                (xc/60.0, yc/60.0))
@@ -137,8 +341,19 @@ def make_cosmological_sources(exp_time, fov, sky_center, cat_center=None,
 
     mylog.info("Selecting halos in the FOV.")
 
-    halo_x = halo_data["x"][()].astype("float64")/(h0*scale.value)
-    halo_y = halo_data["y"][()].astype("float64")/(h0*scale.value)
+    if tiled:
+        halos = _read_halo_tiles(halo_data, xlo, xhi, ylo, yhi)
+    else:
+        halos = {field: halo_data[field][()] 
+                 for field in ["x", "y", "redshift", "M500c"]}
+
+    # Close the halo catalog file
+    halo_data.close()
+
+    scale = cosmo.kpc_comoving_per_arcmin(halos["redshift"]).to("Mpc/arcmin")
+
+    halo_x = halos["x"].astype("float64")/(h0*scale.value)
+    halo_y = halos["y"].astype("float64")/(h0*scale.value)
 
     fov_idxs = (halo_x >= xlo) & (halo_x <= xhi)
     fov_idxs = (halo_y >= ylo) & (halo_y <= yhi) & fov_idxs
@@ -148,16 +363,13 @@ def make_cosmological_sources(exp_time, fov, sky_center, cat_center=None,
     mylog.info("Number of halos in the field of view: %d" % n_halos)
 
     # Now select the specific halos which are in the FOV
-    z = halo_data["redshift"][fov_idxs].astype("float64")
-    m = halo_data["M500c"][fov_idxs].astype("float64")/h0
+    z = halos["redshift"][fov_idxs].astype("float64")
+    m = halos["M500c"][fov_idxs].astype("float64")/h0
     # We need to compute proper scales here
     s = scale[fov_idxs].to("Mpc/arcsec").value/(1.0+z)
     ra0, dec0 = w.wcs_pix2world((halo_x[fov_idxs]-xc)*60.0,
                                 (halo_y[fov_idxs]-yc)*60.0, 1)
 
-    # Close the halo catalog file
-    halo_data.close()
-
     # Some cosmological stuff
     rho_crit = cosmo.critical_density(z).to("Msun/Mpc**3").value
 
@@ -212,38 +424,20 @@ def make_cosmological_sources(exp_time, fov, sky_center, cat_center=None,
             regs.append(reg)
         write_ds9(regs, write_regions)
 
-    tot_flux = 0.0
-    ee = []
-    ra = []
-    dec = []
-
-    pbar = tqdm(leave=True, total=n_halos, 
-                desc="Generating photons from halos ")
-    for halo in range(n_halos):
-        spec = agen.get_spectrum(kT[halo], abund, z[halo], 1.0)
-        spec.rescale_flux(flux_kcorr[halo], emin=emin, emax=emax, 
-                          flux_type="energy")
-        if nH is not None:
-            spec.apply_foreground_absorption(nH, model=absorb_model)
-        e = spec.generate_energies(exp_time, area, prng=prng, quiet=True)
-        beta_model = BetaModel(ra0[halo], dec0[halo], rc[halo], beta[halo],
-                               ellipticity=ellip[halo], theta=theta[halo])
-        xsky, ysky = beta_model.generate_coords(e.size, prng=prng)
-        tot_flux += e.flux
-        ee.append(e.value)
-        ra.append(xsky.value)
-        dec.append(ysky.value)
-        pbar.update()
-    pbar.close()
-
-    ra = np.concatenate(ra)
-    dec = np.concatenate(dec)
-    ee = np.concatenate(ee)
+    ee, halo_id = _generate_halo_energies(kT, z, flux_kcorr, exp_time, 
+                                          area, nH, absorb_model, prng)
+    tot_flux = ee.sum()*erg_per_keV/exp_time/area
+
+    mylog.info("Generating photon positions for the halos.")
+    n_ph = np.bincount(halo_id, minlength=n_halos)
+    ra, dec = generate_beta_model_coords(ra0, dec0, rc, beta, n_ph,
+                                         ellipticity=ellip, theta=theta,
+                                         prng=prng)
 
     mylog.info("Created %d photons from cosmological sources." % ee.size)
 
-    output_events = {"ra": ra, "dec": dec, "energy": ee, 
-                     "flux": tot_flux.value}
+    output_events = {"ra": ra.value, "dec": dec.value, "energy": ee, 
+                     "flux": tot_flux}
 
     return output_events
 
@@ -253,7 +447,7 @@ def make_cosmological_sources_file(filename, name, exp_time, fov,
                                    absorb_model="wabs", nH=0.05, area=40000.0,
                                    overwrite=False, output_sources=None, 
                                    write_regions=None, src_filename=None,
-                                   prng=None, append=False):
+                                   prng=None, append=False, halo_catalog=None):
     r"""
     Make a SIMPUT catalog made up of contributions from
     galaxy clusters, galaxy groups, and galaxies.
@@ -305,12 +499,20 @@ def make_cosmological_sources_file(filename, name, exp_time, fov,
     append : boolean, optional
         If True, the photon list source will be appended to an existing
         SIMPUT catalog. Default: False
+    halo_catalog : string, optional
+        The path to an HDF5 halo catalog to use instead of the 
+        one supplied with SOXS. It may have been tiled using 
+        :func:`~soxs.cosmology.make_tiled_halo_catalog`, in 
+        which case only the tiles which intersect the field of
+        view are read. Default: None, which uses the catalog
+        supplied with SOXS.
     """
     events = make_cosmological_sources(exp_time, fov, sky_center,
                                        cat_center=cat_center,
                                        absorb_model=absorb_model, nH=nH,
                                        area=area, output_sources=output_sources,
-                                       write_regions=write_regions,prng=prng)
+                                       write_regions=write_regions, prng=prng,
+                                       halo_catalog=halo_catalog)
     phlist = SimputPhotonList(events["ra"], events["dec"], events["energy"],
                               events["flux"], name=name)
     if append:
@@ -8,8 +8,14 @@ from soxs.instrument_registry import instrument_registry
 from tqdm.auto import tqdm
 
 
+evt_chunk_size = 10000000
+
+
 def wcs_from_event_file(f):
-    h = f["EVENTS"].header
+    return _wcs_from_header(f["EVENTS"].header)
+
+
+def _wcs_from_header(h):
     w = wcs.WCS(naxis=2)
     w.wcs.crval = [h["TCRVL2"], h["TCRVL3"]]
     w.wcs.crpix = [h["TCRPX2"], h["TCRPX3"]]
@@ -19,10 +25,310 @@ def wcs_from_event_file(f):
     return w
 
 
-def write_event_file(events, parameters, filename, overwrite=False):
+def _time_sorted(t):
+    t = np.asarray(t)
+    return bool(np.all(t[1:] >= t[:-1]))
+
+
+def _tile_coords(x, xmin, tile_size, ntiles):
+    t = np.floor((x-xmin)/tile_size).astype("int64")
+    return np.clip(t, 0, ntiles-1)
+
+
+def _morton_key(tx, ty):
+    def _spread_bits(n):
+        n = n.astype("uint64") & np.uint64(0xFFFFFFFF)
+        for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                            (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                            (1, 0x5555555555555555)]:
+            n = (n | (n << np.uint64(shift))) & np.uint64(mask)
+        return n
+    return _spread_bits(tx) | (_spread_bits(ty) << np.uint64(1))
+
+
+def _tile_index(x, y, frame, tile_size):
+    # Sort the events by the Morton (Z-order) key of the tile they
+    # fall in, so that nearby tiles are mostly nearby in the file, 
+    # and make a table of the rows in each tile.
+    xmin, xmax, ymin, ymax = frame
+    ntilex = int(np.ceil((xmax-xmin)/tile_size))
+    ntiley = int(np.ceil((ymax-ymin)/tile_size))
+    tx = _tile_coords(np.asarray(x), xmin, tile_size, ntilex)
+    ty = _tile_coords(np.asarray(y), ymin, tile_size, ntiley)
+    key = _morton_key(tx, ty)
+    order = np.argsort(key, kind="stable")
+    _, start, nrows = np.unique(key[order], return_index=True, 
+                                return_counts=True)
+    col_tx = fits.Column(name="TILEX", format="J", array=tx[order][start])
+    col_ty = fits.Column(name="TILEY", format="J", array=ty[order][start])
+    col_start = fits.Column(name="START", format="K", array=start)
+    col_nrows = fits.Column(name="NROWS", format="K", array=nrows)
+    tbhdu = fits.BinTableHDU.from_columns([col_tx, col_ty, col_start, col_nrows])
+    tbhdu.name = "TILEIDX"
+    tbhdu.header["TILESIZE"] = tile_size
+    tbhdu.header["TILEXMIN"] = xmin
+    tbhdu.header["TILEYMIN"] = ymin
+    tbhdu.header["NTILEX"] = ntilex
+    tbhdu.header["NTILEY"] = ntiley
+    return order, tbhdu
+
+
+class EventFile:
+    r"""
+    A reader for SOXS event files. The EVENTS table is memory-mapped,
+    only the columns which are asked for are read, and energy, time,
+    and chip filters are applied in chunks of rows, so that the
+    whole table never has to be held in memory at once. If the
+    events in the file are sorted by time, time filters find the
+    rows to read by binary search instead of checking every event.
+    If the file has a spatial tile index (see 
+    :func:`~soxs.events.make_tile_index`), reads which are 
+    restricted to a box in sky coordinates only read the rows in 
+    the tiles which overlap the box.
+
+    Parameters
+    ----------
+    filename : string
+        The path to the event file.
+    chunk_size : integer, optional
+        The number of rows to read from the file at a time. Default
+        is None, which uses the value of 
+        ``soxs.events.evt_chunk_size``.
+
+    Examples
+    --------
+    >>> with EventFile("evt.fits") as ef:
+    ...     events = ef.read(["X", "Y"], emin=0.5, emax=2.0)
+    """
+    def __init__(self, filename, chunk_size=None):
+        if chunk_size is None:
+            chunk_size = evt_chunk_size
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self._f = fits.open(filename, memmap=True)
+        self._hdu = self._f["EVENTS"]
+        self.header = self._hdu.header.copy()
+        self.num_events = self.header["NAXIS2"]
+        self.exposure_time = self.header["EXPOSURE"]
+        self.chantype = self.header["CHANTYPE"]
+        self.time_sorted = self.header.get("TIMESORT", False)
+        self._wcs = None
+        self._dither_params = None
+        self.tile_index = None
+        if "TILEIDX" in self._f:
+            ihdu = self._f["TILEIDX"]
+            self.tile_index = {"tile_size": ihdu.header["TILESIZE"],
+                               "xmin": ihdu.header["TILEXMIN"],
+                               "ymin": ihdu.header["TILEYMIN"],
+                               "ntilex": ihdu.header["NTILEX"],
+                               "ntiley": ihdu.header["NTILEY"]}
+            for key in ["TILEX", "TILEY", "START", "NROWS"]:
+                self.tile_index[key.lower()] = np.array(ihdu.data[key], 
+                                                        dtype="int64")
+
+    @property
+    def wcs(self):
+        """
+        The sky coordinate WCS of the event file.
+        """
+        if self._wcs is None:
+            self._wcs = _wcs_from_header(self.header)
+        return self._wcs
+
+    @property
+    def dither_params(self):
+        """
+        The dither parameters of the observation, in the form
+        used by :func:`~soxs.instrument.perform_dither`.
+        """
+        if self._dither_params is None:
+            h = self.header
+            dp = {}
+            if "DITHXAMP" in h:
+                dp["x_amp"] = h["DITHXAMP"]
+                dp["y_amp"] = h["DITHYAMP"]
+                dp["x_period"] = h["DITHXPER"]
+                dp["y_period"] = h["DITHYPER"]
+                dp["plate_scale"] = h["TCDLT3"]*3600.0
+                dp["dither_on"] = True
+            else:
+                dp["dither_on"] = False
+            self._dither_params = dp
+        return self._dither_params
+
+    def close(self):
+        """
+        Close the event file.
+        """
+        if self._f is not None:
+            self._hdu = None
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.num_events
+
+    def _row_ranges(self, bounds):
+        if bounds is None or self.tile_index is None:
+            return [(0, self.num_events)]
+        idx = self.tile_index
+        # Events outside of the frame are in the tiles on its edges
+        tx0, tx1 = _tile_coords(np.array(bounds[:2]), idx["xmin"], 
+                                idx["tile_size"], idx["ntilex"])
+        ty0, ty1 = _tile_coords(np.array(bounds[2:]), idx["ymin"], 
+                                idx["tile_size"], idx["ntiley"])
+        tx = idx["tilex"]
+        ty = idx["tiley"]
+        sel = (tx >= tx0) & (tx <= tx1) & (ty >= ty0) & (ty <= ty1)
+        starts = idx["start"][sel]
+        stops = starts+idx["nrows"][sel]
+        ranges = []
+        for start, stop in zip(starts, stops):
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = stop
+            else:
+                ranges.append([start, stop])
+        return [tuple(r) for r in ranges]
+
+    def _time_range(self, tmin, tmax):
+        from bisect import bisect_left
+        # np.searchsorted would byte-swap the whole column first, 
+        # while bisect only reads the rows it visits
+        t = self._hdu.data.field("TIME")
+        start = 0 if tmin is None else bisect_left(t, tmin)
+        stop = t.size if tmax is None else bisect_left(t, tmax)
+        return start, stop
+
+    def _mask(self, start, stop, emin, emax, tmin, tmax, chips, bounds):
+        data = self._hdu.data
+        mask = None
+
+        def _and(mask, m):
+            return m if mask is None else mask & m
+
+        if emin is not None or emax is not None:
+            e = data.field("ENERGY")[start:stop]
+            if emin is not None:
+                mask = _and(mask, e > emin)
+            if emax is not None:
+                mask = _and(mask, e < emax)
+        if tmin is not None or tmax is not None:
+            t = data.field("TIME")[start:stop]
+            if tmin is not None:
+                mask = _and(mask, t >= tmin)
+            if tmax is not None:
+                mask = _and(mask, t < tmax)
+        if chips is not None:
+            ccd_id = data.field("CCD_ID")[start:stop]
+            mask = _and(mask, np.isin(ccd_id, chips))
+        if bounds is not None:
+            x = data.field("X")[start:stop]
+            y = data.field("Y")[start:stop]
+            mask = _and(mask, (x >= bounds[0]) & (x <= bounds[1]) &
+                        (y >= bounds[2]) & (y <= bounds[3]))
+        return mask
+
+    def iter_chunks(self, columns, emin=None, emax=None, tmin=None,
+                    tmax=None, chips=None, bounds=None):
+        r"""
+        Iterate over the events in chunks of rows, yielding a
+        dictionary of the requested columns for the events in 
+        each chunk which pass the filters.
+
+        Parameters
+        ----------
+        columns : list of strings
+            The names of the columns to read, e.g. ["X", "Y"].
+        emin : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`, optional
+            Only events with energies above this value, in keV,
+            are kept. Default: None, no lower bound
+        emax : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`, optional
+            Only events with energies below this value, in keV,
+            are kept. Default: None, no upper bound
+        tmin : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`, optional
+            Only events with times greater than or equal to this 
+            value, in seconds, are kept. Default: None, no lower bound
+        tmax : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`, optional
+            Only events with times less than this value, in
+            seconds, are kept. Default: None, no upper bound
+        chips : list of integers, optional
+            Only events which fall on the chips with these 
+            CCD_ID values are kept. Default: None, all chips
+        bounds : array-like, optional
+            Only events with sky coordinates within the box
+            (xmin, xmax, ymin, ymax), in pixels, are kept. If the
+            file has a tile index, only the rows in the tiles which
+            overlap the box are read. Default: None, the whole sky
+        """
+        if emin is not None:
+            emin = parse_value(emin, "keV")*1000.0
+        if emax is not None:
+            emax = parse_value(emax, "keV")*1000.0
+        if tmin is not None:
+            tmin = parse_value(tmin, "s")
+        if tmax is not None:
+            tmax = parse_value(tmax, "s")
+        data = self._hdu.data
+        fields = [data.field(col) for col in columns]
+        ranges = self._row_ranges(bounds)
+        if self.time_sorted and (tmin is not None or tmax is not None):
+            tstart, tstop = self._time_range(tmin, tmax)
+            ranges = [(max(start, tstart), min(stop, tstop)) 
+                      for start, stop in ranges]
+            ranges = [r for r in ranges if r[1] > r[0]]
+            tmin = tmax = None
+        if len(ranges) == 0:
+            ranges = [(0, 0)]
+        for rstart, rstop in ranges:
+            for start in range(rstart, max(rstop, rstart+1), self.chunk_size):
+                stop = min(start+self.chunk_size, rstop)
+                mask = self._mask(start, stop, emin, emax, tmin, tmax, 
+                                  chips, bounds)
+                chunk = {}
+                for col, field in zip(columns, fields):
+                    if mask is None:
+                        chunk[col] = np.array(field[start:stop])
+                    else:
+                        chunk[col] = field[start:stop][mask]
+                yield chunk
+
+    def read(self, columns, emin=None, emax=None, tmin=None,
+             tmax=None, chips=None, bounds=None):
+        r"""
+        Read the requested columns for all of the events which pass
+        the filters. The parameters are the same as those of
+        :meth:`~soxs.events.EventFile.iter_chunks`.
+
+        Returns
+        -------
+        A dictionary of NumPy arrays, keyed by column name.
+        """
+        chunks = list(self.iter_chunks(columns, emin=emin, emax=emax,
+                                       tmin=tmin, tmax=tmax, chips=chips,
+                                       bounds=bounds))
+        if len(chunks) == 1:
+            return chunks[0]
+        return {col: np.concatenate([chunk[col] for chunk in chunks])
+                for col in columns}
+
+
+def write_event_file(events, parameters, filename, overwrite=False,
+                     tile_size=None):
     from astropy.time import Time, TimeDelta
     mylog.info(f"Writing events to file {filename}.")
 
+    if tile_size is not None:
+        frame = [0.5, 2.0*parameters["num_pixels"]+0.5]*2
+        order, tbhdu_idx = _tile_index(events["xpix"], events["ypix"], 
+                                       frame, tile_size)
+        events = {key: np.asarray(events[key])[order] for key in events}
+
     t_begin = Time.now()
     dt = TimeDelta(parameters["exposure_time"], format='sec')
     t_end = t_begin + dt
@@ -32,7 +338,7 @@ def write_event_file(events, parameters, filename, overwrite=False):
     col_e = fits.Column(name='ENERGY', format='E', unit='eV', array=events["energy"]*1000.)
     col_dx = fits.Column(name='DETX', format='D', unit='pixel', array=events["detx"])
     col_dy = fits.Column(name='DETY', format='D', unit='pixel', array=events["dety"])
-    col_id = fits.Column(name='CCD_ID', format='J', unit='pixel', array=events["ccd_id"])
+    col_id = fits.Column(name='CCD_ID', format='J', unit='pixel', array=events["chip_id"])
 
     chantype = parameters["channel_type"].lower()
     if chantype == "pha":
@@ -78,6 +384,7 @@ def write_event_file(events, parameters, filename, overwrite=False):
     tbhdu.header["EXPOSURE"] = parameters["exposure_time"]
     tbhdu.header["TSTART"] = 0.0
     tbhdu.header["TSTOP"] = parameters["exposure_time"]
+    tbhdu.header["TIMESORT"] = _time_sorted(events["time"])
     tbhdu.header["HDUVERS"] = "1.1.0"
     tbhdu.header["RADECSYS"] = "FK5"
     tbhdu.header["EQUINOX"] = 2000.0
@@ -126,10 +433,51 @@ def write_event_file(events, parameters, filename, overwrite=False):
     tbhdu_gti.header["DATE-END"] = t_end.tt.isot
 
     hdulist = [fits.PrimaryHDU(), tbhdu, tbhdu_gti]
+    if tile_size is not None:
+        hdulist.append(tbhdu_idx)
 
     fits.HDUList(hdulist).writeto(filename, overwrite=overwrite)
 
 
+def make_tile_index(evt_file, tile_size=64, out_file=None, overwrite=False):
+    r"""
+    Add a spatial tile index to a SOXS event file. The events are 
+    sorted by the tile of the sky image they fall in, in Morton
+    (Z-order) order of the tiles, and a "TILEIDX" table is added
+    to the file with the rows which belong to each tile. Images,
+    spectra, and profiles which are restricted to a region then 
+    only read the rows in the tiles which overlap the region.
+
+    Parameters
+    ----------
+    evt_file : string
+        The event file to index. 
+    tile_size : integer, optional
+        The width of the square tiles in sky pixels. Default: 64
+    out_file : string, optional
+        The file to write the indexed events to. Default: None,
+        which replaces *evt_file* with the indexed file.
+    overwrite : boolean, optional
+        Whether or not to overwrite an existing *out_file*. 
+        Default: False
+    """
+    if out_file is None:
+        out_file = evt_file
+        overwrite = True
+    with fits.open(evt_file, memmap=False) as f:
+        hdu = f["EVENTS"]
+        h = hdu.header
+        frame = [h["TLMIN2"], h["TLMAX2"], h["TLMIN3"], h["TLMAX3"]]
+        order, tbhdu_idx = _tile_index(hdu.data["X"], hdu.data["Y"], frame,
+                                       tile_size)
+        evt_hdu = fits.BinTableHDU(hdu.data[order], header=h)
+        evt_hdu.header["TIMESORT"] = _time_sorted(evt_hdu.data["TIME"])
+        hdulist = [f[0].copy(), evt_hdu]
+        hdulist += [ext.copy() for ext in f[2:] if ext.name != "TILEIDX"]
+    hdulist.append(tbhdu_idx)
+    fits.HDUList(hdulist).writeto(out_file, overwrite=overwrite)
+
+
 def make_exposure_map(event_file, expmap_file, energy, weights=None,
                       asol_file=None, normalize=True, overwrite=False,
                       reblock=1, nhistx=16, nhisty=16):
@@ -181,48 +529,31 @@ def make_exposure_map(event_file, expmap_file, energy, weights=None,
                            "you do not supply weights!")
     if not isinstance(energy, np.ndarray):
         energy = parse_value(energy, "keV")
-    f_evt = fits.open(event_file)
-    hdu = f_evt["EVENTS"]
-    arf = AuxiliaryResponseFile(hdu.header["ANCRFILE"])
-    exp_time = hdu.header["EXPOSURE"]
-    nx = int(hdu.header["TLMAX2"]-0.5)//2
-    ny = int(hdu.header["TLMAX3"]-0.5)//2
-    ra0 = hdu.header["TCRVL2"]
-    dec0 = hdu.header["TCRVL3"]
-    xdel = hdu.header["TCDLT2"]
-    ydel = hdu.header["TCDLT3"]
-    x0 = hdu.header["TCRPX2"]
-    y0 = hdu.header["TCRPX3"]
-    xaim = hdu.header.get("AIMPT_X", 0.0)
-    yaim = hdu.header.get("AIMPT_Y", 0.0)
-    xaim += hdu.header.get("AIMPT_DX", 0.0)
-    yaim += hdu.header.get("AIMPT_DY", 0.0)
-    roll = hdu.header["ROLL_PNT"]
-    instr = instrument_registry[hdu.header["INSTRUME"].lower()]
-    dither_params = {}
-    if "DITHXAMP" in hdu.header:
-        dither_params["x_amp"] = hdu.header["DITHXAMP"]
-        dither_params["y_amp"] = hdu.header["DITHYAMP"]
-        dither_params["x_period"] = hdu.header["DITHXPER"]
-        dither_params["y_period"] = hdu.header["DITHYPER"]
-        dither_params["plate_scale"] = ydel*3600.0
-        dither_params["dither_on"] = True
-    else:
-        dither_params["dither_on"] = False
-    f_evt.close()
+    with EventFile(event_file) as ef:
+        header = ef.header
+        w = ef.wcs
+        dither_params = ef.dither_params
+    arf = AuxiliaryResponseFile(header["ANCRFILE"])
+    exp_time = header["EXPOSURE"]
+    nx = int(header["TLMAX2"]-0.5)//2
+    ny = int(header["TLMAX3"]-0.5)//2
+    ra0 = header["TCRVL2"]
+    dec0 = header["TCRVL3"]
+    xdel = header["TCDLT2"]
+    ydel = header["TCDLT3"]
+    x0 = header["TCRPX2"]
+    y0 = header["TCRPX3"]
+    xaim = header.get("AIMPT_X", 0.0)
+    yaim = header.get("AIMPT_Y", 0.0)
+    xaim += header.get("AIMPT_DX", 0.0)
+    yaim += header.get("AIMPT_DY", 0.0)
+    roll = header["ROLL_PNT"]
+    instr = instrument_registry[header["INSTRUME"].lower()]
 
     # Create time array for aspect solution
     dt = 1.0 # Seconds
     t = np.arange(0.0, exp_time+dt, dt)
 
-    # Construct WCS
-    w = wcs.WCS(naxis=2)
-    w.wcs.crval = [ra0, dec0]
-    w.wcs.crpix = [x0, y0]
-    w.wcs.cdelt = [xdel, ydel]
-    w.wcs.ctype = ["RA---TAN","DEC--TAN"]
-    w.wcs.cunit = ["deg"]*2
-
     # Create aspect solution if we had dithering.
     # otherwise just set the offsets to zero
     if dither_params["dither_on"]:
@@ -299,7 +630,8 @@ def make_exposure_map(event_file, expmap_file, energy, weights=None,
                   "CDELT1": xdel*reblock,
                   "CDELT2": ydel*reblock,
                   "CRPIX1": 0.5*(2.0*nx//reblock+1),
-                  "CRPIX2": 0.5*(2.0*ny//reblock+1)}
+                  "CRPIX2": 0.5*(2.0*ny//reblock+1),
+                  "EFFAREA": float(eff_area)}
 
     map_hdu = fits.ImageHDU(expmap, header=fits.Header(map_header))
     map_hdu.name = "EXPMAP"
@@ -335,11 +667,15 @@ def make_exposure_map(event_file, expmap_file, energy, weights=None,
 
 
 def _write_spectrum(bins, spec, exp_time, spectype, parameters,
-                    specfile, overwrite=False):
+                    specfile, overwrite=False, noisy=True):
 
     col1 = fits.Column(name='CHANNEL', format='1J', array=bins)
     col2 = fits.Column(name=spectype.upper(), format='1D', array=bins.astype("float64"))
-    col3 = fits.Column(name='COUNTS', format='1J', array=spec.astype("int32"))
+    if noisy:
+        col3 = fits.Column(name='COUNTS', format='1J', array=spec.astype("int32"))
+    else:
+        # Expected counts are not integers
+        col3 = fits.Column(name='COUNTS', format='1D', array=spec)
     col4 = fits.Column(name='COUNT_RATE', format='1D', array=spec/exp_time)
 
     coldefs = fits.ColDefs([col1, col2, col3, col4])
@@ -362,7 +698,7 @@ def _write_spectrum(bins, spec, exp_time, spectype, parameters,
     tbhdu.header["CHANTYPE"] = spectype
     tbhdu.header["BACKFILE"] = "none"
     tbhdu.header["CORRFILE"] = "none"
-    tbhdu.header["POISSERR"] = True
+    tbhdu.header["POISSERR"] = noisy
     for key in ["RESPFILE", "ANCRFILE", "MISSION", "TELESCOP", "INSTRUME"]:
         tbhdu.header[key] = parameters[key]
     tbhdu.header["AREASCAL"] = 1.0
@@ -374,7 +710,541 @@ def _write_spectrum(bins, spec, exp_time, spectype, parameters,
     hdulist.writeto(specfile, overwrite=overwrite)
 
 
-def write_spectrum(evtfile, specfile, overwrite=False):
+def _parse_region(region, w, format="ds9"):
+    from regions import Regions, SkyRegion
+    if isinstance(region, str):
+        if os.path.exists(region):
+            region = Regions.read(region, format=format)
+        else:
+            region = Regions.parse(region, format=format)
+    if isinstance(region, (Regions, list, tuple)):
+        region = list(region)
+    else:
+        region = [region]
+    return [r.to_pixel(w) if isinstance(r, SkyRegion) else r
+            for r in region]
+
+
+class EventProduct:
+    r"""
+    The base class for products which are binned from the events
+    in an event file, such as images, spectra, and radial profiles.
+    Products are filled from the events by 
+    :func:`~soxs.events.write_products`.
+
+    Parameters
+    ----------
+    out_file : string
+        The name of the file to write the product to.
+    emin : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`, optional
+        The minimum energy of the events to include, in keV.
+        Default: None, no lower bound
+    emax : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`, optional
+        The maximum energy of the events to include, in keV.
+        Default: None, no upper bound
+    region : string, :class:`~regions.Region`, or :class:`~regions.Regions`, optional
+        Only include events which fall inside this region. Either
+        a region object (or list of them) from the 
+        `regions <https://astropy-regions.readthedocs.io>`_ package, 
+        a region file, or a region string. Regions in sky coordinates
+        are converted to pixel coordinates using the WCS of the 
+        event file, and regions in pixel coordinates are in the 
+        image coordinates of an unblocked sky image of the event
+        file. Default: None, all events
+    format : string, optional
+        The format of the region file or string. Default: "ds9"
+    """
+    _columns = ()
+
+    def __init__(self, out_file, emin=None, emax=None, region=None,
+                 format="ds9"):
+        self.out_file = out_file
+        self.emin = emin
+        self.emax = emax
+        self.region = region
+        self.format = format
+        self._emin = None
+        self._emax = None
+        self._region = None
+
+    def _setup(self, ef):
+        self._emin = None
+        self._emax = None
+        self._region = None
+        if self.emin is not None:
+            self._emin = parse_value(self.emin, "keV")*1000.0
+        if self.emax is not None:
+            self._emax = parse_value(self.emax, "keV")*1000.0
+        if self.region is not None:
+            self._region = _parse_region(self.region, ef.wcs, 
+                                         format=self.format)
+
+    @property
+    def bounds(self):
+        """
+        The box (xmin, xmax, ymin, ymax) in sky pixel coordinates
+        which contains all of the events this product can include,
+        or None if it can include events from anywhere.
+        """
+        if self._region is None:
+            return None
+        bbox = [reg.bounding_box for reg in self._region]
+        # Bounding boxes are in zero-based pixel indices
+        return (min(bb.ixmin for bb in bbox)+0.5, 
+                max(bb.ixmax for bb in bbox)+0.5,
+                min(bb.iymin for bb in bbox)+0.5, 
+                max(bb.iymax for bb in bbox)+0.5)
+
+    @property
+    def columns(self):
+        cols = list(self._columns)
+        if self._emin is not None or self._emax is not None:
+            cols.append("ENERGY")
+        if self._region is not None:
+            cols += ["X", "Y"]
+        return cols
+
+    def _select(self, chunk):
+        from regions import PixCoord
+        mask = None
+        if self._emin is not None:
+            mask = chunk["ENERGY"] > self._emin
+        if self._emax is not None:
+            m = chunk["ENERGY"] < self._emax
+            mask = m if mask is None else mask & m
+        if self._region is not None:
+            pixcoord = PixCoord(chunk["X"]-1.0, chunk["Y"]-1.0)
+            m = np.zeros(chunk["X"].size, dtype="bool")
+            for reg in self._region:
+                m |= reg.contains(pixcoord)
+            mask = m if mask is None else mask & m
+        if mask is None:
+            return chunk
+        return {col: chunk[col][mask] for col in self._columns}
+
+    def _add(self, chunk):
+        raise NotImplementedError
+
+    def _write(self, overwrite=False):
+        raise NotImplementedError
+
+
+class SpectrumProduct(EventProduct):
+    r"""
+    A spectrum of the events, binned in the channels of the
+    event file. See :class:`~soxs.events.EventProduct` for a
+    description of the parameters.
+    """
+    def _setup(self, ef):
+        super(SpectrumProduct, self)._setup(ef)
+        parameters = {}
+        for key in ["RESPFILE", "ANCRFILE", "MISSION", "TELESCOP", "INSTRUME"]:
+            parameters[key] = ef.header[key]
+        self._setup_spectrum(ef.header["RESPFILE"], ef.chantype,
+                             ef.exposure_time, parameters)
+
+    def _setup_spectrum(self, rmf, spectype, exp_time, parameters):
+        from soxs.response import RedistributionMatrixFile
+        self.rmf = RedistributionMatrixFile(rmf)
+        self.spectype = spectype
+        self.exp_time = exp_time
+        self.parameters = parameters
+        self._columns = [spectype]
+        self._minlength = self.rmf.n_ch
+        if self.rmf.cmin == 1:
+            self._minlength += 1
+        self.spec = np.zeros(self._minlength, dtype="int64")
+
+    def _add(self, chunk):
+        p = self._select(chunk)[self.spectype]
+        self.spec += np.bincount(p, minlength=self._minlength)[:self._minlength]
+
+    def _write(self, overwrite=False):
+        spec = self.spec
+        if self.rmf.cmin == 1:
+            spec = spec[1:]
+        bins = (np.arange(self.rmf.n_ch)+self.rmf.cmin).astype("int32")
+        _write_spectrum(bins, spec, self.exp_time, self.spectype, 
+                        self.parameters, self.out_file, overwrite=overwrite)
+
+
+class RadialProfileProduct(EventProduct):
+    r"""
+    A radial profile of the events. See 
+    :func:`~soxs.events.write_radial_profile` for a description
+    of the parameters.
+    """
+    _columns = ("X", "Y")
+
+    def __init__(self, out_file, ctr, rmin, rmax, nbins, 
+                 ctr_type="celestial", emin=None, emax=None, 
+                 expmap_file=None, region=None, format="ds9"):
+        super(RadialProfileProduct, self).__init__(out_file, emin=emin,
+                                                   emax=emax, region=region,
+                                                   format=format)
+        self.ctr = ctr
+        self.rmin = parse_value(rmin, "arcsec")
+        self.rmax = parse_value(rmax, "arcsec")
+        self.nbins = nbins
+        self.ctr_type = ctr_type
+        self.expmap_file = expmap_file
+
+    def _setup(self, ef):
+        super(RadialProfileProduct, self)._setup(ef)
+        self.orig_dx = ef.header["TCDLT3"]
+        self.exp_time = ef.exposure_time
+        self.w = ef.wcs
+        self.dtheta = np.abs(self.w.wcs.cdelt[1])*3600.0
+        if self.ctr_type == "celestial":
+            self._ctr = self.w.all_world2pix(self.ctr[0], self.ctr[1], 1)
+        else:
+            self._ctr = self.ctr
+        self.rr = np.linspace(self.rmin/self.dtheta, self.rmax/self.dtheta, 
+                              self.nbins+1)
+        self.C = np.zeros(self.nbins)
+
+    @property
+    def bounds(self):
+        rmax = self.rr[-1]
+        bounds = (self._ctr[0]-rmax, self._ctr[0]+rmax, 
+                  self._ctr[1]-rmax, self._ctr[1]+rmax)
+        rbounds = super(RadialProfileProduct, self).bounds
+        if rbounds is not None:
+            bounds = (max(bounds[0], rbounds[0]), min(bounds[1], rbounds[1]),
+                      max(bounds[2], rbounds[2]), min(bounds[3], rbounds[3]))
+        return bounds
+
+    def _add(self, chunk):
+        chunk = self._select(chunk)
+        r = np.sqrt((chunk["X"]-self._ctr[0])**2+(chunk["Y"]-self._ctr[1])**2)
+        self.C += np.histogram(r, bins=self.rr)[0]
+
+    def _write(self, overwrite=False):
+        C = self.C
+        rr = self.rr
+        ctr = self._ctr
+        w = self.w
+        exp_time = self.exp_time
+        rbin = rr*self.dtheta
+        rmid = 0.5*(rbin[1:]+rbin[:-1])
+
+        A = np.pi*(rbin[1:]**2-rbin[:-1]**2)
+
+        Cerr = np.sqrt(C)
+
+        R = C/exp_time
+        Rerr = Cerr/exp_time
+
+        S = R/A
+        Serr = Rerr/A
+
+        col1 = fits.Column(name='RLO', format='D', unit='arcsec', array=rbin[:-1])
+        col2 = fits.Column(name='RHI', format='D', unit='arcsec', array=rbin[1:])
+        col3 = fits.Column(name='RMID', format='D', unit='arcsec', array=rmid)
+        col4 = fits.Column(name='AREA', format='D', unit='arcsec**2', array=A)
+        col5 = fits.Column(name='NET_COUNTS', format='D', unit='count', array=C)
+        col6 = fits.Column(name='NET_ERR', format='D', unit='count', array=Cerr)
+        col7 = fits.Column(name='NET_RATE', format='D', unit='count/s', array=R)
+        col8 = fits.Column(name='ERR_RATE', format='D', unit='count/s', array=Rerr)
+        col9 = fits.Column(name='SUR_BRI', format='D', unit='count/s/arcsec**2', array=S)
+        col10 = fits.Column(name='SUR_BRI_ERR', format='1D', unit='count/s/arcsec**2', array=Serr)
+
+        coldefs = [col1, col2, col3, col4, col5, col6, col7, col8, col9, col10]
+
+        if self.expmap_file is not None:
+            f = fits.open(self.expmap_file)
+            ehdu = f["EXPMAP"]
+            wexp = wcs.WCS(header=ehdu.header)
+            cel = w.all_pix2world(ctr[0], ctr[1], 1)
+            ectr = wexp.all_world2pix(cel[0], cel[1], 1)
+            exp = ehdu.data[:,:]
+            nx, ny = exp.shape
+            reblock = ehdu.header["CDELT2"]/self.orig_dx
+            x, y = np.mgrid[1:nx+1,1:ny+1]
+            r = np.sqrt((x-ectr[0])**2 + (y-ectr[1])**2)
+            f.close()
+            E = np.histogram(r, bins=rr/reblock, weights=exp)[0] / np.histogram(r, bins=rr/reblock)[0]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                F = R/E
+                Ferr = Rerr/E
+            SF = F/A
+            SFerr = Ferr/A
+            col11 = fits.Column(name='MEAN_SRC_EXP', format='D', unit='cm**2', array=E)
+            col12 = fits.Column(name='NET_FLUX', format='D', unit='count/s/cm**2', array=F)
+            col13 = fits.Column(name='NET_FLUX_ERR', format='D', unit='count/s/cm**2', array=Ferr)
+            col14 = fits.Column(name='SUR_FLUX', format='D', unit='count/s/cm**2/arcsec**2', array=SF)
+            col15 = fits.Column(name='SUR_FLUX_ERR', format='D', unit='count/s/cm**2/arcsec**2', array=SFerr)
+            coldefs += [col11, col12, col13, col14, col15]
+
+        tbhdu = fits.BinTableHDU.from_columns(fits.ColDefs(coldefs))
+        tbhdu.name = "PROFILE"
+
+        hdulist = fits.HDUList([fits.PrimaryHDU(), tbhdu])
+
+        hdulist.writeto(self.out_file, overwrite=overwrite)
+
+
+coord_types = {"sky": ("X", "Y", 2, 3),
+               "det": ("DETX", "DETY", 6, 7)}
+
+
+class ImageProduct(EventProduct):
+    r"""
+    An image of the events. See :func:`~soxs.events.write_image`
+    for a description of the parameters.
+    """
+    def __init__(self, out_file, coord_type='sky', emin=None, emax=None,
+                 expmap_file=None, reblock=1, region=None, format="ds9"):
+        super(ImageProduct, self).__init__(out_file, emin=emin, emax=emax,
+                                           region=region, format=format)
+        if coord_type == "det" and reblock > 1:
+            raise RuntimeError("Reblocking images is not supported "
+                               "for detector coordinates!")
+        if coord_type == "det" and expmap_file is not None:
+            raise RuntimeError("Cannot divide by an exposure map for images "
+                               "binned in detector coordinates!")
+        self.coord_type = coord_type
+        self.expmap_file = expmap_file
+        self.reblock = reblock
+        self._columns = coord_types[coord_type][:2]
+
+    def _setup(self, ef):
+        super(ImageProduct, self)._setup(ef)
+        reblock = self.reblock
+        xcoord, ycoord, xcol, ycol = coord_types[self.coord_type]
+        self.exp_time = ef.exposure_time
+        self.xmin = ef.header[f"TLMIN{xcol}"]
+        self.ymin = ef.header[f"TLMIN{ycol}"]
+        self.xmax = ef.header[f"TLMAX{xcol}"]
+        self.ymax = ef.header[f"TLMAX{ycol}"]
+        if self.coord_type == 'sky':
+            self.xctr = ef.header[f"TCRVL{xcol}"]
+            self.yctr = ef.header[f"TCRVL{ycol}"]
+            self.xdel = ef.header[f"TCDLT{xcol}"]*reblock
+            self.ydel = ef.header[f"TCDLT{ycol}"]*reblock
+
+        self.nx = int(self.xmax-self.xmin)//reblock
+        self.ny = int(self.ymax-self.ymin)//reblock
+
+        self._allocate(ef)
+
+    def _allocate(self, ef):
+        self.xbins = np.linspace(self.xmin, self.xmax, self.nx+1, endpoint=True)
+        self.ybins = np.linspace(self.ymin, self.ymax, self.ny+1, endpoint=True)
+
+        self.H = np.zeros((self.nx, self.ny))
+
+    def _add(self, chunk):
+        xcoord, ycoord = self._columns
+        chunk = self._select(chunk)
+        self.H += np.histogram2d(chunk[xcoord], chunk[ycoord],
+                                 bins=[self.xbins, self.ybins])[0]
+
+    def _write(self, overwrite=False):
+        H = self.H
+        nx = self.nx
+        ny = self.ny
+
+        if self.expmap_file is not None:
+            f = fits.open(self.expmap_file)
+            if f["EXPMAP"].shape != (nx, ny):
+                raise RuntimeError("Exposure map and image do not have the same shape!!")
+            with np.errstate(invalid='ignore', divide='ignore'):
+                H /= f["EXPMAP"].data.T
+            H[np.isinf(H)] = 0.0
+            H = np.nan_to_num(H)
+            H[H < 0.0] = 0.0
+            f.close()
+
+        hdu = self._image_hdu(H.T)
+
+        hdu.writeto(self.out_file, overwrite=overwrite)
+
+    def _image_hdu(self, data):
+        nx = self.nx
+        ny = self.ny
+
+        hdu = fits.PrimaryHDU(data)
+
+        if self.coord_type == 'sky':
+            hdu.header["MTYPE1"] = "EQPOS"
+            hdu.header["MFORM1"] = "RA,DEC"
+            hdu.header["CTYPE1"] = "RA---TAN"
+            hdu.header["CTYPE2"] = "DEC--TAN"
+            hdu.header["CRVAL1"] = self.xctr
+            hdu.header["CRVAL2"] = self.yctr
+            hdu.header["CUNIT1"] = "deg"
+            hdu.header["CUNIT2"] = "deg"
+            hdu.header["CDELT1"] = self.xdel
+            hdu.header["CDELT2"] = self.ydel
+            hdu.header["CRPIX1"] = 0.5*(nx+1)
+            hdu.header["CRPIX2"] = 0.5*(ny+1)
+        else:
+            hdu.header["CUNIT1"] = "pixel"
+            hdu.header["CUNIT2"] = "pixel"
+
+        hdu.header["EXPOSURE"] = self.exp_time
+        hdu.name = "IMAGE"
+
+        return hdu
+
+
+class ImageCubeProduct(ImageProduct):
+    r"""
+    A cube of images of the events in a set of energy bands.
+    See :func:`~soxs.events.write_image_cube` for a description
+    of the parameters.
+    """
+    def __init__(self, out_file, ebins, coord_type='sky', expmap_file=None,
+                 reblock=1, region=None, format="ds9"):
+        super(ImageCubeProduct, self).__init__(out_file, coord_type=coord_type,
+                                               expmap_file=expmap_file, 
+                                               reblock=reblock, region=region,
+                                               format=format)
+        if hasattr(ebins, "unit"):
+            ebins = ebins.to_value("keV")
+        self.ebins = np.asarray(ebins, dtype="float64")
+        self._columns = coord_types[coord_type][:2] + ("ENERGY",)
+
+    def _allocate(self, ef):
+        self.xscale = self.nx/(self.xmax-self.xmin)
+        self.yscale = self.ny/(self.ymax-self.ymin)
+        self.nbands = self.ebins.size-1
+
+        self.cube = np.zeros(self.nbands*self.ny*self.nx)
+        self._rescale_expmap = False
+        if self.expmap_file is not None:
+            emap_header = fits.getheader(self.expmap_file, "EXPMAP")
+            self._rescale_expmap = emap_header["NAXIS"] == 2
+            if self._rescale_expmap and "EFFAREA" not in emap_header:
+                raise RuntimeError("The exposure map does not have the "
+                                   "EFFAREA keyword, please remake it with "
+                                   "make_exposure_map!")
+        if self._rescale_expmap:
+            from soxs.response import AuxiliaryResponseFile
+            self.arf = AuxiliaryResponseFile(ef.header["ANCRFILE"])
+            self.inv_area = np.zeros(self.nbands)
+
+    def _add(self, chunk):
+        xcoord, ycoord = self._columns[:2]
+        chunk = self._select(chunk)
+        ix = np.floor((chunk[xcoord]-self.xmin)*self.xscale).astype("int64")
+        iy = np.floor((chunk[ycoord]-self.ymin)*self.yscale).astype("int64")
+        e = chunk["ENERGY"]*1.0e-3
+        ib = np.searchsorted(self.ebins, e, side="right")-1
+        ok = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+        ok &= (ib >= 0) & (ib < self.nbands)
+        idxs = (ib[ok]*self.ny+iy[ok])*self.nx+ix[ok]
+        self.cube += np.bincount(idxs, minlength=self.cube.size)
+        if self._rescale_expmap:
+            area = self.arf.interpolate_area(e[ok]).value
+            inv_area = np.zeros_like(area)
+            np.divide(1.0, area, out=inv_area, where=area > 0.0)
+            self.inv_area += np.bincount(ib[ok], weights=inv_area,
+                                         minlength=self.nbands)
+
+    def _band_expmaps(self):
+        # Exposure maps are the same shape at every energy, so a 
+        # map made at one energy is rescaled to the mean effective 
+        # area of each band, weighted by the counts in the band
+        with fits.open(self.expmap_file) as f:
+            expmap = f["EXPMAP"].data.astype("float64")
+            header = f["EXPMAP"].header
+        if expmap.ndim == 3:
+            if expmap.shape[0] != self.nbands:
+                raise RuntimeError("Exposure map cube and image cube do not "
+                                   "have the same number of bands!")
+            return expmap
+        counts = self.cube.reshape(self.nbands, -1).sum(axis=1)
+        area = np.zeros(self.nbands)
+        for i in range(self.nbands):
+            if self.inv_area[i] > 0.0:
+                area[i] = counts[i]/self.inv_area[i]
+            else:
+                e = np.linspace(self.ebins[i], self.ebins[i+1], 101)
+                area[i] = self.arf.interpolate_area(e).value.mean()
+        return expmap[np.newaxis,:,:]*area[:,np.newaxis,np.newaxis]/header["EFFAREA"]
+
+    def _write(self, overwrite=False):
+        cube = self.cube.reshape(self.nbands, self.ny, self.nx)
+        nx = self.nx
+        ny = self.ny
+
+        if self.expmap_file is not None:
+            expmap = self._band_expmaps()
+            if expmap.shape[1:] != (ny, nx):
+                raise RuntimeError("Exposure map and image do not have the same shape!!")
+            with np.errstate(invalid='ignore', divide='ignore'):
+                cube /= expmap
+            cube[np.isinf(cube)] = 0.0
+            cube = np.nan_to_num(cube)
+            cube[cube < 0.0] = 0.0
+
+        hdu = self._image_hdu(cube)
+
+        col1 = fits.Column(name='CHANNEL', format='1J', 
+                           array=np.arange(1, self.nbands+1, dtype="int32"))
+        col2 = fits.Column(name='E_MIN', format='1D', unit='keV', 
+                           array=self.ebins[:-1])
+        col3 = fits.Column(name='E_MAX', format='1D', unit='keV', 
+                           array=self.ebins[1:])
+        tbhdu = fits.BinTableHDU.from_columns([col1, col2, col3])
+        tbhdu.name = "EBOUNDS"
+
+        fits.HDUList([hdu, tbhdu]).writeto(self.out_file, overwrite=overwrite)
+
+
+def write_products(evt_file, products, overwrite=False):
+    r"""
+    Bin the events from an event file into any number of 
+    products, such as images, spectra, and radial profiles,
+    and write them to files. All of the products are filled
+    from a single pass over the events in the file.
+
+    Parameters
+    ----------
+    evt_file : string
+        The name of the input event file to read.
+    products : list of :class:`~soxs.events.EventProduct` instances
+        The products to make, e.g. :class:`~soxs.events.ImageProduct`,
+        :class:`~soxs.events.SpectrumProduct`, or 
+        :class:`~soxs.events.RadialProfileProduct`. If all of the 
+        products are restricted to regions (or are radial profiles)
+        and the event file has a tile index (see 
+        :func:`~soxs.events.make_tile_index`), only the events in 
+        the tiles which overlap them are read.
+    overwrite : boolean, optional
+        Whether or not to overwrite existing files with the 
+        same names. Default: False
+
+    Examples
+    --------
+    >>> products = [ImageProduct("img_soft.fits", emin=0.5, emax=2.0),
+    ...             ImageProduct("img_hard.fits", emin=2.0, emax=7.0, reblock=2),
+    ...             SpectrumProduct("src.pi", region="fk5;circle(30.0,45.0,20\\")"),
+    ...             RadialProfileProduct("prof.fits", [30.0, 45.0], 0.0, 200.0, 50)]
+    >>> write_products("evt.fits", products, overwrite=True)
+    """
+    with EventFile(evt_file) as ef:
+        columns = []
+        for product in products:
+            product._setup(ef)
+            columns += [col for col in product.columns if col not in columns]
+        bounds = [product.bounds for product in products]
+        if len(bounds) == 0 or None in bounds:
+            bounds = None
+        else:
+            bounds = (min(b[0] for b in bounds), max(b[1] for b in bounds),
+                      min(b[2] for b in bounds), max(b[3] for b in bounds))
+        for chunk in ef.iter_chunks(columns, bounds=bounds):
+            for product in products:
+                product._add(chunk)
+    for product in products:
+        product._write(overwrite=overwrite)
+
+
+def write_spectrum(evtfile, specfile, overwrite=False, region=None,
+                   format="ds9"):
     r"""
     Bin event energies into a spectrum and write it to 
     a FITS binary table. Does not do any grouping of 
@@ -389,46 +1259,40 @@ def write_spectrum(evtfile, specfile, overwrite=False):
     overwrite : boolean, optional
         Whether or not to overwrite an existing file with 
         the same name. Default: False
+    region : string, :class:`~regions.Region`, or :class:`~regions.Regions`, optional
+        Only include events which fall inside this region. Either
+        a region object (or list of them) from the ``regions`` 
+        package, a region file, or a region string. See
+        :class:`~soxs.events.EventProduct` for details. If the 
+        event file has a tile index, only the events in the tiles
+        which overlap the region are read. Default: None
+    format : string, optional
+        The format of the region file or string. Default: "ds9"
     """
-    from soxs.response import RedistributionMatrixFile
-    parameters = {}
+    spec = SpectrumProduct(specfile, region=region, format=format)
     if isinstance(evtfile, str):
-        f = fits.open(evtfile)
-        spectype = f["EVENTS"].header["CHANTYPE"]
-        rmf = f["EVENTS"].header["RESPFILE"]
-        p = f["EVENTS"].data[spectype]
-        exp_time = f["EVENTS"].header["EXPOSURE"]
-        for key in ["RESPFILE", "ANCRFILE", "MISSION", "TELESCOP", "INSTRUME"]:
-            parameters[key] = f["EVENTS"].header[key]
-        f.close()
+        write_products(evtfile, [spec], overwrite=overwrite)
     else:
+        if region is not None:
+            raise RuntimeError("Regions can only be used with event files!")
         rmf = evtfile["rmf"]
         spectype = evtfile["channel_type"]
-        p = evtfile[spectype]
+        parameters = {}
         parameters["RESPFILE"] = os.path.split(rmf)[-1]
         parameters["ANCRFILE"] = os.path.split(evtfile["arf"])[-1]
         parameters["TELESCOP"] = evtfile["telescope"] 
         parameters["INSTRUME"] = evtfile["instrument"]
         parameters["MISSION"] = evtfile["mission"] 
         exp_time = evtfile["exposure_time"]
-
-    rmf = RedistributionMatrixFile(rmf)
-    minlength = rmf.n_ch
-    if rmf.cmin == 1:
-        minlength += 1
-    spec = np.bincount(p, minlength=minlength)
-    if rmf.cmin == 1:
-        spec = spec[1:]
-    bins = (np.arange(rmf.n_ch)+rmf.cmin).astype("int32")
-
-    _write_spectrum(bins, spec, exp_time, spectype, parameters,
-                    specfile, overwrite=overwrite)
+        spec._setup_spectrum(rmf, spectype, exp_time, parameters)
+        spec._add({spectype: evtfile[spectype]})
+        spec._write(overwrite=overwrite)
 
 
 def write_radial_profile(evt_file, out_file, ctr, rmin,
                          rmax, nbins, ctr_type="celestial",
                          emin=None, emax=None, expmap_file=None,
-                         overwrite=False):
+                         overwrite=False, region=None, format="ds9"):
     r"""
     Bin up events into a radial profile and write them to a FITS
     table. 
@@ -466,102 +1330,26 @@ def write_radial_profile(evt_file, out_file, ctr, rmin,
     expmap_file : string, optional
         Supply an exposure map file to determine fluxes. 
         Default: None
+    region : string, :class:`~regions.Region`, or :class:`~regions.Regions`, optional
+        Only include events which fall inside this region. Either
+        a region object (or list of them) from the ``regions`` 
+        package, a region file, or a region string. See
+        :class:`~soxs.events.EventProduct` for details. If the 
+        event file has a tile index, only the events in the tiles
+        which overlap the region are read. Default: None
+    format : string, optional
+        The format of the region file or string. Default: "ds9"
     """
-    rmin = parse_value(rmin, "arcsec")
-    rmax = parse_value(rmax, "arcsec")
-    f = fits.open(evt_file)
-    hdu = f["EVENTS"]
-    orig_dx = hdu.header["TCDLT3"]
-    e = hdu.data["ENERGY"]
-    if emin is None:
-        emin = e.min()
-    else:
-        emin = parse_value(emin, "keV")
-        emin *= 1000.
-    if emax is None:
-        emax = e.max()
-    else:
-        emax = parse_value(emax, "keV")
-        emax *= 1000.
-    idxs = np.logical_and(e > emin, e < emax)
-    x = hdu.data["X"][idxs]
-    y = hdu.data["Y"][idxs]
-    exp_time = hdu.header["EXPOSURE"]
-    w = wcs_from_event_file(f)
-    dtheta = np.abs(w.wcs.cdelt[1])*3600.0
-    f.close()
-
-    if ctr_type == "celestial":
-        ctr = w.all_world2pix(ctr[0], ctr[1], 1)
-
-    r = np.sqrt((x-ctr[0])**2+(y-ctr[1])**2)
-    rr = np.linspace(rmin/dtheta, rmax/dtheta, nbins+1)
-    C = np.histogram(r, bins=rr)[0]
-    rbin = rr*dtheta
-    rmid = 0.5*(rbin[1:]+rbin[:-1])
-
-    A = np.pi*(rbin[1:]**2-rbin[:-1]**2)
-
-    Cerr = np.sqrt(C)
-
-    R = C/exp_time
-    Rerr = Cerr/exp_time
-
-    S = R/A
-    Serr = Rerr/A
-
-    col1 = fits.Column(name='RLO', format='D', unit='arcsec', array=rbin[:-1])
-    col2 = fits.Column(name='RHI', format='D', unit='arcsec', array=rbin[1:])
-    col3 = fits.Column(name='RMID', format='D', unit='arcsec', array=rmid)
-    col4 = fits.Column(name='AREA', format='D', unit='arcsec**2', array=A)
-    col5 = fits.Column(name='NET_COUNTS', format='D', unit='count', array=C)
-    col6 = fits.Column(name='NET_ERR', format='D', unit='count', array=Cerr)
-    col7 = fits.Column(name='NET_RATE', format='D', unit='count/s', array=R)
-    col8 = fits.Column(name='ERR_RATE', format='D', unit='count/s', array=Rerr)
-    col9 = fits.Column(name='SUR_BRI', format='D', unit='count/s/arcsec**2', array=S)
-    col10 = fits.Column(name='SUR_BRI_ERR', format='1D', unit='count/s/arcsec**2', array=Serr)
-
-    coldefs = [col1, col2, col3, col4, col5, col6, col7, col8, col9, col10]
-
-    if expmap_file is not None:
-        f = fits.open(expmap_file)
-        ehdu = f["EXPMAP"]
-        wexp = wcs.WCS(header=ehdu.header)
-        cel = w.all_pix2world(ctr[0], ctr[1], 1)
-        ectr = wexp.all_world2pix(cel[0], cel[1], 1)
-        exp = ehdu.data[:,:]
-        nx, ny = exp.shape
-        reblock = ehdu.header["CDELT2"]/orig_dx
-        x, y = np.mgrid[1:nx+1,1:ny+1]
-        r = np.sqrt((x-ectr[0])**2 + (y-ectr[1])**2)
-        f.close()
-        E = np.histogram(r, bins=rr/reblock, weights=exp)[0] / np.histogram(r, bins=rr/reblock)[0]
-        with np.errstate(invalid='ignore', divide='ignore'):
-            F = R/E
-            Ferr = Rerr/E
-        SF = F/A
-        SFerr = Ferr/A
-        col11 = fits.Column(name='MEAN_SRC_EXP', format='D', unit='cm**2', array=E)
-        col12 = fits.Column(name='NET_FLUX', format='D', unit='count/s/cm**2', array=F)
-        col13 = fits.Column(name='NET_FLUX_ERR', format='D', unit='count/s/cm**2', array=Ferr)
-        col14 = fits.Column(name='SUR_FLUX', format='D', unit='count/s/cm**2/arcsec**2', array=SF)
-        col15 = fits.Column(name='SUR_FLUX_ERR', format='D', unit='count/s/cm**2/arcsec**2', array=SFerr)
-        coldefs += [col11, col12, col13, col14, col15]
-
-    tbhdu = fits.BinTableHDU.from_columns(fits.ColDefs(coldefs))
-    tbhdu.name = "PROFILE"
-
-    hdulist = fits.HDUList([fits.PrimaryHDU(), tbhdu])
-
-    hdulist.writeto(out_file, overwrite=overwrite)
-
-
-coord_types = {"sky": ("X", "Y", 2, 3),
-               "det": ("DETX", "DETY", 6, 7)}
+    prof = RadialProfileProduct(out_file, ctr, rmin, rmax, nbins, 
+                                ctr_type=ctr_type, emin=emin, emax=emax,
+                                expmap_file=expmap_file, region=region,
+                                format=format)
+    write_products(evt_file, [prof], overwrite=overwrite)
 
 
 def write_image(evt_file, out_file, coord_type='sky', emin=None, emax=None,
-                overwrite=False, expmap_file=None, reblock=1):
+                overwrite=False, expmap_file=None, reblock=1, region=None,
+                format="ds9"):
     r"""
     Generate a image by binning X-ray counts and write 
     it to a FITS file.
@@ -589,83 +1377,63 @@ def write_image(evt_file, out_file, coord_type='sky', emin=None, emax=None,
         Change this value to reblock the image to larger 
         pixel sizes (reblock >= 1). Only supported for
         sky coordinates. Default: 1
+    region : string, :class:`~regions.Region`, or :class:`~regions.Regions`, optional
+        Only include events which fall inside this region. Either
+        a region object (or list of them) from the ``regions`` 
+        package, a region file, or a region string. See
+        :class:`~soxs.events.EventProduct` for details. If the 
+        event file has a tile index, only the events in the tiles
+        which overlap the region are read. Default: None
+    format : string, optional
+        The format of the region file or string. Default: "ds9"
     """
-    if emin is None:
-        emin = 0.0
-    else:
-        emin = parse_value(emin, "keV")
-    emin *= 1000.
-    if emax is None:
-        emax = 100.0
-    else:
-        emax = parse_value(emax, "keV")
-    emax *= 1000.
-    if coord_type == "det" and reblock > 1:
-        raise RuntimeError("Reblocking images is not supported "
-                           "for detector coordinates!")
-    f = fits.open(evt_file)
-    e = f["EVENTS"].data["ENERGY"]
-    idxs = np.logical_and(e > emin, e < emax)
-    xcoord, ycoord, xcol, ycol = coord_types[coord_type]
-    x = f["EVENTS"].data[xcoord][idxs]
-    y = f["EVENTS"].data[ycoord][idxs]
-    exp_time = f["EVENTS"].header["EXPOSURE"]
-    xmin = f["EVENTS"].header[f"TLMIN{xcol}"]
-    ymin = f["EVENTS"].header[f"TLMIN{ycol}"]
-    xmax = f["EVENTS"].header[f"TLMAX{xcol}"]
-    ymax = f["EVENTS"].header[f"TLMAX{ycol}"]
-    if coord_type == 'sky':
-        xctr = f["EVENTS"].header[f"TCRVL{xcol}"]
-        yctr = f["EVENTS"].header[f"TCRVL{ycol}"]
-        xdel = f["EVENTS"].header[f"TCDLT{xcol}"]*reblock
-        ydel = f["EVENTS"].header[f"TCDLT{ycol}"]*reblock
-    f.close()
-
-    nx = int(xmax-xmin)//reblock
-    ny = int(ymax-ymin)//reblock
-
-    xbins = np.linspace(xmin, xmax, nx+1, endpoint=True)
-    ybins = np.linspace(ymin, ymax, ny+1, endpoint=True)
+    img = ImageProduct(out_file, coord_type=coord_type, emin=emin, 
+                       emax=emax, expmap_file=expmap_file, reblock=reblock,
+                       region=region, format=format)
+    write_products(evt_file, [img], overwrite=overwrite)
 
-    H, xedges, yedges = np.histogram2d(x, y, bins=[xbins, ybins])
 
-    if expmap_file is not None:
-        if coord_type == "det":
-            raise RuntimeError("Cannot divide by an exposure map for images "
-                               "binned in detector coordinates!")
-        f = fits.open(expmap_file)
-        if f["EXPMAP"].shape != (nx, ny):
-            raise RuntimeError("Exposure map and image do not have the same shape!!")
-        with np.errstate(invalid='ignore', divide='ignore'):
-            H /= f["EXPMAP"].data.T
-        H[np.isinf(H)] = 0.0
-        H = np.nan_to_num(H)
-        H[H < 0.0] = 0.0
-        f.close()
-
-    hdu = fits.PrimaryHDU(H.T)
-
-    if coord_type == 'sky':
-        hdu.header["MTYPE1"] = "EQPOS"
-        hdu.header["MFORM1"] = "RA,DEC"
-        hdu.header["CTYPE1"] = "RA---TAN"
-        hdu.header["CTYPE2"] = "DEC--TAN"
-        hdu.header["CRVAL1"] = xctr
-        hdu.header["CRVAL2"] = yctr
-        hdu.header["CUNIT1"] = "deg"
-        hdu.header["CUNIT2"] = "deg"
-        hdu.header["CDELT1"] = xdel
-        hdu.header["CDELT2"] = ydel
-        hdu.header["CRPIX1"] = 0.5*(nx+1)
-        hdu.header["CRPIX2"] = 0.5*(ny+1)
-    else:
-        hdu.header["CUNIT1"] = "pixel"
-        hdu.header["CUNIT2"] = "pixel"
-
-    hdu.header["EXPOSURE"] = exp_time
-    hdu.name = "IMAGE"
+def write_image_cube(evt_file, out_file, ebins, coord_type='sky',
+                     overwrite=False, expmap_file=None, reblock=1):
+    r"""
+    Generate a cube of images by binning X-ray counts in a 
+    set of energy bands, and write it to a FITS file. The 
+    cube has the shape (n_bands, ny, nx), and the energy
+    bands are written to an "EBOUNDS" table in the same file.
+    All of the bands are binned in a single pass over the 
+    events.
 
-    hdu.writeto(out_file, overwrite=overwrite)
+    Parameters
+    ----------
+    evt_file : string
+        The name of the input event file to read.
+    out_file : string
+        The name of the image cube file to write.
+    ebins : array-like or :class:`~astropy.units.Quantity`
+        The edges of the energy bands, in keV. Each band
+        includes its lower edge and excludes its upper edge.
+    coord_type : string, optional
+        The type of coordinate to bin into an image. 
+        Can be "sky" or "det". Default: "sky"
+    overwrite : boolean, optional
+        Whether or not to overwrite an existing file with 
+        the same name. Default: False
+    expmap_file : string, optional
+        Supply an exposure map file to divide each band of the
+        cube by to get flux maps. If this is a single exposure
+        map from :func:`~soxs.events.make_exposure_map`, it is
+        rescaled in each band to the mean effective area 
+        weighted by the energies of the counts in the band. If 
+        it is a cube of exposure maps, it must have one map for
+        each band. Default: None
+    reblock : integer, optional
+        Change this value to reblock the images to larger 
+        pixel sizes (reblock >= 1). Only supported for
+        sky coordinates. Default: 1
+    """
+    cube = ImageCubeProduct(out_file, ebins, coord_type=coord_type, 
+                            expmap_file=expmap_file, reblock=reblock)
+    write_products(evt_file, [cube], overwrite=overwrite)
 
 
 def plot_spectrum(specfile, plot_energy=True, ebins=None, lw=2, 
@@ -0,0 +1,396 @@
+import numpy as np
+import astropy.wcs as pywcs
+from scipy.signal import fftconvolve
+from regions import PixCoord
+
+from soxs.constants import erg_per_keV
+from soxs.utils import mylog, parse_prng, create_region
+
+# Number of cells per pixel, along each axis, of the grids on which
+# the PSF kernels are built
+psf_kernel_subpixels = 8
+# Maximum number of cells in the grid of a PSF kernel
+max_kernel_cells = 1 << 20
+# Maximum number of points used to sample a source image onto the grid
+max_image_samples = 1 << 25
+# Number of times at which the dither pattern is sampled
+dither_samples = 100000
+
+
+def _pixelize_axis(f, m, nsub, axis):
+    """
+    Spread the PSF on a grid with *nsub* cells per pixel evenly over
+    the pixels it falls in along *axis*, with the pixel edges lying
+    *m* cells past the edges of the blocks of *nsub* cells.
+    """
+    n = f.shape[axis]
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (m, (-n-m) % nsub)
+    g = np.pad(f, pad)
+    shape = list(g.shape)
+    shape[axis] //= nsub
+    shape.insert(axis+1, nsub)
+    g = g.reshape(shape).mean(axis=axis+1)
+    g = np.repeat(g, nsub, axis=axis)
+    return np.take(g, np.arange(m, m+n), axis=axis)
+
+
+def _psf_kernel(psf, detx, dety, energy, rot_mat, max_radius,
+                shift=(0.0, 0.0), event_params=None):
+    """
+    Build a normalized PSF kernel in sky pixel coordinates, at the
+    detector position (detx, dety) and for photons with the given
+    energy, by integrating the PSF over a grid of cells finer than
+    the pixels. The kernel is centered on a point offset by *shift*
+    from the center of a sky pixel. If *event_params* is given, the
+    kernel also includes the effect of placing events randomly within
+    the detector pixels they fall in, for the positions of the pixel
+    edges relative to the source over the dither pattern.
+    """
+    from soxs.instrument import perform_dither
+    if psf is None and event_params is None and not np.any(shift):
+        return np.ones((1, 1)), 0
+    if psf is None:
+        k = 1
+    else:
+        k = psf._kernel_radius(detx, dety, energy, max_radius)
+    if event_params is not None:
+        # Pixelization spreads the kernel by up to a pixel
+        k += 1
+    nsub = max(min(psf_kernel_subpixels,
+                   int(np.sqrt(max_kernel_cells))//(2*k)), 1)
+    n = 2*k*nsub
+    if psf is None:
+        f = np.zeros((n, n))
+        f[n//2-1:n//2+1, n//2-1:n//2+1] = 0.25
+    else:
+        f = psf._kernel(detx, dety, energy, k, nsub)
+    if event_params is not None:
+        # The fraction of the exposure for which the pixel edges fall
+        t = (np.arange(dither_samples)+0.5)*event_params["exposure_time"] / \
+            dither_samples
+        x_off, y_off = perform_dither(t, event_params["dither_params"])
+        # at each cell edge relative to the source, sharing each time
+        # between the two cell edges nearest to the pixel edge
+        px = ((detx-x_off) % 1.0)*nsub
+        py = ((dety-y_off) % 1.0)*nsub
+        mx = np.floor(px).astype("int64")
+        my = np.floor(py).astype("int64")
+        px -= mx
+        py -= my
+        w = np.zeros(nsub*nsub)
+        for ix, iy, wgt in [(mx, my, (1.0-px)*(1.0-py)), (mx+1, my, px*(1.0-py)),
+                            (mx, my+1, (1.0-px)*py), (mx+1, my+1, px*py)]:
+            w += np.bincount((iy % nsub)*nsub+ix % nsub, weights=wgt,
+                             minlength=nsub*nsub)
+        w = w.reshape(nsub, nsub)/dither_samples
+        fx = {j: _pixelize_axis(f, j, nsub, 1) 
+              for j in np.flatnonzero(w.sum(axis=0))}
+        f = np.zeros((n, n))
+        for i in np.flatnonzero(w.sum(axis=1)):
+            g = sum(w[i, j]*fx[j] for j in fx if w[i, j] > 0.0)
+            f += _pixelize_axis(g, i, nsub, 0)
+    # Rotate the cells from detector to sky coordinates, and share
+    # each one between the sky pixels it overlaps
+    c = (np.arange(n)+0.5)/nsub - k
+    cx, cy = np.meshgrid(c, c)
+    inside = f > 0.0
+    dx, dy = np.dot(rot_mat.T, np.array([cx[inside], cy[inside]]))
+    dx += shift[0]
+    dy += shift[1]
+    ks = np.ceil(np.abs(np.concatenate([dx, dy])).max()+0.5/nsub-0.5)
+    ks = int(min(max(ks, 1), max_radius))
+    nk = 2*ks+1
+    xl = dx-0.5/nsub+ks+0.5
+    yl = dy-0.5/nsub+ks+0.5
+    ix = np.floor(xl).astype("int64")
+    iy = np.floor(yl).astype("int64")
+    wx = np.minimum((ix+1-xl)*nsub, 1.0)
+    wy = np.minimum((iy+1-yl)*nsub, 1.0)
+    kernel = np.zeros(nk*nk)
+    for jx, jy, wgt in [(ix, iy, wx*wy), (ix+1, iy, (1.0-wx)*wy),
+                        (ix, iy+1, wx*(1.0-wy)), (ix+1, iy+1, (1.0-wx)*(1.0-wy))]:
+        ok = (jx >= 0) & (jx < nk) & (jy >= 0) & (jy < nk)
+        kernel += np.bincount(jy[ok]*nk+jx[ok], weights=(f[inside]*wgt)[ok],
+                              minlength=nk*nk)
+    kernel = kernel.reshape(nk, nk)
+    kernel /= kernel.sum()
+    return kernel, ks
+
+
+def _points_on_grid(xp, yp, weights, num_pixels, pad):
+    """
+    Deposit weighted points with 1-based sky pixel coordinates (xp, yp)
+    onto a grid of pixels, sharing each point between the four nearest
+    pixel centers so that sub-pixel positions are preserved. Returns
+    the grid and the pixel coordinates of its first pixel. The grid 
+    extends *pad* pixels past the points on each side, but not past 
+    the edges of the sky pixel frame.
+    """
+    if xp.size == 0:
+        return np.zeros((0, 0)), 1, 1
+    fx = np.floor(xp)
+    fy = np.floor(yp)
+    wx = xp-fx
+    wy = yp-fy
+    cx = fx.astype("int64")
+    cy = fy.astype("int64")
+    xlo = max(cx.min()-pad, 1)
+    xhi = min(cx.max()+1+pad, 2*num_pixels)
+    ylo = max(cy.min()-pad, 1)
+    yhi = min(cy.max()+1+pad, 2*num_pixels)
+    if xlo > xhi or ylo > yhi:
+        return np.zeros((0, 0)), xlo, ylo
+    nxg = xhi-xlo+1
+    nyg = yhi-ylo+1
+    grid = np.zeros(nxg*nyg)
+    for ix, iy, wgt in [(cx, cy, (1.0-wx)*(1.0-wy)), (cx+1, cy, wx*(1.0-wy)),
+                        (cx, cy+1, (1.0-wx)*wy), (cx+1, cy+1, wx*wy)]:
+        inside = (ix >= xlo) & (ix <= xhi) & (iy >= ylo) & (iy <= yhi)
+        idxs = (iy[inside]-ylo)*nxg + ix[inside]-xlo
+        grid += np.bincount(idxs, weights=(weights*wgt)[inside],
+                            minlength=nxg*nyg)
+    return grid.reshape(nyg, nxg), xlo, ylo
+
+
+def _image_points(src, w):
+    """
+    Sample the normalized image of a SIMPUT spectrum source (or its
+    position, if it has no image) at points in the sky pixel frame
+    with WCS *w*, returning the pixel coordinates and weights.
+    """
+    if getattr(src, "imhdu", None) is None:
+        xp, yp = w.wcs_world2pix(src.ra, src.dec, 1)
+        return np.atleast_1d(xp), np.atleast_1d(yp), np.ones(1)
+    img = np.asarray(src.imhdu.data, dtype="float64").copy()
+    img[img < 0.0] = 0.0
+    img /= img.sum()
+    w_src = pywcs.WCS(header=src.imhdu.header)
+    w_src.wcs.crval = [src.ra, src.dec]
+    # Subsample the source pixels if they are larger than the
+    # pixels of the grid
+    src_scale = pywcs.utils.proj_plane_pixel_scales(w_src).max()
+    ratio = src_scale/np.abs(w.wcs.cdelt).max()
+    iy, ix = np.nonzero(img)
+    nsub = int(np.ceil(ratio))
+    nsub = max(min(nsub, int(np.sqrt(max_image_samples/ix.size))), 1)
+    offsets = (np.arange(nsub)+0.5)/nsub-0.5
+    ox, oy = np.meshgrid(offsets, offsets)
+    x = (ix[:, np.newaxis]+1+ox.ravel()).ravel()
+    y = (iy[:, np.newaxis]+1+oy.ravel()).ravel()
+    weights = np.repeat(img[iy, ix]/nsub**2, nsub**2)
+    ra, dec = w_src.wcs_pix2world(x, y, 1)
+    xp, yp = w.wcs_world2pix(ra, dec, 1)
+    return xp, yp, weights
+
+
+def _image_plane_bands(src, exp_time, refband, arf, psf, w, rot_mat,
+                       event_params, flux=None, pixelize=False, 
+                       n_bands=10):
+    """
+    Compute the expected counts of a source in the sky pixel frame of
+    an observation, convolved with the PSF, in *n_bands* energy bands
+    containing equal numbers of counts. This is a generator which
+    yields, for each band, the edges of the energy bins within the band,
+    the expected counts in each bin, the image of expected counts, and
+    the 1-based pixel coordinates of the first pixel of the image.
+
+    For photon lists, *flux* is the flux of the source in *refband*,
+    and each photon is weighted by its probability of being detected.
+    If *pixelize* is True, the images include the effect of placing
+    events randomly within detector pixels.
+    """
+    from soxs.spectra import ConvolvedSpectrum
+    if src.src_type == "phlist":
+        energy = np.asarray(src.events["energy"])
+        earea = arf.interpolate_area(energy).value
+        # Photons drawn with their own effective areas are weighted
+        # by the inverse of it
+        if "area" in src.events:
+            inv_area = 1.0/np.asarray(src.events["area"])
+        else:
+            inv_area = np.ones(energy.size)
+        idxs = np.logical_and(energy >= refband[0], energy <= refband[1])
+        rate = flux/(np.sum(energy[idxs]*inv_area[idxs])*erg_per_keV) * \
+            np.sum(earea[idxs]*inv_area[idxs])
+        ph_weights = rate*exp_time*earea*inv_area/np.sum(earea*inv_area)
+        ebins = np.append(arf.elo, arf.ehi[-1])
+        counts = np.histogram(energy, ebins, weights=ph_weights)[0]
+        xp, yp = w.wcs_world2pix(np.asarray(src.events["ra"]),
+                                 np.asarray(src.events["dec"]), 1)
+        ph_bin = np.searchsorted(ebins, energy, side="right")-1
+        ctr = [np.average(xp, weights=ph_weights),
+               np.average(yp, weights=ph_weights)]
+    else:
+        cspec = ConvolvedSpectrum.convolve(
+            src.spec, arf).new_spec_from_band(refband[0], refband[1])
+        ebins = cspec.ebins.value
+        counts = cspec.flux.value*cspec.de.value*exp_time
+        xp, yp, weights = _image_points(src, w)
+        ctr = w.wcs_world2pix(src.ra, src.dec, 1)
+    emid = 0.5*(ebins[1:]+ebins[:-1])
+    cumc = np.concatenate([[0.0], np.cumsum(counts)])
+    if cumc[-1] <= 0.0:
+        return
+    edges = np.searchsorted(cumc, np.linspace(0.0, cumc[-1], n_bands+1))
+    edges = np.unique(np.clip(edges, 0, counts.size))
+    edges[0] = 0
+    edges[-1] = counts.size
+    nx = event_params["num_pixels"]
+    pix_center = event_params["pix_center"]
+    # Center the kernels on the sub-pixel position of the source, and
+    # shift the points by the same amount, so that point sources are
+    # not blurred when they are put on the grid
+    shift = np.asarray(ctr)-np.round(ctr)
+    xp = xp-shift[0]
+    yp = yp-shift[1]
+    det = np.dot(rot_mat, np.array([ctr[0]-pix_center[0],
+                                    ctr[1]-pix_center[1]]))
+    detx = det[0] + event_params["aimpt_coords"][0] + \
+           event_params["aimpt_shift"][0]
+    dety = det[1] + event_params["aimpt_coords"][1] + \
+           event_params["aimpt_shift"][1]
+    kernels = []
+    for ilo, ihi in zip(edges[:-1], edges[1:]):
+        c = counts[ilo:ihi]
+        if c.sum() == 0.0:
+            continue
+        e = np.sum(c*emid[ilo:ihi])/c.sum()
+        kernels.append((ilo, ihi, *_psf_kernel(
+            psf, detx, dety, e, rot_mat, nx, shift=shift,
+            event_params=event_params if pixelize else None)))
+    pad = max(k for _, _, _, k in kernels)
+    if src.src_type != "phlist":
+        grid, xlo, ylo = _points_on_grid(xp, yp, weights, nx, pad)
+    for ilo, ihi, kernel, _ in kernels:
+        c = counts[ilo:ihi]
+        if src.src_type == "phlist":
+            # Only the photons in this band contribute to its image
+            idxs = np.logical_and(ph_bin >= ilo, ph_bin < ihi)
+            grid, xlo, ylo = _points_on_grid(xp[idxs], yp[idxs],
+                                             ph_weights[idxs]/c.sum(),
+                                             nx, pad)
+        if grid.size == 0:
+            continue
+        if kernel.size == 1:
+            image = grid*kernel[0, 0]
+        else:
+            image = fftconvolve(grid, kernel, mode="same")
+            image[image < 0.0] = 0.0
+        image *= c.sum()
+        yield ebins[ilo:ihi+1], c, image, xlo, ylo
+
+
+def _image_plane_events(src, exp_time, refband, arf, psf, w, rot_mat,
+                        event_params, prng=None):
+    """
+    Generate events for a SIMPUT spectrum source with an image by
+    Poisson sampling the pixels of its PSF-convolved expected counts
+    image, so that the cost does not scale with the number of counts.
+    The returned pixel coordinates are relative to the center of the
+    sky pixel frame and already include the effects of the PSF.
+    """
+    prng = parse_prng(prng)
+    pix_center = event_params["pix_center"]
+    energy = []
+    xpix = []
+    ypix = []
+    for ebins, counts, image, xlo, ylo in _image_plane_bands(
+            src, exp_time, refband, arf, psf, w, rot_mat, event_params):
+        cdf = np.concatenate([[0.0], np.cumsum(counts)])
+        cdf /= cdf[-1]
+        n_pix = prng.poisson(lam=image)
+        iy, ix = np.nonzero(n_pix)
+        n_pix = n_pix[iy, ix]
+        n_evt = n_pix.sum()
+        x = np.repeat(ix+xlo, n_pix)
+        y = np.repeat(iy+ylo, n_pix)
+        xpix.append(x+prng.uniform(low=-0.5, high=0.5, size=n_evt)-pix_center[0])
+        ypix.append(y+prng.uniform(low=-0.5, high=0.5, size=n_evt)-pix_center[1])
+        energy.append(np.interp(prng.uniform(size=n_evt), cdf, ebins))
+    if len(energy) == 0:
+        events = {"energy": np.array([]), "xpix": np.array([]),
+                  "ypix": np.array([])}
+    else:
+        events = {"energy": np.concatenate(energy),
+                  "xpix": np.concatenate(xpix),
+                  "ypix": np.concatenate(ypix)}
+    mylog.info(f"{events['energy'].size} events detected.")
+    return events
+
+
+def _dithered_chip_masks(event_params):
+    """
+    Compute, for each chip, the fraction of the exposure during which
+    each detector pixel falls on the chip, which is the chip mask
+    convolved with the distribution of the dither offsets. Returns the
+    masks and the detector coordinates of the lower-left corner of
+    their first pixel.
+    """
+    from soxs.instrument import perform_dither
+    regions = [create_region(chip[0], chip[1:], 0.0, 0.0)
+               for chip in event_params["chips"]]
+    t = (np.arange(dither_samples)+0.5)*event_params["exposure_time"] / \
+        dither_samples
+    x_off, y_off = perform_dither(t, event_params["dither_params"])
+    k = int(np.ceil(np.abs(np.concatenate([x_off, y_off])).max()+0.5))
+    kernel, _, _ = np.histogram2d(y_off, x_off, bins=2*k+1,
+                                  range=[[-k-0.5, k+0.5]]*2)
+    kernel /= kernel.sum()
+    x0 = int(np.floor(min(b[0] for _, b in regions)))-k
+    x1 = int(np.ceil(max(b[1] for _, b in regions)))+k
+    y0 = int(np.floor(min(b[2] for _, b in regions)))-k
+    y1 = int(np.ceil(max(b[3] for _, b in regions)))+k
+    cx, cy = np.meshgrid(np.arange(x0, x1)+0.5, np.arange(y0, y1)+0.5)
+    masks = np.zeros((len(regions), y1-y0, x1-x0))
+    for i, (r, _) in enumerate(regions):
+        mask = r.contains(PixCoord(cx, cy)).astype("float64")
+        if kernel.size > 1:
+            mask = fftconvolve(mask, kernel, mode="same")
+        masks[i] = np.clip(mask, 0.0, 1.0)
+    return masks, x0, y0
+
+
+def _sky_exposure(masks, x0, y0, rot_mat, event_params, xlo, ylo, nx, ny):
+    """
+    Return the exposure fraction of each chip (from the output of
+    :func:`_dithered_chip_masks`) for a block of *ny* by *nx* sky pixels
+    whose first pixel has the 1-based coordinates (xlo, ylo).
+    """
+    pix_center = event_params["pix_center"]
+    x, y = np.meshgrid(np.arange(xlo, xlo+nx)-pix_center[0],
+                       np.arange(ylo, ylo+ny)-pix_center[1])
+    det = np.dot(rot_mat, np.array([x.ravel(), y.ravel()]))
+    ix = np.floor(det[0] + event_params["aimpt_coords"][0] +
+                  event_params["aimpt_shift"][0] - x0).astype("int64")
+    iy = np.floor(det[1] + event_params["aimpt_coords"][1] +
+                  event_params["aimpt_shift"][1] - y0).astype("int64")
+    nchips, myy, mxx = masks.shape
+    inside = (ix >= 0) & (ix < mxx) & (iy >= 0) & (iy < myy)
+    expo = np.zeros((nchips, ix.size))
+    expo[:, inside] = masks[:, iy[inside], ix[inside]]
+    return expo.reshape(nchips, ny, nx)
+
+
+def _add_to_image(image, block, xlo, ylo, reblock):
+    """
+    Add a block of images (with shape (n_bands, ny, nx)) whose first
+    pixel has the 1-based sky pixel coordinates (xlo, ylo) to a stack of
+    images reblocked by *reblock*.
+    """
+    nyo, nxo = image.shape[1:]
+    ny, nx = block.shape[1:]
+    ox = (np.arange(xlo, xlo+nx)-1)//reblock
+    oy = (np.arange(ylo, ylo+ny)-1)//reblock
+    kx = ox < nxo
+    ky = oy < nyo
+    if not kx.any() or not ky.any():
+        return
+    block = block[:, ky][:, :, kx]
+    ox = ox[kx]
+    oy = oy[ky]
+    # Sum the pixels which fall within the same reblocked pixel
+    sx = np.flatnonzero(np.diff(ox, prepend=-1))
+    sy = np.flatnonzero(np.diff(oy, prepend=-1))
+    block = np.add.reduceat(np.add.reduceat(block, sx, axis=2), sy, axis=1)
+    image[:, oy[0]:oy[-1]+1, ox[0]:ox[-1]+1] += block
@@ -6,6 +6,7 @@ from regions import PixCoord
 import warnings
 
 from soxs.events import write_event_file
+from soxs.image_plane import _image_plane_events
 from soxs.instrument_registry import instrument_registry
 from soxs.psf import psf_model_registry
 from soxs.response import AuxiliaryResponseFile, RedistributionMatrixFile
@@ -28,69 +29,10 @@ def perform_dither(t, dither_dict):
     return x_offset, y_offset
 
 
-def generate_events(source, exp_time, instrument, sky_center, 
-                    no_dither=False, dither_params=None, 
-                    roll_angle=0.0, subpixel_res=False, 
-                    aimpt_shift=None, prng=None):
-    """
-    Take unconvolved events and convolve them with instrumental responses. This 
-    function does the following:
-
-    1. Determines which events are observed using the ARF
-    2. Pixelizes the events, applying PSF effects and dithering
-    3. Determines energy channels using the RMF
-
-    This function is not meant to be called by the end-user but is used by
-    the :func:`~soxs.instrument.instrument_simulator` function.
-
-    Parameters
-    ----------
-    input_events : string, dict, or None
-        The unconvolved events to be used as input. Can be one of the
-        following:
-        1. The name of a SIMPUT catalog file.
-        2. A Python dictionary containing the following items:
-        "ra": A NumPy array of right ascension values in degrees.
-        "dec": A NumPy array of declination values in degrees.
-        "energy": A NumPy array of energy values in keV.
-        "flux": The flux of the entire source, in units of erg/cm**2/s.
-    out_file : string
-        The name of the event file to be written.
-    exp_time : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`
-        The exposure time to use, in seconds. 
-    instrument : string
-        The name of the instrument to use, which picks an instrument
-        specification from the instrument registry. 
-    sky_center : array, tuple, or list
-        The center RA, Dec coordinates of the observation, in degrees.
-    no_dither : boolean, optional
-        If True, turn off dithering entirely. Default: False
-    dither_params : array-like of floats, optional
-        The parameters to use to control the size and period of the dither
-        pattern. The first two numbers are the dither amplitude in x and y
-        detector coordinates in arcseconds, and the second two numbers are
-        the dither period in x and y detector coordinates in seconds. 
-        Default: [8.0, 8.0, 1000.0, 707.0].
-    roll_angle : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`, optional
-        The roll angle of the observation in degrees. Default: 0.0
-    subpixel_res : boolean, optional
-        If True, event positions are not randomized within the pixels 
-        within which they are detected. Default: False
-    aimpt_shift : array-like, optional
-        A two-float array-like object which shifts the aimpoint on the 
-        detector from the nominal position. Units are in arcseconds.
-        Default: None, which results in no shift from the nominal aimpoint. 
-    prng : :class:`~numpy.random.RandomState` object, integer, or None
-        A pseudo-random number generator. Typically will only 
-        be specified if you have a reason to generate the same 
-        set of random numbers, such as for a test. Default is None, 
-        which sets the seed based on the system time. 
-    """
-    exp_time = parse_value(exp_time, "s")
-    roll_angle = parse_value(roll_angle, "deg")
-    prng = parse_prng(prng)
+def _parse_source_input(source, prefetch=0):
     if source is None:
         source_list = []
+        parameters = {}
     elif isinstance(source, dict):
         parameters = {}
         for key in ["flux", "emin", "emax", "src_names"]:
@@ -103,8 +45,13 @@ def generate_events(source, exp_time, instrument, sky_center,
             source_list.append(phlist)
     elif isinstance(source, str):
         # Assume this is a SIMPUT catalog
-        source_list, parameters = read_simput_catalog(source)
+        source_list, parameters = read_simput_catalog(source, 
+                                                      prefetch=prefetch)
+    return source_list, parameters
 
+
+def _setup_observation(exp_time, instrument, sky_center, no_dither,
+                       dither_params, roll_angle, aimpt_shift):
     try:
         instrument_spec = instrument_registry[instrument]
     except KeyError:
@@ -172,6 +119,90 @@ def generate_events(source, exp_time, instrument, sky_center,
     # Determine rotation matrix
     rot_mat = get_rot_mat(roll_angle)
 
+    return instrument_spec, arf, rmf, event_params, w, rot_mat
+
+
+def generate_events(source, exp_time, instrument, sky_center, 
+                    no_dither=False, dither_params=None, 
+                    roll_angle=0.0, subpixel_res=False, 
+                    aimpt_shift=None, prng=None, fast_image=False, 
+                    prefetch=0):
+    """
+    Take unconvolved events and convolve them with instrumental responses. This 
+    function does the following:
+
+    1. Determines which events are observed using the ARF
+    2. Pixelizes the events, applying PSF effects and dithering
+    3. Determines energy channels using the RMF
+
+    This function is not meant to be called by the end-user but is used by
+    the :func:`~soxs.instrument.instrument_simulator` function.
+
+    Parameters
+    ----------
+    input_events : string, dict, or None
+        The unconvolved events to be used as input. Can be one of the
+        following:
+        1. The name of a SIMPUT catalog file.
+        2. A Python dictionary containing the following items:
+        "ra": A NumPy array of right ascension values in degrees.
+        "dec": A NumPy array of declination values in degrees.
+        "energy": A NumPy array of energy values in keV.
+        "flux": The flux of the entire source, in units of erg/cm**2/s.
+    out_file : string
+        The name of the event file to be written.
+    exp_time : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`
+        The exposure time to use, in seconds. 
+    instrument : string
+        The name of the instrument to use, which picks an instrument
+        specification from the instrument registry. 
+    sky_center : array, tuple, or list
+        The center RA, Dec coordinates of the observation, in degrees.
+    no_dither : boolean, optional
+        If True, turn off dithering entirely. Default: False
+    dither_params : array-like of floats, optional
+        The parameters to use to control the size and period of the dither
+        pattern. The first two numbers are the dither amplitude in x and y
+        detector coordinates in arcseconds, and the second two numbers are
+        the dither period in x and y detector coordinates in seconds. 
+        Default: [8.0, 8.0, 1000.0, 707.0].
+    roll_angle : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`, optional
+        The roll angle of the observation in degrees. Default: 0.0
+    subpixel_res : boolean, optional
+        If True, event positions are not randomized within the pixels 
+        within which they are detected. Default: False
+    aimpt_shift : array-like, optional
+        A two-float array-like object which shifts the aimpoint on the 
+        detector from the nominal position. Units are in arcseconds.
+        Default: None, which results in no shift from the nominal aimpoint. 
+    prng : :class:`~numpy.random.RandomState` object, integer, or None
+        A pseudo-random number generator. Typically will only 
+        be specified if you have a reason to generate the same 
+        set of random numbers, such as for a test. Default is None, 
+        which sets the seed based on the system time. 
+    fast_image : boolean, optional
+        If True, events for SIMPUT sources with a spectrum and an image
+        are generated by convolving the image with the PSF in a number
+        of energy bands and Poisson sampling the pixels of the result,
+        instead of scattering every photon through the PSF. This is 
+        much faster for bright extended sources. Default: False
+    prefetch : integer, optional
+        If the input is a SIMPUT catalog, read up to this many sources 
+        ahead of the one being processed on a background thread, so
+        that reading them from disk overlaps with processing. 
+        Default: 0, which reads each source when it is needed.
+    """
+    exp_time = parse_value(exp_time, "s")
+    roll_angle = parse_value(roll_angle, "deg")
+    prng = parse_prng(prng)
+    source_list, parameters = _parse_source_input(source, prefetch=prefetch)
+
+    instrument_spec, arf, rmf, event_params, w, rot_mat = \
+        _setup_observation(exp_time, instrument, sky_center, no_dither,
+                           dither_params, roll_angle, aimpt_shift)
+    aimpt_shift = event_params["aimpt_shift"]
+    dither_dict = event_params["dither_params"]
+
     # Set up PSF
     psf_type = instrument_spec["psf"][0]
     psf_class = psf_model_registry[psf_type]
@@ -188,8 +219,13 @@ def generate_events(source, exp_time, instrument, sky_center,
         mylog.info(f"Applying energy-dependent effective area from "
                    f"{os.path.split(arf.filename)[-1]}.")
         refband = [parameters["emin"][i], parameters["emax"][i]]
-        if src.src_type == "phlist":
-            events = arf.detect_events_phlist(src.events.copy(), exp_time,
+        on_image = fast_image and src.src_type.endswith("spectrum") and \
+            getattr(src, "imhdu", None) is not None
+        if on_image:
+            events = _image_plane_events(src, exp_time, refband, arf, psf, 
+                                         w, rot_mat, event_params, prng=prng)
+        elif src.src_type == "phlist":
+            events = arf.detect_events_phlist(src.events, exp_time,
                                               parameters["flux"][i], 
                                               refband, prng=prng)
         elif src.src_type.endswith("spectrum"):
@@ -206,14 +242,19 @@ def generate_events(source, exp_time, instrument, sky_center,
 
             mylog.info("Pixeling events.")
 
-            # Convert RA, Dec to pixel coordinates
-            xpix, ypix = w.wcs_world2pix(events["ra"], events["dec"], 1)
+            if on_image:
+                # These events already have pixel coordinates
+                xpix = events.pop("xpix")
+                ypix = events.pop("ypix")
+            else:
+                # Convert RA, Dec to pixel coordinates
+                xpix, ypix = w.wcs_world2pix(events["ra"], events["dec"], 1)
 
-            xpix -= event_params["pix_center"][0]
-            ypix -= event_params["pix_center"][1]
+                xpix -= event_params["pix_center"][0]
+                ypix -= event_params["pix_center"][1]
 
-            events.pop("ra")
-            events.pop("dec")
+                events.pop("ra")
+                events.pop("dec")
 
             n_evt = xpix.size
 
@@ -234,10 +275,12 @@ def generate_events(source, exp_time, instrument, sky_center,
             detx -= x_offset
             dety -= y_offset
 
-            # PSF scattering of detector coordinates
+            # PSF scattering of detector coordinates, unless the PSF 
+            # was already applied in the image plane
 
-            mylog.info(f"Scattering events with a {psf}-based PSF.")
-            detx, dety = psf.scatter(detx, dety, events["energy"])
+            if not on_image:
+                mylog.info(f"Scattering events with a {psf}-based PSF.")
+                detx, dety = psf.scatter(detx, dety, events["energy"])
 
             # Convert detector coordinates to chip coordinates.
             # Throw out events that don't fall on any chip.
@@ -542,6 +585,10 @@ def make_background_file(out_file, exp_time, instrument, sky_center,
                                            input_pt_sources=input_pt_sources,
                                            absorb_model=absorb_model,
                                            nH=nH, prng=prng)
+    # Background files are sorted by time, so that the events within
+    # a time window can be found quickly when they are reused
+    order = np.argsort(events["time"], kind="stable")
+    events = {key: events[key][order] for key in events}
     write_event_file(events, event_params, out_file, overwrite=overwrite)
 
 
@@ -551,7 +598,9 @@ def instrument_simulator(input_events, out_file, exp_time, instrument,
                          bkgnd_file=None, no_dither=False, 
                          dither_params=None, roll_angle=0.0, 
                          subpixel_res=False, aimpt_shift=None,
-                         bkg_nH=0.05, input_pt_sources=None, prng=None):
+                         bkg_nH=0.05, input_pt_sources=None, prng=None, 
+                         fast_image=False, prefetch=0, tile_size=None,
+                         bkgnd_time_offset=0.0):
     """
     Take unconvolved events and create an event file from them. This
     function calls generate_events to do the following:
@@ -630,6 +679,30 @@ def instrument_simulator(input_events, out_file, exp_time, instrument,
         be specified if you have a reason to generate the same 
         set of random numbers, such as for a test. Default is None, 
         which sets the seed based on the system time. 
+    fast_image : boolean, optional
+        If True, events for SIMPUT sources with a spectrum and an image
+        are generated by convolving the image with the PSF in a number
+        of energy bands and Poisson sampling the pixels of the result,
+        instead of scattering every photon through the PSF. This is 
+        much faster for bright extended sources. Default: False
+    prefetch : integer, optional
+        If the input is a SIMPUT catalog, read up to this many sources 
+        ahead of the one being processed on a background thread, so
+        that reading them from disk overlaps with processing. 
+        Default: 0, which reads each source when it is needed.
+    tile_size : integer, optional
+        If set, the events are sorted into square tiles of this many
+        sky pixels on a side, and a tile index is written to the 
+        event file, which speeds up making images, spectra, and 
+        profiles of regions of the file. See 
+        :func:`~soxs.events.make_tile_index`. Default: None
+    bkgnd_time_offset : float, (value, unit) tuple, :class:`~astropy.units.Quantity`, or string, optional
+        If *bkgnd_file* is set, the background events are taken from 
+        the time window of the background file which starts at this
+        time, in seconds. If set to "random", the window starts at a
+        random time, so that independent backgrounds can be drawn from
+        one background file which is much longer than the observation.
+        Default: 0.0
 
     Examples
     --------
@@ -644,7 +717,8 @@ def instrument_simulator(input_events, out_file, exp_time, instrument,
     events, event_params = generate_events(input_events, exp_time, instrument, sky_center,
                                            no_dither=no_dither, dither_params=dither_params, 
                                            roll_angle=roll_angle, subpixel_res=subpixel_res, 
-                                           aimpt_shift=aimpt_shift, prng=prng)
+                                           aimpt_shift=aimpt_shift, fast_image=fast_image,
+                                           prefetch=prefetch, prng=prng)
     # If the user wants backgrounds, either make the background or add an already existing
     # background event file. It may be necessary to reproject events to a new coordinate system.
     if bkgnd_file is None:
@@ -665,12 +739,15 @@ def instrument_simulator(input_events, out_file, exp_time, instrument,
         mylog.info(f"Adding background events from the file {bkgnd_file}.")
         if not os.path.exists(bkgnd_file):
             raise IOError(f"Cannot find the background event file {bkgnd_file}!")
-        events = add_background_from_file(events, event_params, bkgnd_file)
+        events = add_background_from_file(events, event_params, bkgnd_file,
+                                          time_offset=bkgnd_time_offset,
+                                          prng=prng)
     if len(events["energy"]) == 0:
         mylog.warning("No events were detected from source or background!! We "
                       "will not write an event file.")
     else:
-        write_event_file(events, event_params, out_file, overwrite=overwrite)
+        write_event_file(events, event_params, out_file, overwrite=overwrite,
+                         tile_size=tile_size)
     mylog.info("Observation complete.")
 
 
@@ -678,7 +755,7 @@ def simulate_spectrum(spec, instrument, exp_time, out_file,
                       instr_bkgnd=False, foreground=False,
                       ptsrc_bkgnd=False, bkgnd_area=None,
                       absorb_model="wabs", bkg_nH=0.05,
-                      overwrite=False, prng=None, **kwargs):
+                      overwrite=False, prng=None, noisy=True, **kwargs):
     """
     Generate a PI or PHA spectrum from a :class:`~soxs.spectra.Spectrum`
     by convolving it with responses. To be used if one wants to 
@@ -723,6 +800,9 @@ def simulate_spectrum(spec, instrument, exp_time, out_file,
         be specified if you have a reason to generate the same 
         set of random numbers, such as for a test. Default is None, 
         which sets the seed based on the system time. 
+    noisy : boolean, optional
+        If False, the expected counts in each channel are written
+        instead of a Poisson realization of them. Default: True
 
     Examples
     --------
@@ -773,14 +853,16 @@ def simulate_spectrum(spec, instrument, exp_time, out_file,
 
     if spec is not None:
         cspec = ConvolvedSpectrum.convolve(spec, arf)
-        out_spec += rmf.convolve_spectrum(cspec, exp_time, prng=prng)
+        out_spec += rmf.convolve_spectrum(cspec, exp_time, noisy=noisy, 
+                                          prng=prng)
 
     fov = None if bkgnd_area is None else np.sqrt(bkgnd_area)
 
     if foreground:
         mylog.info("Adding in astrophysical foreground.")
         cspec_frgnd = ConvolvedSpectrum.convolve(hm_astro_bkgnd.to_spectrum(fov), arf)
-        out_spec += rmf.convolve_spectrum(cspec_frgnd, exp_time, prng=prng)
+        out_spec += rmf.convolve_spectrum(cspec_frgnd, exp_time, noisy=noisy,
+                                          prng=prng)
     if instr_bkgnd and instrument_spec["bkgnd"] is not None:
         mylog.info("Adding in instrumental background.")
         bkgnd_spec = instrument_spec["bkgnd"]
@@ -791,16 +873,273 @@ def simulate_spectrum(spec, instrument, exp_time, out_file,
             bkgnd_spec[0], bkgnd_spec[1],
             instrument_spec['focal_length'])
         out_spec += bkgnd_spec.generate_channel_spectrum(exp_time, bkgnd_area,
-                                                         prng=prng)
+                                                         noisy=noisy, prng=prng)
     if ptsrc_bkgnd:
         mylog.info("Adding in background from unresolved point-sources.")
         spec_plaw = BackgroundSpectrum.from_powerlaw(1.45, 0.0, 2.0e-7, emin=0.01,
                                                      emax=10.0, nbins=300000)
         spec_plaw.apply_foreground_absorption(bkg_nH, model=absorb_model)
         cspec_plaw = ConvolvedSpectrum.convolve(spec_plaw.to_spectrum(fov), arf)
-        out_spec += rmf.convolve_spectrum(cspec_plaw, exp_time, prng=prng)
+        out_spec += rmf.convolve_spectrum(cspec_plaw, exp_time, noisy=noisy,
+                                          prng=prng)
 
     bins = (np.arange(rmf.n_ch)+rmf.cmin).astype("int32")
 
     _write_spectrum(bins, out_spec, exp_time, rmf.header["CHANTYPE"], 
-                    event_params, out_file, overwrite=overwrite)
+                    event_params, out_file, overwrite=overwrite, noisy=noisy)
+
+
+def make_expected_counts(input_events, exp_time, instrument, sky_center,
+                         ebins=None, img_file=None, spec_file=None,
+                         instr_bkgnd=True, foreground=True, ptsrc_bkgnd=True,
+                         no_dither=False, dither_params=None, roll_angle=0.0,
+                         aimpt_shift=None, bkg_nH=0.05, absorb_model="wabs",
+                         reblock=1, overwrite=False):
+    """
+    Compute the expected (noise-free) counts image and channel spectrum
+    of an observation of a set of sources and backgrounds, using the ARF,
+    RMF, PSF, dither pattern, and chip geometry of an instrument but no
+    random draws. These are the mean values of the images and spectra of
+    event files created by :func:`~soxs.instrument.instrument_simulator`
+    with the same arguments.
+
+    The images of the sources are convolved with the PSF in a number of
+    energy bands. The point-source background is modeled as the flat
+    unresolved cosmic X-ray background used by
+    :func:`~soxs.instrument.simulate_spectrum`.
+
+    Parameters
+    ----------
+    input_events : string, dict, or None
+        The unconvolved events to be used as input. Can be one of the
+        following:
+        1. The name of a SIMPUT catalog file.
+        2. A Python dictionary containing the following items:
+        "ra": A NumPy array of right ascension values in degrees.
+        "dec": A NumPy array of declination values in degrees.
+        "energy": A NumPy array of energy values in keV.
+        "flux": The flux of the entire source, in units of erg/cm**2/s.
+    exp_time : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`
+        The exposure time to use, in seconds. 
+    instrument : string
+        The name of the instrument to use, which picks an instrument
+        specification from the instrument registry. 
+    sky_center : array, tuple, or list
+        The center RA, Dec coordinates of the observation, in degrees.
+    ebins : array-like or :class:`~astropy.units.Quantity`, optional
+        The edges of a set of energy bands in keV. If set, a cube of 
+        images in these bands is computed. Default: None, which
+        computes a single image of the counts at all energies.
+    img_file : string, optional
+        If set, the image (or cube) of expected counts will be written 
+        to this file. Default: None
+    spec_file : string, optional
+        If set, the spectrum of expected counts will be written to this
+        file. Default: None
+    instr_bkgnd : boolean, optional
+        Whether or not to include the instrumental/particle background. 
+        Default: True
+    foreground : boolean, optional
+        Whether or not to include the local foreground. 
+        Default: True
+    ptsrc_bkgnd : boolean, optional
+        Whether or not to include the point-source background. 
+        Default: True
+    no_dither : boolean, optional
+        If True, turn off dithering entirely. Default: False
+    dither_params : array-like of floats, optional
+        The parameters to use to control the size and period of the dither
+        pattern. The first two numbers are the dither amplitude in x and y
+        detector coordinates in arcseconds, and the second two numbers are
+        the dither period in x and y detector coordinates in seconds. 
+        Default: [8.0, 8.0, 1000.0, 707.0].
+    roll_angle : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`, optional
+        The roll angle of the observation in degrees. Default: 0.0
+    aimpt_shift : array-like, optional
+        A two-float array-like object which shifts the aimpoint on the 
+        detector from the nominal position. Units are in arcseconds.
+        Default: None, which results in no shift from the nominal aimpoint. 
+    bkg_nH : float, optional
+        The hydrogen column in units of 10**22 atoms/cm**2 for the 
+        point-source background. Default: 0.05
+    absorb_model : string, optional
+        The absorption model to use, "wabs" or "tbabs". Default: "wabs"
+    reblock : integer, optional
+        Change this value to reblock the image to larger 
+        pixel sizes (reblock >= 1). Default: 1
+    overwrite : boolean, optional
+        Whether or not to overwrite existing files with the same names.
+        Default: False
+
+    Returns
+    -------
+    A tuple of the image (or cube, with the energy band as the first
+    axis) of expected counts and the expected counts in each channel.
+
+    Examples
+    --------
+    >>> img, spec = make_expected_counts("sloshing_simput.fits", 
+    ...                                  (300.0, "ks"), "lynx_hdxi", 
+    ...                                  [30., 45.], ebins=[0.5, 2.0, 7.0])
+    """
+    from astropy.units import Quantity
+    import astropy.io.fits as pyfits
+    from soxs.background.foreground import hm_astro_bkgnd
+    from soxs.background.spectra import BackgroundSpectrum
+    from soxs.background.instrument import InstrumentalBackground
+    from soxs.events import _write_spectrum
+    from soxs.image_plane import _image_plane_bands, _add_to_image, \
+        _dithered_chip_masks, _sky_exposure
+    from soxs.spectra import ConvolvedSpectrum
+    exp_time = parse_value(exp_time, "s")
+    roll_angle = parse_value(roll_angle, "deg")
+    source_list, parameters = _parse_source_input(input_events)
+
+    instrument_spec, arf, rmf, event_params, w, rot_mat = \
+        _setup_observation(exp_time, instrument, sky_center, no_dither,
+                           dither_params, roll_angle, aimpt_shift)
+
+    psf_type = instrument_spec["psf"][0]
+    psf = psf_model_registry[psf_type](instrument_spec)
+
+    if ebins is None:
+        out_ebins = np.array([0.0, np.inf])
+    else:
+        out_ebins = Quantity(ebins, "keV").value
+    n_out = out_ebins.size-1
+    nx = event_params["num_pixels"]
+    nxo = 2*nx//reblock
+    image = np.zeros((n_out, nxo, nxo))
+    spec = np.zeros(rmf.n_ch)
+    rmf_mat = rmf._channel_matrix()
+
+    masks, x0, y0 = _dithered_chip_masks(event_params)
+
+    for i, src in enumerate(source_list):
+
+        mylog.info(f"Computing expected counts from source "
+                   f"{parameters['src_names'][i]}.")
+
+        refband = [parameters["emin"][i], parameters["emax"][i]]
+        for ebins_b, counts_b, img, xlo, ylo in _image_plane_bands(
+                src, exp_time, refband, arf, psf, w, rot_mat, event_params,
+                flux=parameters["flux"][i], pixelize=True):
+            # Only the counts which fall on the chips are detected
+            img *= _sky_exposure(masks, x0, y0, rot_mat, event_params,
+                                 xlo, ylo, img.shape[1], img.shape[0]).sum(axis=0)
+            cumc = np.concatenate([[0.0], np.cumsum(counts_b)])
+            frac = np.diff(np.interp(out_ebins, ebins_b, cumc))/cumc[-1]
+            _add_to_image(image, frac[:, np.newaxis, np.newaxis]*img, 
+                          xlo, ylo, reblock)
+            h = np.diff(np.interp(rmf.ebins, ebins_b, cumc))
+            spec += img.sum()/cumc[-1]*rmf_mat.T.dot(h)
+
+    # The backgrounds are uniform over the chips, so we need the 
+    # counts in each band and channel for a single pixel
+    n_chips = masks.shape[0]
+    pixel_area = (event_params["plate_scale"]*60.0)**2
+    pixel_width = np.sqrt(pixel_area)
+    bkg_img = np.zeros((n_chips, n_out))
+    bkg_spec = np.zeros((n_chips, rmf.n_ch))
+
+    diffuse = []
+    if foreground:
+        mylog.info("Adding in astrophysical foreground.")
+        diffuse.append(hm_astro_bkgnd.to_spectrum(pixel_width))
+    if ptsrc_bkgnd:
+        mylog.info("Adding in background from unresolved point-sources.")
+        spec_plaw = BackgroundSpectrum.from_powerlaw(1.45, 0.0, 2.0e-7, emin=0.01,
+                                                     emax=10.0, nbins=300000)
+        spec_plaw.apply_foreground_absorption(bkg_nH, model=absorb_model)
+        diffuse.append(spec_plaw.to_spectrum(pixel_width))
+    for dspec in diffuse:
+        cspec = ConvolvedSpectrum.convolve(dspec, arf)
+        cumc = np.concatenate([[0.0], np.cumsum(cspec._flux*cspec._de*exp_time)])
+        bkg_img += np.diff(np.interp(out_ebins, cspec._ebins, cumc))
+        bkg_spec += rmf_mat.T.dot(np.diff(np.interp(rmf.ebins, cspec._ebins, cumc)))
+
+    if instr_bkgnd and instrument_spec["bkgnd"] is not None:
+        mylog.info("Adding in instrumental background.")
+        bkgnd_spec = instrument_spec["bkgnd"]
+        if isinstance(bkgnd_spec[0], str):
+            bkgnd_spec = [bkgnd_spec]*n_chips
+        emin = rmf.ebounds_data["E_MIN"]
+        emax = rmf.ebounds_data["E_MAX"]
+        # The channel energies are uniformly distributed between 
+        # E_MIN and E_MAX, so find the fraction of each in each band
+        overlap = np.clip(np.minimum(emax[:, np.newaxis], out_ebins[1:]) -
+                          np.maximum(emin[:, np.newaxis], out_ebins[:-1]),
+                          0.0, None)/(emax-emin)[:, np.newaxis]
+        for j in range(n_chips):
+            bspec = InstrumentalBackground.from_filename(
+                bkgnd_spec[j][0], bkgnd_spec[j][1], instrument_spec['focal_length'])
+            counts = bspec.generate_channel_spectrum(exp_time, pixel_area, 
+                                                     noisy=False)
+            ch = np.asarray(bspec.channel) - rmf.cmin
+            keep = (ch >= 0) & (ch < rmf.n_ch)
+            bkg_spec[j, ch[keep]] += counts[keep]
+            bkg_img[j] += counts[keep].dot(overlap[ch[keep]])
+
+    if bkg_img.any():
+        # Sum the backgrounds over the sky pixel frame in blocks of rows
+        chip_area = np.zeros(n_chips)
+        num_rows = max(1, (1 << 22)//(2*nx))
+        for ylo in range(1, 2*nx+1, num_rows):
+            ny = min(num_rows, 2*nx+1-ylo)
+            expo = _sky_exposure(masks, x0, y0, rot_mat, event_params,
+                                 1, ylo, 2*nx, ny)
+            chip_area += expo.sum(axis=(1, 2))
+            _add_to_image(image, np.tensordot(bkg_img.T, expo, axes=1),
+                          1, ylo, reblock)
+        spec += bkg_spec.T.dot(chip_area)
+
+    if ebins is None:
+        image = image[0]
+
+    if img_file is not None:
+        hdus = [pyfits.PrimaryHDU(image)]
+        hdu = hdus[0]
+        hdu.header["MTYPE1"] = "EQPOS"
+        hdu.header["MFORM1"] = "RA,DEC"
+        hdu.header["CTYPE1"] = "RA---TAN"
+        hdu.header["CTYPE2"] = "DEC--TAN"
+        hdu.header["CRVAL1"] = event_params["sky_center"][0]
+        hdu.header["CRVAL2"] = event_params["sky_center"][1]
+        hdu.header["CUNIT1"] = "deg"
+        hdu.header["CUNIT2"] = "deg"
+        hdu.header["CDELT1"] = -event_params["plate_scale"]*reblock
+        hdu.header["CDELT2"] = event_params["plate_scale"]*reblock
+        hdu.header["CRPIX1"] = 0.5*(nxo+1)
+        hdu.header["CRPIX2"] = 0.5*(nxo+1)
+        hdu.header["EXPOSURE"] = exp_time
+        hdu.name = "IMAGE"
+        if ebins is not None:
+            # The third axis is the number of the energy band, which
+            # is the CHANNEL in the EBOUNDS table
+            hdu.header["CTYPE3"] = "CHANNEL"
+            hdu.header["CRVAL3"] = 1.0
+            hdu.header["CDELT3"] = 1.0
+            hdu.header["CRPIX3"] = 1.0
+            col1 = pyfits.Column(name="CHANNEL", format="1J",
+                                 array=np.arange(1, n_out+1, dtype="int32"))
+            col2 = pyfits.Column(name="E_MIN", format="1D", unit="keV",
+                                 array=out_ebins[:-1])
+            col3 = pyfits.Column(name="E_MAX", format="1D", unit="keV",
+                                 array=out_ebins[1:])
+            tbhdu = pyfits.BinTableHDU.from_columns([col1, col2, col3])
+            tbhdu.name = "EBOUNDS"
+            hdus.append(tbhdu)
+        pyfits.HDUList(hdus).writeto(img_file, overwrite=overwrite)
+
+    if spec_file is not None:
+        spec_params = {"RESPFILE": os.path.split(rmf.filename)[-1],
+                       "ANCRFILE": os.path.split(arf.filename)[-1],
+                       "TELESCOP": rmf.header["TELESCOP"],
+                       "INSTRUME": rmf.header["INSTRUME"],
+                       "MISSION": rmf.header.get("MISSION", "")}
+        bins = (np.arange(rmf.n_ch)+rmf.cmin).astype("int32")
+        _write_spectrum(bins, spec, exp_time, rmf.header["CHANTYPE"],
+                        spec_params, spec_file, overwrite=overwrite, 
+                        noisy=False)
+
+    return image, spec
@@ -61,7 +61,8 @@ class InstrumentRegistry:
                 fns.append(bkgnd)
             logs.append("instrumental background model")
         if inst_spec['psf'] is not None:
-            if "image" in inst_spec['psf'][0]:
+            if "image" in inst_spec['psf'][0] or \
+                    inst_spec['psf'][0] == "eef":
                 fns.append(inst_spec['psf'][1])
                 logs.append("PSF model")
         for fn, log in zip(fns, logs):
@@ -3,6 +3,7 @@ import astropy.io.fits as pyfits
 from astropy.units import Quantity
 
 from soxs.constants import sigma_to_fwhm
+from soxs.spatial import _invert_cdf
 from soxs.utils import parse_prng, get_data_file, \
     image_pos, find_nearest
 
@@ -10,6 +11,63 @@ from soxs.utils import parse_prng, get_data_file, \
 psf_model_registry = {}
 
 
+def _radial_kernel_radius(eef, max_radius):
+    # The radius in pixels which encloses 99.9% of the PSF
+    r = np.arange(1, max_radius+1)
+    return int(r[min(np.searchsorted(eef(r), 0.999), r.size-1)])
+
+
+def _radial_density(eef, c, d):
+    # Average the PSF over an annulus of width 2*d at each point of
+    # the grid with coordinates c along each axis
+    r = np.hypot(*np.meshgrid(c, c))
+    rlo = np.maximum(r-d, 0.0)
+    rhi = r+d
+    return (eef(rhi)-eef(rlo))/(rhi*rhi-rlo*rlo)
+
+
+def _radial_kernel(eef, k, nsub, nfine=16):
+    # Integrate the PSF over each cell using its average over an 
+    # annulus one cell wide, and integrate the cells nearest to the
+    # center, where the PSF may be sharply peaked, on a grid of cells
+    # *nfine* times smaller
+    n = 2*k*nsub
+    f = _radial_density(eef, (np.arange(n)+0.5)/nsub - k, 0.5/nsub)
+    cf = (np.arange(4*nfine)+0.5)/(nsub*nfine) - 2.0/nsub
+    ff = _radial_density(eef, cf, 0.5/(nsub*nfine))
+    f[n//2-2:n//2+2, n//2-2:n//2+2] = \
+        ff.reshape(4, nfine, 4, nfine).mean(axis=(1, 3))
+    return f/f.sum()
+
+
+def _image_kernel_radius(im, ctr, scale, max_radius):
+    iy, ix = np.nonzero(im > 0.0)
+    dx = (np.array([ix.min(), ix.max()])+1-ctr[0])*scale[0]
+    dy = (np.array([iy.min(), iy.max()])+1-ctr[1])*scale[1]
+    r = np.abs(np.concatenate([dx, dy])).max()+0.5*np.abs(scale).max()
+    return int(min(max(np.ceil(r), 1), max_radius))
+
+
+def _image_kernel(im, ctr, scale, k, nsub):
+    # Deposit the PSF image onto the cells, splitting each image pixel
+    # into points no larger than the cells
+    im = np.asarray(im, dtype="float64")
+    iy, ix = np.nonzero(im > 0.0)
+    ns = int(np.ceil(np.abs(scale).max()*nsub))
+    offsets = (np.arange(ns)+0.5)/ns-0.5
+    ox, oy = np.meshgrid(offsets, offsets)
+    dx = ((ix[:, np.newaxis]+1+ox.ravel()).ravel()-ctr[0])*scale[0]
+    dy = ((iy[:, np.newaxis]+1+oy.ravel()).ravel()-ctr[1])*scale[1]
+    n = 2*k*nsub
+    jx = np.floor((dx+k)*nsub).astype("int64")
+    jy = np.floor((dy+k)*nsub).astype("int64")
+    inside = (jx >= 0) & (jx < n) & (jy >= 0) & (jy < n)
+    weights = np.repeat(im[iy, ix], ns*ns)
+    f = np.bincount(jy[inside]*n+jx[inside], weights=weights[inside],
+                    minlength=n*n).reshape(n, n)
+    return f/f.sum()
+
+
 class RegisteredPSFModel(type):
     def __init__(cls, name, b, d):
         type.__init__(cls, name, b, d)
@@ -26,6 +84,23 @@ class PSF(metaclass=RegisteredPSFModel):
     def __str__(self):
         return self._psf_type
 
+    def _kernel_radius(self, x, y, e, max_radius):
+        """
+        The half-width in pixels, no larger than *max_radius*, of
+        the grid needed by :meth:`_kernel` at the detector position
+        (x, y) and the energy *e*.
+        """
+        raise NotImplementedError
+
+    def _kernel(self, x, y, e, k, nsub):
+        """
+        The fraction of the PSF at the detector position (x, y) and
+        the energy *e* which falls within each cell of a grid 2*k 
+        pixels wide centered on (x, y), with *nsub* cells per pixel
+        along each axis.
+        """
+        raise NotImplementedError
+
 
 class GaussianPSF(PSF):
     _psf_type = "gaussian"
@@ -42,6 +117,129 @@ class GaussianPSF(PSF):
         y += self.prng.normal(loc=0.0, scale=self.sigma, size=n_evt)
         return x, y
 
+    def _eef(self, r):
+        return 1.0-np.exp(-0.5*(r/self.sigma)**2)
+
+    def _kernel_radius(self, x, y, e, max_radius):
+        return _radial_kernel_radius(self._eef, max_radius)
+
+    def _kernel(self, x, y, e, k, nsub):
+        return _radial_kernel(self._eef, k, nsub)
+
+
+class KingPSF(PSF):
+    _psf_type = "king"
+
+    def __init__(self, inst, prng=None):
+        super().__init__(prng)
+        plate_scale_arcsec = inst['fov']/inst['num_pixels']*60.0
+        self.r_c = inst["psf"][1] / plate_scale_arcsec
+        self.alpha = inst["psf"][2]
+        if self.alpha <= 1.0:
+            raise ValueError("The slope of the King profile must be "
+                             "greater than 1!")
+
+    def scatter(self, x, y, e):
+        n_evt = x.size
+        # Invert the encircled energy of the King profile,
+        # EEF(r) = 1-(1+(r/r_c)**2)**(1-alpha)
+        u = self.prng.uniform(size=n_evt)
+        r = self.r_c*np.sqrt((1.0-u)**(1.0/(1.0-self.alpha))-1.0)
+        phi = 2.0*np.pi*self.prng.uniform(size=n_evt)
+        x += r*np.cos(phi)
+        y += r*np.sin(phi)
+        return x, y
+
+    def _eef(self, r):
+        return 1.0-(1.0+(r/self.r_c)**2)**(1.0-self.alpha)
+
+    def _kernel_radius(self, x, y, e, max_radius):
+        return _radial_kernel_radius(self._eef, max_radius)
+
+    def _kernel(self, x, y, e, k, nsub):
+        return _radial_kernel(self._eef, k, nsub)
+
+
+class EEFPSF(PSF):
+    _psf_type = "eef"
+
+    def __init__(self, inst, prng=None):
+        super().__init__(prng)
+        self.eef_file = get_data_file(inst['psf'][1])
+        self.det_ctr = np.array(inst['aimpt_coords'])
+        plate_scale_arcmin = inst['fov']/inst['num_pixels']
+        plate_scale_arcsec = plate_scale_arcmin*60.0
+        eef_e = []
+        eef_r = []
+        self.eef_tables = []
+        with pyfits.open(self.eef_file) as f:
+            for hdu in f:
+                if not isinstance(hdu, pyfits.BinTableHDU):
+                    continue
+                eef_e.append(hdu.header["ENERGY"])
+                key = "THETA" if "OFFAXIS" not in hdu.header else "OFFAXIS"
+                eef_r.append(hdu.header[key])
+                unit = hdu.columns["RADIUS"].unit
+                if unit is None:
+                    unit = "arcsec"
+                r = Quantity(hdu.data["RADIUS"], unit).to_value("arcsec")
+                eef = np.maximum.accumulate(hdu.data["EEF"].astype("float64"))
+                if r[0] > 0.0:
+                    r = np.insert(r, 0, 0.0)
+                    eef = np.insert(eef, 0, 0.0)
+                self.eef_tables.append((r/plate_scale_arcsec, eef/eef[-1]))
+        if len(self.eef_tables) == 0:
+            raise RuntimeError(f"No encircled energy tables were found "
+                               f"in {self.eef_file}!")
+        self.eef_e, self.ie = np.unique(eef_e, return_inverse=True)
+        if np.all(self.eef_e > 100.0):
+            # this is probably in eV
+            self.eef_e *= 1.0e-3
+        self.eef_r2, self.ir = np.unique(eef_r, return_inverse=True)
+        # Map each pair of energy and off-axis angle to a table. If 
+        # a pair has no table, use the one closest to it in off-axis 
+        # angle, and then in energy
+        self.table_idx = -np.ones((self.eef_e.size, self.eef_r2.size),
+                                  dtype="int")
+        self.table_idx[self.ie, self.ir] = np.arange(len(self.eef_tables))
+        have_e, have_r = np.nonzero(self.table_idx >= 0)
+        for i, j in zip(*np.nonzero(self.table_idx < 0)):
+            k = np.lexsort((np.abs(self.eef_e[have_e]-self.eef_e[i]),
+                            np.abs(self.eef_r2[have_r]-self.eef_r2[j])))[0]
+            self.table_idx[i, j] = self.table_idx[have_e[k], have_r[k]]
+        self.eef_r2 = (self.eef_r2/plate_scale_arcmin)**2
+
+    def scatter(self, x, y, e):
+        r2 = (x-self.det_ctr[0])**2 + (y-self.det_ctr[1])**2
+        idx_e = find_nearest(self.eef_e, e)
+        idx_r = find_nearest(self.eef_r2, r2)
+        n_evt = x.size
+        u = self.prng.uniform(size=n_evt)
+        r = np.zeros(n_evt)
+        # Each event is scattered using the table closest to it 
+        # in energy and off-axis angle
+        table_idx = self.table_idx[idx_e, idx_r]
+        for j, (rr, eef) in enumerate(self.eef_tables):
+            idxs = np.where(table_idx == j)[0]
+            r[idxs] = _invert_cdf(rr, eef, u[idxs])
+        phi = 2.0*np.pi*self.prng.uniform(size=n_evt)
+        x += r*np.cos(phi)
+        y += r*np.sin(phi)
+        return x, y
+
+    def _eef(self, x, y, e):
+        r2 = (x-self.det_ctr[0])**2 + (y-self.det_ctr[1])**2
+        idx_e = find_nearest(self.eef_e, np.atleast_1d(e))[0]
+        idx_r = find_nearest(self.eef_r2, np.atleast_1d(r2))[0]
+        rr, eef = self.eef_tables[self.table_idx[idx_e, idx_r]]
+        return lambda r: np.interp(r, rr, eef)
+
+    def _kernel_radius(self, x, y, e, max_radius):
+        return _radial_kernel_radius(self._eef(x, y, e), max_radius)
+
+    def _kernel(self, x, y, e, k, nsub):
+        return _radial_kernel(self._eef(x, y, e), k, nsub)
+
 
 class ImagePSF(PSF):
     _psf_type = "image"
@@ -73,6 +271,13 @@ class ImagePSF(PSF):
         dy *= self.scale[1]
         return x+dx, y+dy
 
+    def _kernel_radius(self, x, y, e, max_radius):
+        return _image_kernel_radius(self.imhdu.data, self.imctr, self.scale,
+                                    max_radius)
+
+    def _kernel(self, x, y, e, k, nsub):
+        return _image_kernel(self.imhdu.data, self.imctr, self.scale, k, nsub)
+
 
 class MultiImagePSF(PSF):
     _psf_type = "multi_image"
@@ -140,3 +345,23 @@ class MultiImagePSF(PSF):
                              f"({n_out}) does not equal the input number "
                              f"({n_in})!")
         return x, y
+
+    def _image(self, x, y, e):
+        r2 = (x-self.det_ctr[0])**2 + (y-self.det_ctr[1])**2
+        idx_e = find_nearest(self.img_e, np.atleast_1d(e))[0]
+        idx_r = find_nearest(self.img_r2, np.atleast_1d(r2))[0]
+        for j in range(self.num_images):
+            i, ie, ir = self.img_i[j]
+            if ie == idx_e and ir == idx_r:
+                with pyfits.open(self.img_file) as f:
+                    im = f[i].data.astype("float64")
+                return im, self.img_c[j], self.img_s[j]
+        raise ValueError(f"There is no PSF image for the energy {e} "
+                         f"and the position ({x}, {y})!")
+
+    def _kernel_radius(self, x, y, e, max_radius):
+        im, ctr, scale = self._image(x, y, e)
+        return _image_kernel_radius(im, ctr, scale, max_radius)
+
+    def _kernel(self, x, y, e, k, nsub):
+        return _image_kernel(*self._image(x, y, e), k, nsub)
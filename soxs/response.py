@@ -1,4 +1,6 @@
 import numpy as np
+from numpy.random import RandomState
+from collections import OrderedDict
 
 import astropy.io.fits as pyfits
 import astropy.units as u
@@ -12,6 +14,16 @@ from soxs.utils import get_data_file, ensure_numpy_array, image_pos, \
     mylog, parse_prng, parse_value
 
 
+# Effective areas interpolated onto spectral energy grids, cached
+# per ARF and grid since the same ones are used over and over
+_max_area_cache_entries = 64
+_area_cache = OrderedDict()
+
+# Number of photons from a photon list which are processed at once 
+# when determining which are detected
+phlist_chunk_size = 10000000
+
+
 class AuxiliaryResponseFile:
     r"""
     A class for auxiliary response files (ARFs).
@@ -68,7 +80,32 @@ class AuxiliaryResponseFile:
         """
         earea = np.interp(np.asarray(energy), self.emid, self.eff_area,
                           left=0.0, right=0.0)
-        return u.Quantity(earea, "cm**2")
+        return u.Quantity(np.asarray(earea), "cm**2", copy=False)
+
+    @property
+    def _cache_key(self):
+        # Based on the contents rather than the filename, so that
+        # modified or flat responses are handled correctly
+        return (self.eff_area.size, hash(self.emid.tobytes()), 
+                hash(self.eff_area.tobytes()))
+
+    def _area_on_grid(self, emid):
+        """
+        Interpolate the effective area onto the bin centers of a
+        spectral energy grid, caching the result for each ARF and 
+        grid. Returns a read-only array in cm**2.
+        """
+        emid = np.asarray(emid, dtype="float64")
+        key = self._cache_key + (emid.size, hash(emid.tobytes()))
+        if key in _area_cache:
+            _area_cache.move_to_end(key)
+            return _area_cache[key]
+        earea = self.interpolate_area(emid).value
+        earea.flags.writeable = False
+        _area_cache[key] = earea
+        if len(_area_cache) > _max_area_cache_entries:
+            _area_cache.popitem(last=False)
+        return earea
 
     def detect_events_spec(self, src, exp_time, refband, prng=None):
         from soxs.spectra import ConvolvedSpectrum
@@ -88,11 +125,16 @@ class AuxiliaryResponseFile:
         mylog.info(f"{energy.size} events detected.")
         return {"energy": energy, "ra": ra, "dec": dec}
 
-    def detect_events_phlist(self, events, exp_time, flux, refband, prng=None):
+    def detect_events_phlist(self, events, exp_time, flux, refband, 
+                             prng=None, chunk_size=None):
         """
         Use the ARF to determine a subset of photons which 
         will be detected.
 
+        The photons are processed in chunks, so that only the 
+        detected photons are ever copied from the arrays in 
+        *events*, which may be memory-mapped from a file.
+
         Parameters
         ----------
         events : dict of np.ndarrays
@@ -109,29 +151,101 @@ class AuxiliaryResponseFile:
             be specified if you have a reason to generate the same 
             set of random numbers, such as for a test. Default is None, 
             which sets the seed based on the system time. 
+        chunk_size : integer, optional
+            The number of photons to process at once. Default: None,
+            which uses the value of ``soxs.response.phlist_chunk_size``.
+
+        If *events* has an "area" item, each photon was drawn with its
+        own effective area (see 
+        :meth:`~soxs.simput.SimputPhotonList.from_models`), and is 
+        detected with a probability proportional to the ratio of the 
+        effective area of this ARF to its own.
         """
         prng = parse_prng(prng)
-        energy = np.asarray(events["energy"])
-        if energy.size == 0:
-            return events
-        earea = self.interpolate_area(energy).value
-        idxs = np.logical_and(energy >= refband[0], energy <= refband[1])
-        rate = flux/(energy[idxs].sum()*erg_per_keV)*earea[idxs].sum()
+        if chunk_size is None:
+            chunk_size = phlist_chunk_size
+        energy = events["energy"]
+        area = events.get("area", None)
+        keys = [key for key in events if key != "area"]
+        n_evt = energy.size
+        if n_evt == 0:
+            return {key: np.asarray(events[key]) for key in keys}
+        starts = np.arange(0, n_evt, chunk_size)
+        # Each chunk gets its own seed, so that the same photons 
+        # are thinned in both passes over the chunks
+        seeds = prng.randint(np.iinfo(np.int32).max, size=starts.size)
+
+        def _chunk_area(k):
+            # The effective area of each photon in a chunk, relative 
+            # to the effective area it was drawn with
+            e = np.asarray(energy[starts[k]:starts[k]+chunk_size])
+            earea = self.interpolate_area(e).value
+            if area is None:
+                inv_area = np.ones(e.size)
+            else:
+                inv_area = 1.0/np.asarray(area[starts[k]:starts[k]+chunk_size])
+            return e, earea*inv_area, inv_area
+
+        if area is None:
+            max_ratio = self.max_area
+        else:
+            max_ratio = max(_chunk_area(k)[1].max() 
+                            for k in range(starts.size))
+
+        def _thin_chunk(k):
+            e, ratio, inv_area = _chunk_area(k)
+            randvec = RandomState(seeds[k]).uniform(size=e.size)
+            return e, ratio, inv_area, randvec < ratio/max_ratio
+
+        # First pass: find the count rate and the number of photons
+        # in each chunk which survive thinning by the ARF
+        e_sum = 0.0
+        area_sum = 0.0
+        n_thin = np.zeros(starts.size, dtype="int64")
+        for k in range(starts.size):
+            e, ratio, inv_area, thinned = _thin_chunk(k)
+            idxs = np.logical_and(e >= refband[0], e <= refband[1])
+            e_sum += np.sum(e[idxs]*inv_area[idxs], dtype="float64")
+            area_sum += ratio[idxs].sum(dtype="float64")
+            n_thin[k] = thinned.sum()
+        rate = flux/(e_sum*erg_per_keV)*area_sum
         n_ph = prng.poisson(lam=rate*exp_time)
-        fak = float(n_ph)/energy.size
+        fak = float(n_ph)/n_evt
         if fak > 1.0:
-            mylog.error(f"Number of events in sample: {energy.size}, "
+            mylog.error(f"Number of events in sample: {n_evt}, "
                         f"Number of events wanted: {n_ph}")
             raise ValueError("This combination of exposure time and effective "
                              "area will result in more photons being drawn "
                              "than are available in the sample!!!")
-        w = earea / self.max_area
-        randvec = prng.uniform(size=energy.size)
-        eidxs = prng.permutation(np.where(randvec < w)[0])[:n_ph].astype("int64")
-        mylog.info(f"{n_ph} events detected.")
-        for key in events:
-            events[key] = np.asarray(events[key][eidxs])
-        return events
+        # The detected photons are a random subset of the photons which 
+        # survive thinning, so the number from each chunk is drawn
+        # from a hypergeometric distribution
+        n_det = np.zeros(starts.size, dtype="int64")
+        n_left = min(n_ph, n_thin.sum())
+        n_rest = n_thin.sum()
+        for k in range(starts.size):
+            if n_left == 0:
+                break
+            n_rest -= n_thin[k]
+            n_det[k] = prng.hypergeometric(n_thin[k], n_rest, n_left)
+            n_left -= n_det[k]
+
+        # Second pass: copy the detected photons from each chunk
+        det_events = {key: [] for key in keys}
+        for k in np.nonzero(n_det)[0]:
+            thinned = _thin_chunk(k)[-1]
+            eidxs = np.sort(prng.choice(np.flatnonzero(thinned), 
+                                        size=n_det[k], replace=False))
+            for key in keys:
+                chunk = events[key][starts[k]:starts[k]+chunk_size]
+                det_events[key].append(np.asarray(chunk[eidxs]))
+        for key in keys:
+            if len(det_events[key]) == 0:
+                det_events[key] = np.asarray(events[key][:0])
+            else:
+                det_events[key] = np.concatenate(det_events[key])
+        mylog.info(f"{n_det.sum()} events detected.")
+        return det_events
 
     def plot(self, xscale="log", yscale="log", xlabel=None,
              ylabel=None, fig=None, ax=None, **kwargs):
@@ -210,6 +324,40 @@ class FlatResponse(AuxiliaryResponseFile):
         self.max_area = area
 
 
+class _EnvelopeResponse(AuxiliaryResponseFile):
+    """
+    A response on the energy bins *ebins* whose effective area in each
+    bin is the largest of the effective areas of one or more ARFs, 
+    scaled so that its maximum is *area*.
+    """
+    def __init__(self, arfs, ebins, area):
+        if isinstance(arfs, (str, AuxiliaryResponseFile)):
+            arfs = [arfs]
+        self.filename = "envelope_response"
+        self.elo = ebins[:-1]
+        self.ehi = ebins[1:]
+        self.emid = 0.5*(self.elo+self.ehi)
+        self.eff_area = np.zeros(self.emid.size)
+        for arf in arfs:
+            if isinstance(arf, str):
+                if arf in instrument_registry:
+                    arf = AuxiliaryResponseFile.from_instrument(arf)
+                else:
+                    arf = AuxiliaryResponseFile(arf)
+            self.eff_area = np.maximum(self.eff_area, 
+                                       arf._area_on_grid(self.emid))
+        self.eff_area *= area/self.eff_area.max()
+        self.max_area = area
+
+    def bin_area(self, energy):
+        """
+        The effective area of the bins which the energies in
+        *energy* fall within.
+        """
+        idxs = np.searchsorted(self.elo, energy, side="right")-1
+        return self.eff_area[np.clip(idxs, 0, self.eff_area.size-1)]
+
+
 class RedistributionMatrixFile:
     r"""
     A class for redistribution matrix files (RMFs).
@@ -252,6 +400,7 @@ class RedistributionMatrixFile:
                 break
         self.cmin = self.header.get(f"TLMIN{num}", 1)
         self.cmax = self.header.get(f"TLMAX{num}", self.n_ch)
+        self._ch_matrix = None
 
     @classmethod
     def from_instrument(cls, name):
@@ -303,6 +452,35 @@ class RedistributionMatrixFile:
                 true_channel += list(range(start, start + nchan))
         return np.array(true_channel)
 
+    def _channel_matrix(self):
+        """
+        The probabilities of photons in each energy bin being detected
+        in each channel, as a sparse matrix whose rows are normalized
+        in the same way as in :meth:`scatter_energies`.
+        """
+        if self._ch_matrix is None:
+            from scipy.sparse import csr_matrix
+            rows = []
+            cols = []
+            vals = []
+            for k in range(self.n_e):
+                weights = ensure_numpy_array(
+                    np.nan_to_num(np.float64(self.data["MATRIX"][k])))
+                true_channel = self._make_channels(k)
+                if len(true_channel) == 0 or weights.sum() == 0.0:
+                    continue
+                ch = true_channel[:weights.size]-self.cmin
+                rows.append(np.full(ch.size, k))
+                cols.append(ch)
+                vals.append(weights[:ch.size]/weights.sum())
+            rows = np.concatenate(rows)
+            cols = np.concatenate(cols)
+            vals = np.concatenate(vals)
+            keep = (cols >= 0) & (cols < self.n_ch)
+            self._ch_matrix = csr_matrix((vals[keep], (rows[keep], cols[keep])),
+                                         shape=(self.n_e, self.n_ch))
+        return self._ch_matrix
+
     def eb_to_ch(self, energy):
         energy = parse_value(energy, "keV")
         return np.searchsorted(self.ebounds_data["E_MIN"], energy)-1
@@ -374,8 +552,8 @@ class RedistributionMatrixFile:
                           rate=False):
         prng = parse_prng(prng)
         exp_time = parse_value(exp_time, "s")
-        counts = cspec.flux.value * exp_time * cspec.de.value
-        spec = np.histogram(cspec.emid.value, self.ebins, weights=counts)[0]
+        counts = cspec._flux * exp_time * cspec._de
+        spec = np.histogram(cspec._emid, self.ebins, weights=counts)[0]
         conv_spec = np.zeros(self.n_ch)
         pbar = tqdm(leave=True, total=self.n_e, desc="Convolving spectrum ")
         if not isinstance(self.data["MATRIX"], pyfits.column._VLF) and \
@@ -30,18 +30,65 @@ def _parse_catalog_entry(src):
 
 
 class LazyReadSimputCatalog(Sequence):
-    def __init__(self, src_cat):
+    def __init__(self, src_cat, prefetch=0):
         self.src_cat = src_cat
+        self.prefetch = prefetch
 
     def __getitem__(self, i):
-        spec = self.src_cat.spectra[i]
-        return self.src_cat.read_source(spec)
+        return self.src_cat._read_source(i)
 
     def __len__(self):
         return self.src_cat.num_sources
 
-
-def read_simput_catalog(simput_file):
+    def __iter__(self):
+        if self.prefetch <= 0:
+            yield from super(LazyReadSimputCatalog, self).__iter__()
+            return
+        import queue
+        import threading
+        # Sources are read on a separate thread, up to *prefetch* of 
+        # them ahead of the one being used, so that reading them from
+        # disk overlaps with the work done on the previous ones
+        if self.src_cat._index is None:
+            self.src_cat._build_index()
+        sources = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def _reader():
+            for i in range(len(self)):
+                if stop.is_set():
+                    return
+                try:
+                    item = (self.src_cat._read_source(i), None)
+                except Exception as e:
+                    item = (None, e)
+                sources.put(item)
+                if item[1] is not None:
+                    return
+
+        thread = threading.Thread(target=_reader, daemon=True)
+        thread.start()
+        try:
+            for _ in range(len(self)):
+                src, err = sources.get()
+                if err is not None:
+                    raise err
+                yield src
+        finally:
+            # If iteration stops early, unblock the reader so it exits
+            stop.set()
+            while thread.is_alive():
+                try:
+                    sources.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+    def close(self):
+        self.src_cat.close()
+
+
+def read_simput_catalog(simput_file, prefetch=0):
     r"""
     Read events from a SIMPUT catalog. This will read 
     all of the sources in the catalog.
@@ -50,6 +97,11 @@ def read_simput_catalog(simput_file):
     ----------
     simput_file : string
         The SIMPUT file to read from.
+    prefetch : integer, optional
+        When iterating over the sources, read up to this many sources
+        ahead of the current one on a background thread, so that 
+        reading from disk overlaps with using the sources. Default: 0,
+        which reads each source when it is needed.
 
     Returns
     -------
@@ -62,7 +114,7 @@ def read_simput_catalog(simput_file):
                   "emax": sc.emax,
                   "src_names": sc.src_names,
                   "flux": sc.fluxes}
-    return LazyReadSimputCatalog(sc), parameters
+    return LazyReadSimputCatalog(sc, prefetch=prefetch), parameters
 
 
 class SimputCatalog:
@@ -81,6 +133,64 @@ class SimputCatalog:
         self.num_sources = self.spectra.size
         # timing not yet supported
         self.timing = np.array(["NULL"]*self.num_sources)
+        self._index = None
+        self._handles = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Close the source files which have been opened to read 
+        sources from this catalog.
+        """
+        for f, _ in self._handles.values():
+            f.close()
+        self._handles = {}
+
+    def _build_index(self):
+        """
+        Parse the SPECTRUM and IMAGE entries of every source once, so 
+        that each source can be read without searching or parsing.
+        """
+        spec_index = {}
+        entries = []
+        for i, (spec, img) in enumerate(zip(self.spectra, self.images)):
+            spec_index.setdefault(spec, i)
+            spec_entry = _parse_catalog_entry(spec)
+            if img.upper() == "NULL":
+                img_entry = None
+            else:
+                img_entry = _parse_catalog_entry(img)
+            entries.append((spec_entry, img_entry))
+        self._index = (spec_index, entries)
+
+    def _source_path(self, src_file):
+        # If no file is specified, assume the catalog and
+        # source are in the same file. Other files are 
+        # relative to the catalog file.
+        if src_file == "":
+            return self.filename
+        return os.path.join(os.path.dirname(self.filename), src_file)
+
+    def _get_hdu(self, src_file, extname, extver):
+        """
+        Return an HDU from a source file, keeping the file open
+        (and memory-mapped) so that other sources can be read from it. 
+        """
+        fn = os.path.normpath(self._source_path(src_file))
+        if fn not in self._handles:
+            f = pyfits.open(fn, memmap=True)
+            hdus = {}
+            for hdu in f[1:]:
+                name = hdu.name.lower()
+                hdus.setdefault((name, None), hdu)
+                hdus.setdefault((name, hdu.ver), hdu)
+            self._handles[fn] = (f, hdus)
+        return self._handles[fn][1][extname, extver]
 
     @classmethod
     def from_source(cls, filename, source, src_filename=None,
@@ -118,6 +228,41 @@ class SimputCatalog:
                   overwrite=overwrite)
         return sc
 
+    @classmethod
+    def from_sources(cls, filename, sources, src_filename=None,
+                     overwrite=False):
+        """
+        Create a new :class:`~soxs.simput.SimputCatalog`
+        instance using a list of :class:`~soxs.simput.SimputSource`
+        instances, which are all written at once. See 
+        :meth:`~soxs.simput.SimputCatalog.extend` for details.
+
+        Parameters
+        ----------
+        filename : string
+            The name of the SIMPUT catalog file to write.
+        sources : list of :class:`~soxs.simput.SimputSource`
+            The SIMPUT sources to create the catalog with.
+        src_filename : string, optional
+            If set, this will be the filename to write the sources
+            to. By default, the sources will be written to the same
+            file as the SIMPUT catalog.
+        overwrite : boolean, optional
+            Whether or not to overwrite an existing file with
+            the same name. If src_filename=None and the sources are
+            to the written to the SIMPUT catalog file, then this
+            argument is ignored. If src_filename is another value,
+            it exists, and overwrite=False, the sources will be
+            appended to the file. Default: False
+        """
+        sc = cls([], [], [], [], [], [], [], [], filename)
+        if os.path.exists(filename) and not overwrite:
+            raise IOError(f"{filename} exists and overwrite=False!")
+        sc._write_catalog(overwrite=overwrite)
+        sc.extend(sources, src_filename=src_filename,
+                  overwrite=overwrite)
+        return sc
+
     @classmethod
     def from_file(cls, filename):
         """
@@ -152,24 +297,33 @@ class SimputCatalog:
         Read a source from the SIMPUT catalog with the identifier
         *spec* for the SPECTRUM field.
         """
+        if self._index is None:
+            self._build_index()
+        return self._read_source(self._index[0][spec])
+
+    def _read_source(self, i):
+        """
+        Read the *i*-th source in the SIMPUT catalog.
+        """
         from .spectra import Spectrum
         from astropy.io.fits.column import _VLF
-        i = np.where(self.spectra == spec)[0][0]
-        src_file, extname, extver, row = _parse_catalog_entry(spec)
-        # If no file is specified, assume the catalog and
-        # source are in the same file
-        if src_file == "":
-            fn_src = self.filename
-        else:
-            fn_src = src_file
-        ext = extname if extver is None else (extname, extver)
-        data = pyfits.getdata(fn_src, ext)
+        if self._index is None:
+            self._build_index()
+        spec_entry, img_entry = self._index[1][i]
+        src_file, extname, extver, row = spec_entry
+        data = self._get_hdu(src_file, extname, extver).data
         if extname == "phlist":
-            ra = Quantity(data["ra"], "deg")
-            dec = Quantity(data["dec"], "deg")
-            energy = Quantity(data["energy"], "keV")
+            # The columns are not copied, so that large photon lists
+            # are only read from the file when they are used
+            ra = Quantity(data["ra"], "deg", copy=False)
+            dec = Quantity(data["dec"], "deg", copy=False)
+            energy = Quantity(data["energy"], "keV", copy=False)
+            if "AREA" in data.columns.names:
+                area = Quantity(data["area"], "cm**2", copy=False)
+            else:
+                area = None
             src = SimputPhotonList(ra, dec, energy, self.fluxes[i],
-                                   name=self.src_names[i])
+                                   name=self.src_names[i], area=area)
         elif extname == "spectrum":
             emid = data["energy"]
             flux = data["fluxdensity"]
@@ -178,26 +332,25 @@ class SimputCatalog:
                 flux = flux[0]
             elif row is not None:
                 if isinstance(row, str):
-                    row = np.where(data["name"])[0][0]
+                    row = np.where(data["name"] == row)[0][0]
+                else:
+                    # Row numbers in SIMPUT catalogs start at 1
+                    row -= 1
                 emid = emid[row, :]
                 flux = flux[row, :]
+            # Copy the arrays so that the spectrum survives the file
+            # being closed
+            emid = np.array(emid)
+            flux = np.array(flux)
             de = np.diff(emid)[0]
             ebins = np.append(emid - 0.5 * de, emid[-1] + 0.5 * de)
             spec = Spectrum(ebins, flux)
-            if self.images[i].upper() != "NULL":
-                src_file, extname, extver, _ = \
-                    _parse_catalog_entry(self.images[i])
-                # If no file is specified, assume the catalog and
-                # source are in the same file
-                if src_file == "":
-                    fn_img = self.filename
-                else:
-                    fn_img = src_file
-                ext = extname if extver is None else (extname, extver)
-                imdata, imheader = pyfits.getdata(
-                    fn_img, ext, header=True)
-                imhdu = pyfits.ImageHDU(data=imdata,
-                                        header=imheader)
+            if img_entry is not None:
+                img_hdu = self._get_hdu(*img_entry[:3])
+                # Copy the data so that the image survives the file
+                # being closed
+                imhdu = pyfits.ImageHDU(data=np.array(img_hdu.data),
+                                        header=img_hdu.header.copy())
             else:
                 imhdu = None
             src = SimputSpectrum(spec, self.ra[i], self.dec[i],
@@ -277,6 +430,10 @@ class SimputCatalog:
         self.emin = np.append(self.emin, source.emin)
         self.emax = np.append(self.emax, source.emax)
         self.num_sources += 1
+        # The source files may change, so they must be reopened
+        # and the catalog reindexed
+        self.close()
+        self._index = None
 
         if src_filename is None:
             src_filename = self.filename
@@ -313,6 +470,148 @@ class SimputCatalog:
         source._write_source(src_filename, extver, img_extver=img_extver,
                              overwrite=overwrite)
 
+    def extend(self, sources, src_filename=None, overwrite=False):
+        """
+        Add many sources to this catalog at once. Unlike calling
+        :meth:`~soxs.simput.SimputCatalog.append` for each source, the
+        source file is opened and the catalog is written only once.
+        Sources with spectra (but not photon lists) which share the 
+        same energy bins are written as the rows of a single SPECTRUM 
+        extension.
+
+        Parameters
+        ----------
+        sources : list of :class:`~soxs.simput.SimputSource`
+            The SIMPUT sources to append to this catalog.
+        src_filename : string, optional
+            If set, this will be the filename to write the sources
+            to. By default, the sources will be written to the same
+            file as the SIMPUT catalog.
+        overwrite : boolean, optional
+            Whether or not to overwrite an existing file with
+            the same name. If src_filename=None and the sources are
+            to be written to the SIMPUT catalog file, then this
+            argument is ignored. If src_filename is another value,
+            it exists, and overwrite=False, the sources will be
+            appended to the file. Default: False
+        """
+        if len(sources) == 0:
+            return
+        self.close()
+        self._index = None
+
+        if src_filename is None:
+            src_filename = self.filename
+
+        if src_filename == self.filename:
+            # Don't overwrite the SIMPUT catalog file!!
+            overwrite = False
+        elif overwrite and os.path.exists(src_filename):
+            mylog.warning(f"Overwriting {src_filename}.")
+            os.remove(src_filename)
+
+        if src_filename != self.filename:
+            src_fn = os.path.join(
+                os.path.relpath(Path(src_filename).parent,
+                                Path(self.filename).parent),
+                os.path.basename(src_filename))
+        else:
+            src_fn = ""
+
+        extvers = {extname: _determine_extver(src_filename, extname)
+                   for extname in ["PHLIST", "SPECTRUM", "IMAGE"]}
+
+        # Group the spectra by their energy bins, so that each group
+        # can be written as a single extension
+        groups = {}
+        for i, source in enumerate(sources):
+            if source.src_type == "spectrum":
+                key = source.spec.emid.value.tobytes()
+                groups.setdefault(key, []).append(i)
+        rows = {}
+        hdus = []
+        for idxs in groups.values():
+            hdus.append(_spectrum_table_hdu([sources[i] for i in idxs],
+                                            extvers["SPECTRUM"]))
+            for k, i in enumerate(idxs):
+                rows[i] = (extvers["SPECTRUM"], k+1)
+            extvers["SPECTRUM"] += 1
+
+        spectra = []
+        images = []
+        for i, source in enumerate(sources):
+            if source.src_type == "spectrum":
+                extver, row = rows[i]
+                spec = f"{src_fn}[SPECTRUM,{extver}][#row=={row}]"
+            else:
+                extver = extvers[source.src_type.upper()]
+                extvers[source.src_type.upper()] += 1
+                spec = f"{src_fn}[{source.src_type.upper()},{extver}]"
+                hdus.append(source._make_table_hdu(extver))
+            if source.imhdu is not None:
+                img_extver = extvers["IMAGE"]
+                extvers["IMAGE"] += 1
+                img = f"{src_fn}[IMAGE,{img_extver}]"
+                imhdu = pyfits.ImageHDU(data=source.imhdu.data,
+                                        header=source.imhdu.header.copy())
+                imhdu.header["EXTVER"] = img_extver
+                hdus.append(imhdu)
+            elif source.src_type == "phlist":
+                img = spec
+            else:
+                img = "NULL"
+            spectra.append(spec)
+            images.append(img)
+
+        self.src_names = np.append(self.src_names, 
+                                   [source.name for source in sources])
+        self.ra = np.append(self.ra, [source.ra for source in sources])
+        self.dec = np.append(self.dec, [source.dec for source in sources])
+        self.fluxes = np.append(self.fluxes, 
+                                [source.flux for source in sources])
+        self.emin = np.append(self.emin, [source.emin for source in sources])
+        self.emax = np.append(self.emax, [source.emax for source in sources])
+        self.spectra = np.append(self.spectra, spectra)
+        self.images = np.append(self.images, images)
+        self.num_sources += len(sources)
+
+        self._write_catalog()
+
+        if os.path.exists(src_filename):
+            mylog.info(f"Appending {len(sources)} sources to {src_filename}.")
+            with pyfits.open(src_filename, mode='append') as f:
+                for hdu in hdus:
+                    f.append(hdu)
+                f.flush()
+        else:
+            mylog.info(f"Writing {len(sources)} sources to {src_filename}.")
+            pyfits.HDUList([pyfits.PrimaryHDU()]+hdus).writeto(src_filename)
+
+
+def _spectrum_table_hdu(sources, extver):
+    """
+    Make a SPECTRUM extension with one row for each of a list of 
+    :class:`~soxs.simput.SimputSpectrum` sources which share the same
+    energy bins.
+    """
+    emid = sources[0].spec.emid.value
+    nbins = emid.size
+    col1 = pyfits.Column(name='NAME', format='80A',
+                         array=[source.name for source in sources])
+    col2 = pyfits.Column(name='ENERGY', format=f'{nbins}E',
+                         array=np.tile(emid, (len(sources), 1)))
+    col3 = pyfits.Column(name='FLUXDENSITY', format=f'{nbins}D',
+                         array=[source.spec.flux.value for source in sources])
+    tbhdu = pyfits.BinTableHDU.from_columns([col1, col2, col3])
+    tbhdu.name = "SPECTRUM"
+    tbhdu.header["HDUCLASS"] = "HEASARC/SIMPUT"
+    tbhdu.header["HDUCLAS1"] = "SPECTRUM"
+    tbhdu.header["HDUVERS"] = "1.1.0"
+    tbhdu.header["TUNIT2"] = "keV"
+    tbhdu.header["TUNIT3"] = "photon/(cm**2*s*keV)"
+    tbhdu.header["EXTVER"] = extver
+    return tbhdu
+
 
 def _determine_extver(fn, extname):
     extver = 1
@@ -341,7 +640,7 @@ class SimputSource:
     def _get_source_hdu(self):
         return None, None
 
-    def _write_source(self, filename, extver, img_extver=None, overwrite=False):
+    def _make_table_hdu(self, extver):
         coldefs, header = self._get_source_hdu()
 
         tbhdu = pyfits.BinTableHDU.from_columns(coldefs)
@@ -357,6 +656,10 @@ class SimputSource:
         tbhdu.header.update(header)
 
         tbhdu.header["EXTVER"] = extver
+        return tbhdu
+
+    def _write_source(self, filename, extver, img_extver=None, overwrite=False):
+        tbhdu = self._make_table_hdu(extver)
         if self.imhdu is not None:
             self.imhdu.header["EXTVER"] = img_extver
 
@@ -463,12 +766,14 @@ class SimputSpectrum(SimputSource):
 class SimputPhotonList(SimputSource):
     src_type = "phlist"
 
-    def __init__(self, ra, dec, energy, flux, name=None):
+    def __init__(self, ra, dec, energy, flux, name=None, area=None):
         emin = np.asarray(energy).min()
         emax = np.asarray(energy).max()
         super(SimputPhotonList, self).__init__(
             emin, emax, flux, 0.0, 0.0, name=name)
         self.events = {"ra": ra, "dec": dec, "energy": energy}
+        if area is not None:
+            self.events["area"] = area
         self.num_events = energy.size
 
     def __getitem__(self, item):
@@ -483,7 +788,7 @@ class SimputPhotonList(SimputSource):
 
     @classmethod
     def from_models(cls, name, spectral_model, spatial_model,
-                    t_exp, area, prng=None):
+                    t_exp, area, prng=None, chunk_size=None, arf=None):
         """
         Generate a SIMPUT photon list from a spectral and a spatial
         model. 
@@ -508,13 +813,82 @@ class SimputPhotonList(SimputSource):
             be specified if you have a reason to generate the same 
             set of random numbers, such as for a test. Default is None, 
             which sets the seed based on the system time. 
+        chunk_size : integer, optional
+            If set, the energies and coordinates will be generated in
+            chunks of at most this many photons, which limits the 
+            memory used by temporary arrays for very large photon 
+            lists. Default: None, which generates them all at once.
+        arf : string, :class:`~soxs.response.AuxiliaryResponseFile`, or list of these, optional
+            If set, the photons are drawn with an energy-dependent 
+            effective area instead of a constant one, which in each 
+            energy bin of *spectral_model* is the largest of the 
+            effective areas of these ARFs (which may also be given by 
+            the names of instruments), scaled so that its maximum is 
+            *area*. This results in much smaller photon lists, since 
+            few photons are drawn at energies where the ARFs have 
+            little effective area. The effective area that each photon 
+            was drawn with is stored in its "area" field, so that the 
+            photon list can be used with any ARF. Default: None
         """
         prng = parse_prng(prng)
         t_exp = parse_value(t_exp, "s")
         area = parse_value(area, "cm**2")
-        e = spectral_model.generate_energies(t_exp, area, prng=prng)
-        ra, dec = spatial_model.generate_coords(e.size, prng=prng)
-        return cls(ra, dec, e, e.flux.value, name=name)
+        if arf is not None:
+            return cls._from_models_arf(name, spectral_model, spatial_model,
+                                        t_exp, area, arf, prng, chunk_size)
+        if chunk_size is None:
+            e = spectral_model.generate_energies(t_exp, area, prng=prng)
+            ra, dec = spatial_model.generate_coords(e.size, prng=prng)
+            return cls(ra, dec, e, e.flux.value, name=name)
+        energy = []
+        ra = []
+        dec = []
+        flux = 0.0
+        for e in spectral_model.generate_energy_chunks(t_exp, area, 
+                                                       chunk_size=chunk_size,
+                                                       prng=prng):
+            r, d = spatial_model.generate_coords(e.size, prng=prng)
+            energy.append(e.value)
+            ra.append(r.value)
+            dec.append(d.value)
+            flux += e.flux.value
+        energy = Quantity(np.concatenate(energy), "keV")
+        ra = Quantity(np.concatenate(ra), "deg")
+        dec = Quantity(np.concatenate(dec), "deg")
+        return cls(ra, dec, energy, flux, name=name)
+
+    @classmethod
+    def _from_models_arf(cls, name, spectral_model, spatial_model, t_exp, 
+                         area, arf, prng, chunk_size):
+        from soxs.constants import erg_per_keV
+        from soxs.response import _EnvelopeResponse
+        from soxs.spectra import ConvolvedSpectrum
+        env = _EnvelopeResponse(arf, spectral_model.ebins.value, area)
+        cspec = ConvolvedSpectrum.convolve(spectral_model, env)
+        if chunk_size is None:
+            chunks = [cspec.generate_energies(t_exp, prng=prng)]
+        else:
+            chunks = cspec.generate_energy_chunks(t_exp, chunk_size=chunk_size,
+                                                  prng=prng)
+        energy = []
+        ra = []
+        dec = []
+        ph_area = []
+        flux = 0.0
+        for e in chunks:
+            r, d = spatial_model.generate_coords(e.size, prng=prng)
+            a = env.bin_area(e.value)
+            energy.append(e.value)
+            ra.append(r.value)
+            dec.append(d.value)
+            ph_area.append(a)
+            # Each photon stands for 1/a photons per unit area
+            flux += np.sum(e.value/a)*erg_per_keV/t_exp
+        energy = Quantity(np.concatenate(energy), "keV")
+        ra = Quantity(np.concatenate(ra), "deg")
+        dec = Quantity(np.concatenate(dec), "deg")
+        ph_area = Quantity(np.concatenate(ph_area), "cm**2")
+        return cls(ra, dec, energy, flux, name=name, area=ph_area)
 
     def _get_source_hdu(self):
         col1 = pyfits.Column(name='ENERGY', format='E',
@@ -524,6 +898,9 @@ class SimputPhotonList(SimputSource):
         col3 = pyfits.Column(name='DEC', format='D',
                              array=np.asarray(self["dec"]))
         cols = [col1, col2, col3]
+        if "area" in self.events:
+            cols.append(pyfits.Column(name='AREA', format='E',
+                                      array=np.asarray(self["area"])))
 
         coldefs = pyfits.ColDefs(cols)
 
@@ -532,6 +909,8 @@ class SimputPhotonList(SimputSource):
                   "TUNIT1": "keV",
                   "TUNIT2": "deg",
                   "TUNIT3": "deg"}
+        if "area" in self.events:
+            header["TUNIT4"] = "cm**2"
 
         return coldefs, header
 
@@ -23,12 +23,45 @@ def construct_wcs(ra0, dec0, dtheta=None, nx=None):
     return w
 
 
+def _radial_cdf(func, r_max=3000.0, nodes=None, rtol=1.0e-6, 
+                max_iter=10):
+    # Build the cumulative distribution of radii for a surface 
+    # brightness profile func on an adaptive grid: start from a 
+    # logarithmic grid (plus any nodes where the profile is known 
+    # to change behavior) and split the bins where the trapezoidal 
+    # and Simpson estimates of the integral of func(r)*r disagree.
+    r = np.concatenate([[0.0], np.logspace(-2.0, np.log10(r_max), 1000)])
+    if nodes is not None:
+        nodes = np.asarray(nodes, dtype="float64")
+        r = np.union1d(r, nodes[(nodes > 0.0) & (nodes < r_max)])
+    for i in range(max_iter):
+        w = func(r)*r
+        rmid = 0.5*(r[1:]+r[:-1])
+        wmid = func(rmid)*rmid
+        dr = np.diff(r)
+        trap = 0.5*(w[1:]+w[:-1])*dr
+        simp = (w[1:]+4.0*wmid+w[:-1])*dr/6.0
+        refine = np.abs(trap-simp) > rtol*simp.sum()
+        # Only refine the grid if the integral will be computed 
+        # again on it, so that the CDF matches the radii
+        if not refine.any() or i == max_iter-1:
+            break
+        r = np.union1d(r, rmid[refine])
+    cdf = np.concatenate([[0.0], np.cumsum(simp)])
+    return r, cdf/cdf[-1]
+
+
+def _invert_cdf(r, cdf, u):
+    # Invert a piecewise-linear cumulative distribution, skipping 
+    # over bins where it is flat
+    idxs = np.clip(np.searchsorted(cdf, u), 1, cdf.size-1)
+    f = (u-cdf[idxs-1])/(cdf[idxs]-cdf[idxs-1])
+    return r[idxs-1]+f*(r[idxs]-r[idxs-1])
+
+
 def generate_radial_events(num_events, func, prng, ellipticity=1.0):
-    rbins = np.linspace(0.0, 3000.0, 100000)
-    rmid = 0.5*(rbins[1:]+rbins[:-1])
-    pdf = func(rmid)*rmid
-    pdf /= pdf.sum()
-    radius = prng.choice(rmid, size=num_events, p=pdf)
+    r, cdf = _radial_cdf(func)
+    radius = _invert_cdf(r, cdf, prng.uniform(size=num_events))
     theta = 2.*np.pi*prng.uniform(size=num_events)
     x = radius*np.cos(theta)
     y = radius*np.sin(theta)*ellipticity
@@ -51,6 +84,139 @@ def gen_img_coords(width, nx, theta):
     return coords
 
 
+def _beta_model_radii(r_c, beta, u, r_max=3000.0):
+    # Analytic inverse of the cumulative distribution of radii for
+    # a beta-model profile truncated at r_max, where each of the 
+    # uniform deviates in u may have its own r_c and beta. The 
+    # truncation matches the radial grid in generate_radial_events.
+    r_c, beta, u = np.broadcast_arrays(r_c, beta, u)
+    p = 1.5-3.0*beta
+    lxmax = np.log1p((r_max/r_c)**2)
+    log_case = np.abs(p) < 1.0e-8
+    ps = np.where(log_case, 1.0, p)
+    x2 = np.where(log_case, np.expm1(u*lxmax),
+                  np.expm1(np.log1p(u*np.expm1(ps*lxmax))/ps))
+    return r_c*np.sqrt(x2)
+
+
+def _pix2world(ra0, dec0, x, y):
+    # Equivalent to construct_wcs(ra0, dec0).wcs_pix2world(x, y, 1)
+    # for offsets x, y in arcseconds, but with a different tangent 
+    # point allowed for every position
+    xi = np.deg2rad(-x*one_arcsec)
+    eta = np.deg2rad(y*one_arcsec)
+    cosd0 = np.cos(np.deg2rad(dec0))
+    sind0 = np.sin(np.deg2rad(dec0))
+    denom = cosd0-eta*sind0
+    ra = ra0+np.rad2deg(np.arctan2(xi, denom))
+    dec = np.rad2deg(np.arctan2(sind0+eta*cosd0, np.hypot(xi, denom)))
+    return np.mod(ra, 360.0), dec
+
+
+def _generate_beta_model_coords(ra0, dec0, r_c, beta, ellipticity, 
+                                theta, prng):
+    # Positions for photons from many beta models at once, where
+    # every argument is an array with one value per photon
+    num_events = np.size(ra0)
+    radius = _beta_model_radii(r_c, beta, prng.uniform(size=num_events))
+    phi = 2.*np.pi*prng.uniform(size=num_events)
+    x = radius*np.cos(phi)
+    y = radius*np.sin(phi)*ellipticity
+    t = np.deg2rad(theta)
+    xx = x*np.cos(t)-y*np.sin(t)
+    yy = x*np.sin(t)+y*np.cos(t)
+    return _pix2world(ra0, dec0, xx, yy)
+
+
+def _parse_source_values(value, units, num_sources):
+    # Parameters which may be given as a scalar or with one 
+    # value per source, with or without units
+    if isinstance(value, u.Quantity):
+        value = value.to_value(units)
+    value = np.asarray(value, dtype="float64")
+    return np.broadcast_to(value, (num_sources,))
+
+
+def generate_point_source_coords(ra0, dec0, num_events):
+    """
+    Generate photon positions for many point sources at once.
+
+    Parameters
+    ----------
+    ra0 : array-like or :class:`~astropy.units.Quantity`
+        The RA of each source in degrees.
+    dec0 : array-like or :class:`~astropy.units.Quantity`
+        The Dec of each source in degrees.
+    num_events : array-like of integers
+        The number of events to generate for each source.
+
+    Returns
+    -------
+    The RA and Dec of the events in degrees, grouped by 
+    source in the order the sources were given.
+    """
+    num_events = np.asarray(num_events, dtype="int64")
+    ra0 = _parse_source_values(ra0, "deg", num_events.size)
+    dec0 = _parse_source_values(dec0, "deg", num_events.size)
+    ra = np.repeat(ra0, num_events)
+    dec = np.repeat(dec0, num_events)
+    return u.Quantity(ra, "deg"), u.Quantity(dec, "deg")
+
+
+def generate_beta_model_coords(ra0, dec0, r_c, beta, num_events, 
+                               ellipticity=1.0, theta=0.0, prng=None):
+    """
+    Generate photon positions for many beta-model sources at 
+    once. This is equivalent to creating a 
+    :class:`~soxs.spatial.BetaModel` for each source and calling
+    its ``generate_coords`` method, but the radii for all of the
+    sources are drawn and projected onto the sky together. 
+
+    Parameters
+    ----------
+    ra0 : array-like or :class:`~astropy.units.Quantity`
+        The center RA of each source in degrees.
+    dec0 : array-like or :class:`~astropy.units.Quantity`
+        The center Dec of each source in degrees.
+    r_c : float, array-like, or :class:`~astropy.units.Quantity`
+        The core radius of each profile in arcseconds.
+    beta : float or array-like
+        The "beta" parameter of each profile.
+    num_events : array-like of integers
+        The number of events to generate for each source.
+    ellipticity : float or array-like, optional
+        The ellipticity of each profile, expressed as the 
+        ratio between the length scales of the x and y 
+        coordinates, as in :class:`~soxs.spatial.BetaModel`. 
+        Default: 1.0
+    theta : float, array-like, or :class:`~astropy.units.Quantity`, optional
+        The angle through which to rotate each profile in 
+        degrees. Default: 0.0
+    prng : :class:`~numpy.random.RandomState` object, integer, or None
+        A pseudo-random number generator. Typically will only
+        be specified if you have a reason to generate the same
+        set of random numbers, such as for a test. Default is None,
+        which sets the seed based on the system time.
+
+    Returns
+    -------
+    The RA and Dec of the events in degrees, grouped by 
+    source in the order the sources were given.
+    """
+    prng = parse_prng(prng)
+    num_events = np.asarray(num_events, dtype="int64")
+    num_sources = num_events.size
+    params = [_parse_source_values(ra0, "deg", num_sources),
+              _parse_source_values(dec0, "deg", num_sources),
+              _parse_source_values(r_c, "arcsec", num_sources),
+              _parse_source_values(beta, "", num_sources),
+              _parse_source_values(ellipticity, "", num_sources),
+              _parse_source_values(theta, "deg", num_sources)]
+    params = [np.repeat(param, num_events) for param in params]
+    ra, dec = _generate_beta_model_coords(*params, prng)
+    return u.Quantity(ra, "deg"), u.Quantity(dec, "deg")
+
+
 class SpatialModel:
     def __init__(self, ra0, dec0):
         self.ra0 = parse_value(ra0, "deg")
@@ -163,10 +329,23 @@ class RadialFunctionModel(SpatialModel):
         self.theta = parse_value(theta, "deg")
         self.func = func
         self.ellipticity = ellipticity
+        self._cdf = None
+
+    def _radial_nodes(self):
+        return None
+
+    def _sample_radii(self, num_events, prng):
+        # The inverse CDF is built the first time it is needed and
+        # reused for every subsequent set of coordinates
+        if self._cdf is None:
+            self._cdf = _radial_cdf(self.func, nodes=self._radial_nodes())
+        return _invert_cdf(*self._cdf, prng.uniform(size=num_events))
 
     def _generate_coords(self, num_events, prng):
-        x, y = generate_radial_events(num_events, self.func, prng,
-                                      ellipticity=self.ellipticity)
+        radius = self._sample_radii(num_events, prng)
+        phi = 2.*np.pi*prng.uniform(size=num_events)
+        x = radius*np.cos(phi)
+        y = radius*np.sin(phi)*self.ellipticity
         coords = rotate_xy(self.theta, x, y)
         return coords[0,:], coords[1,:]
 
@@ -208,6 +387,11 @@ class RadialArrayModel(RadialFunctionModel):
         func = lambda rr: np.interp(rr, r, S_r, left=0.0, right=0.0)
         super(RadialArrayModel, self).__init__(ra0, dec0, func, theta=theta, 
                                                ellipticity=ellipticity)
+        self._nodes = np.asarray(r)
+
+    def _radial_nodes(self):
+        # The profile is piecewise-linear between the tabulated radii
+        return self._nodes
 
 
 class RadialFileModel(RadialArrayModel):
@@ -275,6 +459,12 @@ class BetaModel(RadialFunctionModel):
         func = lambda r: (1.0+(r/r_c)**2)**(-3*beta+0.5)
         super(BetaModel, self).__init__(ra0, dec0, func, theta=theta, 
                                         ellipticity=ellipticity)
+        self.r_c = r_c
+        self.beta = beta
+
+    def _sample_radii(self, num_events, prng):
+        return _beta_model_radii(self.r_c, self.beta, 
+                                 prng.uniform(size=num_events))
 
 
 class DoubleBetaModel(RadialFunctionModel):
@@ -358,6 +548,16 @@ class AnnulusModel(RadialFunctionModel):
         super(AnnulusModel, self).__init__(ra0, dec0, func, 
                                            theta=theta,
                                            ellipticity=ellipticity)
+        self.r_in = r_in
+        self.r_out = r_out
+
+    def _sample_radii(self, num_events, prng):
+        # Uniform in area between r_in and r_out, truncated at the 
+        # same maximum radius as the other radial models
+        r_in = min(self.r_in, 3000.0)
+        r_out = min(self.r_out, 3000.0)
+        u = prng.uniform(size=num_events)
+        return np.sqrt(r_in**2+u*(r_out**2-r_in**2))
 
 
 class RectangleModel(SpatialModel):
@@ -1,19 +1,21 @@
 import numpy as np
+from functools import lru_cache
 import subprocess
 import tempfile
-import shutil
+import hashlib
 import os
-from soxs.utils import soxs_files_path, mylog, \
+from soxs.utils import mylog, \
     parse_prng, parse_value, soxs_cfg, line_width_equiv, \
     DummyPbar, get_data_file
 from soxs.lib.broaden_lines import broaden_lines
+from soxs.absorption import get_absorb, wabs_cross_section, \
+    tbabs_cross_section, get_wabs_absorb, get_tbabs_absorb
 from soxs.constants import erg_per_keV, hc, \
     cosmic_elem, metal_elem, atomic_weights, clight, \
     m_u, elem_names, sigma_to_fwhm, abund_tables, sqrt2pi
 import astropy.io.fits as pyfits
 import astropy.units as u
 import h5py
-from scipy.interpolate import InterpolatedUnivariateSpline
 from astropy.modeling.functional_models import \
     Gaussian1D
 from tqdm.auto import tqdm
@@ -21,47 +23,248 @@ from tqdm.auto import tqdm
 
 class Energies(u.Quantity):
     def __new__(cls, energy, flux):
-        ret = u.Quantity.__new__(cls, energy, unit="keV")
+        ret = u.Quantity.__new__(cls, energy, unit="keV", copy=False)
         ret.flux = u.Quantity(flux, "erg/(cm**2*s)")
         return ret
 
 
-def _generate_energies(spec, t_exp, rate, prng, quiet=False):
-    cumspec = spec.cumspec
-    n_ph = prng.poisson(t_exp*rate)
+def _sample_in_bins(elo, de, counts, prng, ordered=False):
+    # Given the number of photons in each bin, place them uniformly
+    # within the bins. This is O(n_ph), and the result is grouped
+    # by bin in the order of the bins, but not sorted within each 
+    # bin unless ordered=True.
+    idxs = np.repeat(np.arange(counts.size), counts.ravel())
+    e = elo[idxs]
+    e += prng.uniform(size=idxs.size)*de[idxs]
+    if ordered:
+        e.sort()
+    return e
+
+
+def _bin_counts(spec, t_exp, rate, prng):
+    # A Poisson draw of the total number of photons followed by a 
+    # multinomial draw of the photons in each bin is equivalent to 
+    # independent Poisson draws in each bin
+    lam = t_exp*rate*np.diff(spec.cumspec)
+    return prng.poisson(lam=lam)
+
+
+def _energy_chunks(spec, counts, chunk_size, prng, ordered=False):
+    # Split the photons given by the bin counts into consecutive 
+    # chunks of chunk_size photons, and only generate the energies
+    # of the bins which overlap each chunk
+    cumcounts = np.cumsum(counts)
+    lo = cumcounts-counts
+    n_ph = cumcounts[-1]
+    for start in range(0, n_ph, chunk_size):
+        stop = min(start+chunk_size, n_ph)
+        b0 = np.searchsorted(cumcounts, start, side="right")
+        b1 = np.searchsorted(cumcounts, stop, side="left")+1
+        c = np.minimum(cumcounts[b0:b1], stop)-np.maximum(lo[b0:b1], start)
+        yield _sample_in_bins(spec._ebins[b0:b1], spec._de[b0:b1], c, prng,
+                              ordered=ordered)
+
+
+def _generate_energies(spec, t_exp, rate, prng, quiet=False, ordered=False):
+    counts = _bin_counts(spec, t_exp, rate, prng)
     if not quiet:
-        mylog.info("Creating %d energies from this spectrum." % n_ph)
-    randvec = prng.uniform(size=n_ph)
-    randvec.sort()
-    e = np.interp(randvec, cumspec, spec.ebins.value)
+        mylog.info("Creating %d energies from this spectrum." % counts.sum())
+    e = _sample_in_bins(spec._ebins[:-1], spec._de, counts, prng,
+                        ordered=ordered)
     if not quiet:
         mylog.info("Finished creating energies.")
     return e
 
 
+def _to_float_array(x, units):
+    # Always returns a copy, so that in-place operations on a
+    # spectrum never touch the array it was created from
+    if hasattr(x, "to_astropy"):
+        x = x.to_astropy()
+    if isinstance(x, u.Quantity):
+        x = x.to_value(units)
+    return np.array(x, dtype="float64")
+
+
+@lru_cache(maxsize=None)
+def _integrated_units(units):
+    pflux_units = u.Unit(units)*u.keV
+    return pflux_units, pflux_units*u.erg/u.photon
+
+
+def _xspec_cache_dir():
+    cache_dir = soxs_cfg.get("soxs", "xspec_cache_dir", fallback=None)
+    if cache_dir is None:
+        cache_dir = os.path.join(soxs_cfg.get("soxs", "soxs_data_dir"),
+                                 "xspec_cache")
+    return cache_dir
+
+
+def _xspec_cache_key(xspec_in, rsp_line):
+    # The key is the hash of everything that is sent to XSPEC
+    # to define the model, plus the energy grid
+    hasher = hashlib.sha256()
+    for line in xspec_in:
+        hasher.update(line.strip().encode("utf-8"))
+        hasher.update(b"\n")
+    hasher.update(rsp_line.encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def _read_xspec_cache(key):
+    fn = os.path.join(_xspec_cache_dir(), f"{key}.h5")
+    if not os.path.exists(fn):
+        return None
+    try:
+        with h5py.File(fn, "r") as f:
+            ebins = f["ebins"][()]
+            flux = f["flux"][()]
+    except (OSError, KeyError):
+        mylog.warning(f"Could not read the XSPEC cache file {fn}, "
+                      f"so it will be regenerated.")
+        return None
+    return ebins, flux
+
+
+def _write_xspec_cache(key, ebins, flux):
+    cache_dir = _xspec_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file in the same directory and then
+    # move it into place, so that other processes never see a 
+    # partially written file
+    fd, tmpfn = tempfile.mkstemp(suffix=".h5", dir=cache_dir)
+    os.close(fd)
+    try:
+        with h5py.File(tmpfn, "w") as f:
+            f.create_dataset("ebins", data=ebins)
+            f.create_dataset("flux", data=flux)
+        os.replace(tmpfn, os.path.join(cache_dir, f"{key}.h5"))
+    finally:
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
+
+
+def _run_xspec(xspec_ins, rsp_line):
+    # Evaluate one or more models in a single XSPEC session, 
+    # run inside a temporary directory so that the current
+    # working directory is never changed
+    script = []
+    for i, xspec_in in enumerate(xspec_ins):
+        script += list(xspec_in)
+        script += [rsp_line,
+                   f"set fp [open spec_{i}.xspec w+]\n",
+                   "tclout energies\n", "puts $fp $xspec_tclout\n",
+                   "tclout modval\n", "puts $fp $xspec_tclout\n",
+                   "close $fp\n"]
+    script.append("quit\n")
+    logfile = os.path.join(os.getcwd(), "xspec.log")
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, "xspec.in"), "w") as f_xin:
+            f_xin.writelines(script)
+        with open(logfile, "ab") as xsout:
+            subprocess.call(["xspec", "-", "xspec.in"], cwd=tmpdir,
+                            stdout=xsout, stderr=xsout)
+        for i in range(len(xspec_ins)):
+            fn = os.path.join(tmpdir, f"spec_{i}.xspec")
+            if not os.path.exists(fn):
+                raise RuntimeError(f"XSPEC did not produce a spectrum! "
+                                   f"Check {logfile} for details.")
+            with open(fn, "r") as f_s:
+                lines = f_s.readlines()
+            ebins = np.array(lines[0].split()).astype("float64")
+            de = np.diff(ebins)
+            flux = np.array(lines[1].split()).astype("float64")/de
+            results.append((ebins, flux))
+    return results
+
+
 class Spectrum:
     _units = "photon/(cm**2*s*keV)"
 
     def __init__(self, ebins, flux):
-        self.ebins = u.Quantity(ebins, "keV")
-        self.emid = 0.5*(self.ebins[1:]+self.ebins[:-1])
-        self.flux = u.Quantity(flux, self._units)
-        self.nbins = len(self.emid)
-        self.de = np.diff(self.ebins)
-        self._compute_total_flux()
-
-    def _compute_total_flux(self):
-        self.total_flux = (self.flux*self.de).sum()
-        self.total_energy_flux = (self.flux*self.emid.to("erg")*self.de).sum()/(1.0*u.photon)
-        cumspec = np.cumsum((self.flux*self.de).value)
-        cumspec = np.insert(cumspec, 0, 0.0)
-        cumspec /= cumspec[-1]
-        self.cumspec = cumspec
-        self.func = lambda e: np.interp(e, self.emid.value, self.flux.value)
+        self._ebins = _to_float_array(ebins, "keV")
+        self._emid = 0.5*(self._ebins[1:]+self._ebins[:-1])
+        self._de = np.diff(self._ebins)
+        self._flux = _to_float_array(flux, self._units)
+        self.nbins = self._emid.size
+        self._cache = {}
+
+    # The spectrum is stored as unitless float64 arrays, with the
+    # astropy Quantity attributes being views of them. Derived
+    # quantities are computed when they are first needed, and
+    # any method which modifies the flux must call _invalidate.
+
+    def _invalidate(self):
+        self._cache.clear()
+
+    @property
+    def ebins(self):
+        return u.Quantity(self._ebins, "keV", copy=False)
+
+    @property
+    def emid(self):
+        return u.Quantity(self._emid, "keV", copy=False)
+
+    @property
+    def de(self):
+        return u.Quantity(self._de, "keV", copy=False)
+
+    @property
+    def flux(self):
+        return u.Quantity(self._flux, self._units, copy=False)
+
+    @flux.setter
+    def flux(self, value):
+        value = _to_float_array(value, self._units)
+        if value.shape != self._emid.shape:
+            raise RuntimeError("The shape of the flux array is not consistent "
+                               "with the energy binning!")
+        self._flux = value
+        self._invalidate()
+
+    def _get_band_flux(self, idxs=None):
+        if "pflux" not in self._cache:
+            self._cache["pflux"] = self._flux*self._de
+            self._cache["eflux"] = self._cache["pflux"]*self._emid*erg_per_keV
+        pflux = self._cache["pflux"]
+        eflux = self._cache["eflux"]
+        if idxs is not None:
+            pflux = pflux[idxs]
+            eflux = eflux[idxs]
+        return pflux.sum(), eflux.sum()
+
+    @property
+    def total_flux(self):
+        if "total_flux" not in self._cache:
+            pflux_units = _integrated_units(self._units)[0]
+            self._cache["total_flux"] = u.Quantity(self._get_band_flux()[0],
+                                                   pflux_units)
+        return self._cache["total_flux"]
+
+    @property
+    def total_energy_flux(self):
+        if "total_energy_flux" not in self._cache:
+            eflux_units = _integrated_units(self._units)[1]
+            self._cache["total_energy_flux"] = u.Quantity(self._get_band_flux()[1],
+                                                          eflux_units)
+        return self._cache["total_energy_flux"]
+
+    @property
+    def cumspec(self):
+        if "cumspec" not in self._cache:
+            cumspec = np.cumsum(self._flux*self._de)
+            cumspec = np.insert(cumspec, 0, 0.0)
+            cumspec /= cumspec[-1]
+            self._cache["cumspec"] = cumspec
+        return self._cache["cumspec"]
+
+    def func(self, e):
+        return np.interp(e, self._emid, self._flux)
 
     def _check_binning_units(self, other):
         if self.nbins != other.nbins or \
-                not np.isclose(self.ebins.value, other.ebins.value).all():
+                not np.isclose(self._ebins, other._ebins).all():
             raise RuntimeError("Energy binning for these two "
                                "spectra is not the same!!")
         if self._units != other._units:
@@ -70,22 +273,22 @@ class Spectrum:
 
     def __add__(self, other):
         self._check_binning_units(other)
-        return Spectrum(self.ebins, self.flux+other.flux)
+        return Spectrum(self._ebins, self._flux+other._flux)
 
     def __sub__(self, other):
         self._check_binning_units(other)
-        return Spectrum(self.ebins, self.flux-other.flux)
+        return Spectrum(self._ebins, self._flux-other._flux)
 
     def __mul__(self, other):
         if hasattr(other, "eff_area"):
             return ConvolvedSpectrum.convolve(self, other)
         else:
-            return Spectrum(self.ebins, other*self.flux)
+            return Spectrum(self._ebins, other*self._flux)
 
     __rmul__ = __mul__
 
     def __truediv__(self, other):
-        return Spectrum(self.ebins, self.flux/other)
+        return Spectrum(self._ebins, self._flux/other)
 
     __div__ = __truediv__
 
@@ -121,13 +324,13 @@ class Spectrum:
         """
         emin = parse_value(emin, "keV")
         emax = parse_value(emax, "keV")
-        range = np.logical_and(self.emid.value >= emin, self.emid.value <= emax)
-        pflux = (self.flux*self.de)[range].sum()
-        eflux = (self.flux*self.emid.to("erg")*self.de)[range].sum()/(1.0*u.photon)
-        return pflux, eflux
+        range = np.logical_and(self._emid >= emin, self._emid <= emax)
+        pflux_units, eflux_units = _integrated_units(self._units)
+        pflux, eflux = self._get_band_flux(range)
+        return u.Quantity(pflux, pflux_units), u.Quantity(eflux, eflux_units)
 
     @classmethod
-    def from_xspec_script(cls, infile, emin, emax, nbins):
+    def from_xspec_script(cls, infile, emin, emax, nbins, use_cache=True):
         """
         Create a model spectrum using a script file as 
         input to XSPEC.
@@ -142,14 +345,20 @@ class Spectrum:
             The maximum energy of the spectrum in keV. 
         nbins : integer
             The number of bins in the spectrum.
+        use_cache : boolean, optional
+            If True, look up the spectrum in the on-disk XSPEC cache 
+            before running XSPEC, and store it there afterward. 
+            Default: True
         """
         f = open(infile, "r")
         xspec_in = f.readlines()
         f.close()
-        return cls._from_xspec(xspec_in, emin, emax, nbins)
+        return cls._from_xspec([xspec_in], emin, emax, nbins,
+                               use_cache=use_cache)[0]
 
     @classmethod
-    def from_xspec_model(cls, model_string, params, emin, emax, nbins):
+    def from_xspec_model(cls, model_string, params, emin, emax, nbins,
+                         use_cache=True):
         """
         Create a model spectrum using a model string and parameters
         as input to XSPEC.
@@ -168,43 +377,75 @@ class Spectrum:
             The maximum energy of the spectrum in keV
         nbins : integer
             The number of bins in the spectrum.
+        use_cache : boolean, optional
+            If True, look up the spectrum in the on-disk XSPEC cache 
+            before running XSPEC, and store it there afterward. 
+            Default: True
         """
-        xspec_in = []
-        model_str = "%s &" % model_string
-        for param in params:
-            model_str += " %g &" % param
-        model_str += " /*"
-        xspec_in.append("model %s\n" % model_str)
-        return cls._from_xspec(xspec_in, emin, emax, nbins)
+        return cls.from_xspec_models(model_string, [params], emin, emax,
+                                     nbins, use_cache=use_cache)[0]
 
     @classmethod
-    def _from_xspec(cls, xspec_in, emin, emax, nbins):
+    def from_xspec_models(cls, model_string, params_list, emin, emax,
+                          nbins, use_cache=True):
+        """
+        Create a list of model spectra from a single model string and 
+        a number of different parameter sets, evaluating all of the 
+        models which are not in the cache in a single XSPEC session.
+
+        Parameters
+        ----------
+        model_string : string
+            The model to create the spectra from. Use standard XSPEC
+            model syntax. Example: "wabs*mekal"
+        params_list : list of lists
+            The parameters for each spectrum. Each must be in the 
+            order that XSPEC expects.
+        emin : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`
+            The minimum energy of the spectra in keV
+        emax : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`
+            The maximum energy of the spectra in keV
+        nbins : integer
+            The number of bins in the spectra.
+        use_cache : boolean, optional
+            If True, look up the spectra in the on-disk XSPEC cache 
+            before running XSPEC, and store them there afterward. 
+            Default: True
+
+        Returns
+        -------
+        A list of :class:`~soxs.spectra.Spectrum` objects, one for 
+        each parameter set. 
+        """
+        xspec_ins = []
+        for params in params_list:
+            model_str = "%s &" % model_string
+            for param in params:
+                model_str += " %g &" % param
+            model_str += " /*"
+            xspec_ins.append(["model %s\n" % model_str])
+        return cls._from_xspec(xspec_ins, emin, emax, nbins,
+                               use_cache=use_cache)
+
+    @classmethod
+    def _from_xspec(cls, xspec_ins, emin, emax, nbins, use_cache=True):
         emin = parse_value(emin, "keV")
         emax = parse_value(emax, "keV")
-        tmpdir = tempfile.mkdtemp()
-        curdir = os.getcwd()
-        os.chdir(tmpdir)
-        xspec_in.append("dummyrsp %g %g %d lin\n" % (emin, emax, nbins))
-        xspec_in += ["set fp [open spec_therm.xspec w+]\n",
-                     "tclout energies\n", "puts $fp $xspec_tclout\n",
-                     "tclout modval\n", "puts $fp $xspec_tclout\n",
-                     "close $fp\n", "quit\n"]
-        f_xin = open("xspec.in", "w")
-        f_xin.writelines(xspec_in)
-        f_xin.close()
-        logfile = os.path.join(curdir, "xspec.log")
-        with open(logfile, "ab") as xsout:
-            subprocess.call(["xspec", "-", "xspec.in"],
-                            stdout=xsout, stderr=xsout)
-        f_s = open("spec_therm.xspec", "r")
-        lines = f_s.readlines()
-        f_s.close()
-        ebins = np.array(lines[0].split()).astype("float64")
-        de = np.diff(ebins)
-        flux = np.array(lines[1].split()).astype("float64")/de
-        os.chdir(curdir)
-        shutil.rmtree(tmpdir)
-        return cls(ebins, flux)
+        rsp_line = "dummyrsp %g %g %d lin\n" % (emin, emax, nbins)
+        keys = [_xspec_cache_key(xspec_in, rsp_line) 
+                for xspec_in in xspec_ins]
+        spectra = [None]*len(xspec_ins)
+        if use_cache:
+            for i, key in enumerate(keys):
+                spectra[i] = _read_xspec_cache(key)
+        to_run = [i for i, spec in enumerate(spectra) if spec is None]
+        if len(to_run) > 0:
+            results = _run_xspec([xspec_ins[i] for i in to_run], rsp_line)
+            for i, (ebins, flux) in zip(to_run, results):
+                if use_cache:
+                    _write_xspec_cache(keys[i], ebins, flux)
+                spectra[i] = (ebins, flux)
+        return [cls(ebins, flux) for ebins, flux in spectra]
 
     @classmethod
     def from_powerlaw(cls, photon_index, redshift, norm, emin, emax,
@@ -297,11 +538,11 @@ class Spectrum:
     def _new_spec_from_band(self, emin, emax):
         emin = parse_value(emin, "keV")
         emax = parse_value(emax, 'keV')
-        band = np.logical_and(self.ebins.value >= emin,
-                              self.ebins.value <= emax)
+        band = np.logical_and(self._ebins >= emin,
+                              self._ebins <= emax)
         idxs = np.where(band)[0]
-        ebins = self.ebins.value[idxs]
-        flux = self.flux.value[idxs[:-1]]
+        ebins = self._ebins[idxs]
+        flux = self._flux[idxs[:-1]]
         return ebins, flux
 
     def new_spec_from_band(self, emin, emax):
@@ -343,18 +584,18 @@ class Spectrum:
                 "energy": erg/s/cm**2
         """
         if emin is None:
-            emin = self.ebins[0].value
+            emin = self._ebins[0]
         if emax is None:
-            emax = self.ebins[-1].value
+            emax = self._ebins[-1]
         emin = parse_value(emin, "keV")
         emax = parse_value(emax, 'keV')
-        idxs = np.logical_and(self.emid.value >= emin, self.emid.value <= emax)
+        idxs = np.logical_and(self._emid >= emin, self._emid <= emax)
         if flux_type == "photons":
-            f = (self.flux*self.de)[idxs].sum()
+            f = self._get_band_flux(idxs)[0]
         elif flux_type == "energy":
-            f = (self.flux*self.emid.to("erg")*self.de)[idxs].sum()
-        self.flux *= new_flux/f.value
-        self._compute_total_flux()
+            f = self._get_band_flux(idxs)[1]
+        self._flux *= new_flux/f
+        self._invalidate()
 
     def write_file(self, specfile, overwrite=False):
         """
@@ -371,7 +612,7 @@ class Spectrum:
         if os.path.exists(specfile) and not overwrite:
             raise IOError(f"File {specfile} exists and overwrite=False!")
         header = f"Energy\tFlux\nkeV\t{self._units}"
-        np.savetxt(specfile, np.transpose([self.emid, self.flux]), 
+        np.savetxt(specfile, np.transpose([self._emid, self._flux]), 
                    delimiter="\t", header=header)
 
     def write_h5_file(self, specfile, overwrite=False):
@@ -389,9 +630,9 @@ class Spectrum:
         if os.path.exists(specfile) and not overwrite:
             raise IOError("File %s exists and overwrite=False!" % specfile)
         f = h5py.File(specfile, "w")
-        f.create_dataset("emin", data=self.ebins[0].value)
-        f.create_dataset("emax", data=self.ebins[-1].value)
-        f.create_dataset("spectrum", data=self.flux.value)
+        f.create_dataset("emin", data=self._ebins[0])
+        f.create_dataset("emax", data=self._ebins[-1])
+        f.create_dataset("spectrum", data=self._flux)
         f.close()
 
     def apply_foreground_absorption(self, nH, model="wabs", redshift=0.0):
@@ -412,13 +653,9 @@ class Spectrum:
             The redshift of the absorbing material. Default: 0.0
         """
         nH = parse_value(nH, "1.0e22*cm**-2")
-        e = self.emid.value*(1.0+redshift)
-        if model == "wabs":
-            sigma = wabs_cross_section(e)
-        elif model == "tbabs":
-            sigma = tbabs_cross_section(e)
-        self.flux *= np.exp(-nH*1.0e22*sigma)
-        self._compute_total_flux()
+        self._flux *= get_absorb(self._emid, nH, model=model, 
+                                 redshift=redshift, cache=True)
+        self._invalidate()
 
     def add_emission_line(self, line_center, line_width, line_amp,
                           line_type="gaussian"):
@@ -449,8 +686,8 @@ class Spectrum:
         else:
             raise NotImplementedError("Line profile type '%s' " % line_type +
                                       "not implemented!")
-        self.flux += u.Quantity(f(self.emid.value), self._units)
-        self._compute_total_flux()
+        self._flux += f(self._emid)
+        self._invalidate()
 
     def add_absorption_line(self, line_center, line_width, equiv_width, 
                             line_type='gaussian'):
@@ -483,10 +720,11 @@ class Spectrum:
         else:
             raise NotImplementedError("Line profile type '%s' " % line_type +
                                       "not implemented!")
-        self.flux *= np.exp(-f(self.emid.value))
-        self._compute_total_flux()
+        self._flux *= np.exp(-f(self._emid))
+        self._invalidate()
 
-    def generate_energies(self, t_exp, area, prng=None, quiet=False):
+    def generate_energies(self, t_exp, area, prng=None, quiet=False,
+                          ordered=False):
         """
         Generate photon energies from this spectrum 
         given an exposure time and effective area.
@@ -509,16 +747,76 @@ class Spectrum:
             If True, log messages will not be displayed when 
             creating energies. Useful if you have to loop over 
             a lot of spectra. Default: False
+        ordered : boolean, optional
+            If True, the energies will be returned sorted in 
+            increasing order. Otherwise, they are grouped by 
+            energy bin but not sorted within each bin, which is 
+            faster. Default: False
         """
         t_exp = parse_value(t_exp, "s")
         area = parse_value(area, "cm**2")
         prng = parse_prng(prng)
         rate = area*self.total_flux.value
-        energy = _generate_energies(self, t_exp, rate, prng, quiet=quiet)
+        energy = _generate_energies(self, t_exp, rate, prng, quiet=quiet,
+                                    ordered=ordered)
         flux = np.sum(energy)*erg_per_keV/t_exp/area
         energies = Energies(energy, flux)
         return energies
 
+    def generate_energy_chunks(self, t_exp, area, chunk_size=1000000, 
+                               prng=None, quiet=False, ordered=False):
+        """
+        Generate photon energies from this spectrum given an
+        exposure time and effective area, in chunks of at most
+        *chunk_size* energies. This is a generator, which allows
+        very large numbers of photons to be processed with bounded
+        memory. The total number of photons is drawn from the same
+        Poisson distribution as in :meth:`generate_energies`, and 
+        the chunks are in order of increasing energy bin. 
+
+        Parameters
+        ----------
+        t_exp : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`
+            The exposure time in seconds.
+        area : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`
+            The effective area in cm**2.
+        chunk_size : integer, optional
+            The maximum number of energies in each chunk. 
+            Default: 1000000
+        prng : :class:`~numpy.random.RandomState` object, integer, or None
+            A pseudo-random number generator. Typically will only 
+            be specified if you have a reason to generate the same 
+            set of random numbers, such as for a test. Default is None, 
+            which sets the seed based on the system time. 
+        quiet : boolean, optional
+            If True, log messages will not be displayed when 
+            creating energies. Default: False
+        ordered : boolean, optional
+            If True, the energies in each chunk will be sorted in
+            increasing order. Otherwise, they are grouped by energy
+            bin but not sorted within each bin, which is faster. 
+            Default: False
+
+        Returns
+        -------
+        A generator of :class:`~soxs.spectra.Energies` objects. The
+        flux of each chunk is the contribution of its photons to
+        the total flux, so the fluxes of all of the chunks sum to 
+        the flux of the whole sample.
+        """
+        t_exp = parse_value(t_exp, "s")
+        area = parse_value(area, "cm**2")
+        prng = parse_prng(prng)
+        rate = area*self.total_flux.value
+        counts = _bin_counts(self, t_exp, rate, prng)
+        if not quiet:
+            mylog.info(f"Creating {counts.sum()} energies from this spectrum "
+                       f"in chunks of {chunk_size}.")
+        for energy in _energy_chunks(self, counts, chunk_size, prng,
+                                     ordered=ordered):
+            flux = np.sum(energy)*erg_per_keV/t_exp/area
+            yield Energies(energy, flux)
+
     def plot(self, lw=2, xmin=None, xmax=None, ymin=None, ymax=None,
              xscale=None, yscale=None, label=None, fontsize=18, 
              fig=None, ax=None, **kwargs):
@@ -742,6 +1040,22 @@ class ApecGenerator:
             self.atable = abund_tables[abund_table].copy()
         self._atable = self.atable.copy()
         self._atable[1:] /= abund_tables["angr"][1:]
+        self._tables = {}
+
+    def __getstate__(self):
+        # The FITS handles and any precomputed tables are not
+        # shipped when this object is pickled (e.g. to worker
+        # processes), the files are reopened on the other side
+        state = self.__dict__.copy()
+        del state["line_handle"]
+        del state["coco_handle"]
+        state["_tables"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.line_handle = pyfits.open(self.linefile)
+        self.coco_handle = pyfits.open(self.cocofile)
 
     def _make_spectrum(self, kT, element, ion, velocity, line_fields,
                        coco_fields, scale_factor):
@@ -804,6 +1118,11 @@ class ApecGenerator:
         return line_fields, coco_fields
 
     def _get_table(self, indices, redshift, velocity):
+        if (redshift, velocity) in self._tables:
+            cspec, mspec, vspec = self._tables[redshift, velocity]
+            if vspec is not None:
+                vspec = vspec[:, indices, :]
+            return cspec[indices, :], mspec[indices, :], vspec
         numi = len(indices)
         scale_factor = 1./(1.+redshift)
         cspec = np.zeros((numi, self.nbins))
@@ -840,6 +1159,126 @@ class ApecGenerator:
         pbar.close()
         return cspec, mspec, vspec
 
+    def make_table(self, redshift=0.0, velocity=0.0, nproc=None,
+                   filename=None, overwrite=False):
+        """
+        Compute the table of spectra for all of the temperatures
+        in the APEC tables at a given redshift and velocity
+        broadening, optionally spreading the temperatures over a
+        pool of processes. The table is stored in this object, and
+        subsequent calls to :meth:`get_spectrum` or
+        :meth:`get_nei_spectrum` with the same redshift and velocity
+        will use it instead of reading the APEC tables again.
+
+        Parameters
+        ----------
+        redshift : float, optional
+            The redshift. Default: 0.0
+        velocity : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`, optional
+            The velocity broadening parameter, in units of
+            km/s. Default: 0.0
+        nproc : integer, optional
+            The number of processes to use. Default is to use
+            all of the available CPUs.
+        filename : string, optional
+            If set, the table will also be written to this
+            HDF5 file, which can be reloaded later using
+            :meth:`read_table`. Default: None
+        overwrite : boolean, optional
+            Whether or not to overwrite an existing file with
+            the same name. Default: False
+
+        Returns
+        -------
+        A tuple of three arrays: the spectra of the H, He, and trace
+        elements with shape (nT, nbins), the spectra of the metals
+        with shape (nT, nbins), and the spectra of the variable
+        elements with shape (num_var_elem, nT, nbins), or None if
+        there are no variable elements.
+        """
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        if filename is not None and os.path.exists(filename) and not overwrite:
+            raise IOError(f"File {filename} exists and overwrite=False!")
+        velocity = parse_value(velocity, "km/s")
+        v = velocity*1.0e5
+        if nproc is None:
+            nproc = os.cpu_count()
+        if nproc == 1:
+            table = self._get_table(np.arange(self.nT), redshift, v)
+        else:
+            cspec = np.zeros((self.nT, self.nbins))
+            mspec = np.zeros((self.nT, self.nbins))
+            vspec = None
+            if self.num_var_elem > 0:
+                vspec = np.zeros((self.num_var_elem, self.nT, self.nbins))
+            mylog.info(f"Computing the spectrum table using {nproc} processes.")
+            pbar = tqdm(leave=True, total=self.nT, desc="Preparing spectrum table ")
+            with ProcessPoolExecutor(max_workers=nproc, 
+                                     initializer=_init_apec_worker,
+                                     initargs=(self,)) as executor:
+                futures = [executor.submit(_apec_table_worker, ikT, redshift, v)
+                           for ikT in range(self.nT)]
+                for future in as_completed(futures):
+                    ikT, (c, m, var) = future.result()
+                    cspec[ikT, :] = c[0, :]
+                    mspec[ikT, :] = m[0, :]
+                    if vspec is not None:
+                        vspec[:, ikT, :] = var[:, 0, :]
+                    pbar.update()
+            pbar.close()
+            table = (cspec, mspec, vspec)
+        self._tables[redshift, v] = table
+        if filename is not None:
+            with h5py.File(filename, "w") as f:
+                f.attrs["redshift"] = redshift
+                f.attrs["velocity"] = velocity
+                f.attrs["nei"] = self.nei
+                f.attrs["broadening"] = self.broadening
+                f.attrs["nolines"] = self.nolines
+                f.attrs["var_elem"] = self.var_ion_names if self.nei \
+                    else self.var_elem_names
+                f.create_dataset("kT", data=self.Tvals)
+                f.create_dataset("ebins", data=self.ebins)
+                f.create_dataset("abund_table", data=self.atable)
+                f.create_dataset("cosmic_spec", data=table[0])
+                f.create_dataset("metal_spec", data=table[1])
+                if table[2] is not None:
+                    f.create_dataset("var_spec", data=table[2])
+        return table
+
+    def read_table(self, filename):
+        """
+        Read a table of spectra previously written by
+        :meth:`make_table` and store it in this object, so
+        that spectra at the same redshift and velocity
+        broadening will be computed from it.
+
+        Parameters
+        ----------
+        filename : string
+            The HDF5 file containing the table.
+        """
+        with h5py.File(filename, "r") as f:
+            var_elem = self.var_ion_names if self.nei else self.var_elem_names
+            if bool(f.attrs["nei"]) != self.nei or \
+                    bool(f.attrs["broadening"]) != self.broadening or \
+                    bool(f.attrs["nolines"]) != self.nolines or \
+                    list(f.attrs["var_elem"]) != list(var_elem):
+                raise RuntimeError(f"The table in {filename} was not computed "
+                                   f"with the same options as this ApecGenerator!")
+            if f["ebins"].size != self.ebins.size or \
+                    not np.allclose(f["ebins"][()], self.ebins) or \
+                    not np.allclose(f["abund_table"][()], self.atable):
+                raise RuntimeError(f"The table in {filename} was not computed "
+                                   f"with the same energy binning or abundance "
+                                   f"table as this ApecGenerator!")
+            cspec = f["cosmic_spec"][()]
+            mspec = f["metal_spec"][()]
+            vspec = f["var_spec"][()] if "var_spec" in f else None
+            redshift = f.attrs["redshift"]
+            v = f.attrs["velocity"]*1.0e5
+        self._tables[redshift, v] = (cspec, mspec, vspec)
+
     def _spectrum_init(self, kT, velocity, elem_abund):
         kT = parse_value(kT, "keV")
         velocity = parse_value(velocity, "km/s")
@@ -935,51 +1374,16 @@ class ApecGenerator:
         return Spectrum(self.ebins, spec)
 
 
-def wabs_cross_section(E):
-    emax = np.array([0.0, 0.1, 0.284, 0.4, 0.532, 0.707, 0.867, 1.303, 1.840, 
-                     2.471, 3.210, 4.038, 7.111, 8.331, 10.0])
-    c0 = np.array([17.3, 34.6, 78.1, 71.4, 95.5, 308.9, 120.6, 141.3,
-                   202.7,342.7,352.2,433.9,629.0,701.2])
-    c1 = np.array([608.1, 267.9, 18.8, 66.8, 145.8, -380.6, 169.3,
-                   146.8, 104.7, 18.7, 18.7, -2.4, 30.9, 25.2]) 
-    c2 = np.array([-2150., -476.1 ,4.3, -51.4, -61.1, 294.0, -47.7,
-                   -31.5, -17.0, 0.0, 0.0, 0.75, 0.0, 0.0])
-    idxs = np.minimum(np.searchsorted(emax, E)-1, 13)
-    sigma = (c0[idxs]+c1[idxs]*E+c2[idxs]*E*E)*1.0e-24/E**3
-    return sigma
-
-
-def get_wabs_absorb(e, nH):
-    sigma = wabs_cross_section(e)
-    return np.exp(-nH*1.0e22*sigma)
-
-
-_tbabs_emid = None
-_tbabs_sigma = None
-_tbabs_spline = None
-
-
-def tbabs_cross_section(E):
-    global _tbabs_emid
-    global _tbabs_sigma
-    global _tbabs_spline
-    if _tbabs_spline is None:
-        filename = os.path.join(soxs_files_path, "tbabs_table.h5")
-        f = h5py.File(filename, "r")
-        _tbabs_sigma = f["cross_section"][:]
-        nbins = _tbabs_sigma.size
-        ebins = np.linspace(f["emin"][()], f["emax"][()], nbins+1)
-        f.close()
-        _tbabs_emid = 0.5*(ebins[1:]+ebins[:-1])
-        _tbabs_spline = InterpolatedUnivariateSpline(_tbabs_emid,
-                                                     _tbabs_sigma, k=5, 
-                                                     ext=1)
-    return _tbabs_spline(E)
+_apec_worker_gen = None
 
 
-def get_tbabs_absorb(e, nH):
-    sigma = tbabs_cross_section(e)
-    return np.exp(-nH*1.0e22*sigma)
+def _init_apec_worker(agen):
+    global _apec_worker_gen
+    _apec_worker_gen = agen
+
+
+def _apec_table_worker(index, redshift, velocity):
+    return index, _apec_worker_gen._get_table([index], redshift, velocity)
 
 
 class ConvolvedSpectrum(Spectrum):
@@ -990,18 +1394,18 @@ class ConvolvedSpectrum(Spectrum):
         from soxs.response import AuxiliaryResponseFile, FlatResponse
         super(ConvolvedSpectrum, self).__init__(ebins, flux)
         if isinstance(arf, Number):
-            arf = FlatResponse(ebins[0], ebins[-1], arf, ebins.size-1)
+            arf = FlatResponse(self._ebins[0], self._ebins[-1], arf, self.nbins)
         elif isinstance(arf, str):
             arf = AuxiliaryResponseFile(arf)
         self.arf = arf
 
     def __add__(self, other):
         self._check_binning_units(other)
-        return ConvolvedSpectrum(self.ebins, self.flux+other.flux, self.arf)
+        return ConvolvedSpectrum(self._ebins, self._flux+other._flux, self.arf)
 
     def __sub__(self, other):
         self._check_binning_units(other)
-        return ConvolvedSpectrum(self.ebins, self.flux-other.flux, self.arf)
+        return ConvolvedSpectrum(self._ebins, self._flux-other._flux, self.arf)
 
     @classmethod
     def convolve(cls, spectrum, arf):
@@ -1019,9 +1423,9 @@ class ConvolvedSpectrum(Spectrum):
         from soxs.response import AuxiliaryResponseFile
         if not isinstance(arf, AuxiliaryResponseFile):
             arf = AuxiliaryResponseFile(arf)
-        earea = arf.interpolate_area(spectrum.emid.value)
-        rate = spectrum.flux * earea
-        return cls(spectrum.ebins, rate, arf)
+        earea = arf._area_on_grid(spectrum._emid)
+        rate = spectrum._flux * earea
+        return cls(spectrum._ebins, rate, arf)
 
     def new_spec_from_band(self, emin, emax):
         """
@@ -1044,12 +1448,12 @@ class ConvolvedSpectrum(Spectrum):
         Return the deconvolved :class:`~soxs.spectra.Spectrum`
         object associated with this convolved spectrum.
         """
-        earea = self.arf.interpolate_area(self.emid)
-        flux = self.flux / earea
-        flux = np.nan_to_num(flux.value)
-        return Spectrum(self.ebins.value, flux)
+        earea = self.arf._area_on_grid(self._emid)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            flux = np.nan_to_num(self._flux / earea)
+        return Spectrum(self._ebins, flux)
 
-    def generate_energies(self, t_exp, prng=None, quiet=False):
+    def generate_energies(self, t_exp, prng=None, quiet=False, ordered=False):
         """
         Generate photon energies from this convolved spectrum given an
         exposure time.
@@ -1067,16 +1471,77 @@ class ConvolvedSpectrum(Spectrum):
             If True, log messages will not be displayed when 
             creating energies. Useful if you have to loop over 
             a lot of spectra. Default: False
+        ordered : boolean, optional
+            If True, the energies will be returned sorted in 
+            increasing order. Otherwise, they are grouped by 
+            energy bin but not sorted within each bin, which is 
+            faster. Default: False
         """
         t_exp = parse_value(t_exp, "s")
         prng = parse_prng(prng)
         rate = self.total_flux.value
-        energy = _generate_energies(self, t_exp, rate, prng, quiet=quiet)
+        energy = _generate_energies(self, t_exp, rate, prng, quiet=quiet,
+                                    ordered=ordered)
         earea = self.arf.interpolate_area(energy).value
         flux = np.sum(energy)*erg_per_keV/t_exp/earea.sum()
         energies = Energies(energy, flux)
         return energies
 
+    def generate_energy_chunks(self, t_exp, chunk_size=1000000, prng=None,
+                               quiet=False, ordered=False):
+        """
+        Generate photon energies from this convolved spectrum given
+        an exposure time, in chunks of at most *chunk_size* energies.
+        This is a generator, which allows very large numbers of 
+        photons to be processed with bounded memory. The total number
+        of photons is drawn from the same Poisson distribution as in
+        :meth:`generate_energies`, and the chunks are in order of 
+        increasing energy bin. 
+
+        Parameters
+        ----------
+        t_exp : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`
+            The exposure time in seconds.
+        chunk_size : integer, optional
+            The maximum number of energies in each chunk. 
+            Default: 1000000
+        prng : :class:`~numpy.random.RandomState` object, integer, or None
+            A pseudo-random number generator. Typically will only 
+            be specified if you have a reason to generate the same 
+            set of random numbers, such as for a test. Default is None, 
+            which sets the seed based on the system time. 
+        quiet : boolean, optional
+            If True, log messages will not be displayed when 
+            creating energies. Default: False
+        ordered : boolean, optional
+            If True, the energies in each chunk will be sorted in
+            increasing order. Otherwise, they are grouped by energy
+            bin but not sorted within each bin, which is faster. 
+            Default: False
+
+        Returns
+        -------
+        A generator of :class:`~soxs.spectra.Energies` objects. The
+        flux of each chunk is the contribution of its photons to
+        the total flux, so the fluxes of all of the chunks sum to 
+        the flux of the whole sample. Since the total effective area
+        of the photons must be known before the first chunk is 
+        generated, it is computed from the effective area at the 
+        centers of the bins.
+        """
+        t_exp = parse_value(t_exp, "s")
+        prng = parse_prng(prng)
+        rate = self.total_flux.value
+        counts = _bin_counts(self, t_exp, rate, prng)
+        if not quiet:
+            mylog.info(f"Creating {counts.sum()} energies from this spectrum "
+                       f"in chunks of {chunk_size}.")
+        earea = (counts*self.arf._area_on_grid(self._emid)).sum()
+        for energy in _energy_chunks(self, counts, chunk_size, prng,
+                                     ordered=ordered):
+            flux = np.sum(energy)*erg_per_keV/t_exp/earea
+            yield Energies(energy, flux)
+
     def apply_foreground_absorption(self, nH, model="wabs"):
         raise NotImplementedError
 
@@ -1097,3 +1562,382 @@ class ConvolvedSpectrum(Spectrum):
     @classmethod
     def from_xspec_script(cls, infile, emin=0.01, emax=50.0, nbins=10000):
         raise NotImplementedError
+
+    @classmethod
+    def from_xspec_models(cls, model_string, params_list, emin=0.01,
+                          emax=50.0, nbins=10000):
+        raise NotImplementedError
+
+
+class SpectrumStack:
+    r"""
+    A stack of spectra which share the same energy binning,
+    stored as a single (N, nbins) array so that operations
+    can be applied to all of the spectra at once.
+
+    Parameters
+    ----------
+    ebins : array-like or :class:`~astropy.units.Quantity`
+        The energy bin edges of the spectra in keV.
+    flux : array-like or :class:`~astropy.units.Quantity`
+        The spectra, with shape (N, nbins).
+
+    Examples
+    --------
+    >>> spectra = [agen.get_spectrum(kT, 0.3, 0.05, 1.0e-3) 
+    ...            for kT in [2.0, 4.0, 6.0]]
+    >>> stack = SpectrumStack.from_spectra(spectra)
+    >>> stack.apply_foreground_absorption([0.01, 0.02, 0.03])
+    """
+    _units = "photon/(cm**2*s*keV)"
+
+    def __init__(self, ebins, flux):
+        self.ebins = u.Quantity(ebins, "keV")
+        self.emid = 0.5*(self.ebins[1:]+self.ebins[:-1])
+        self.flux = u.Quantity(np.atleast_2d(flux), self._units)
+        self.nbins = len(self.emid)
+        if self.flux.shape[1] != self.nbins:
+            raise RuntimeError("The shape of the flux array is not consistent "
+                               "with the energy binning!")
+        self.nspec = self.flux.shape[0]
+        self.de = np.diff(self.ebins)
+
+    @classmethod
+    def from_spectra(cls, spectra):
+        """
+        Create a stack from a list of spectra.
+
+        Parameters
+        ----------
+        spectra : list of :class:`~soxs.spectra.Spectrum` objects
+            The spectra to stack. All must have the same energy
+            binning and units.
+        """
+        for spec in spectra[1:]:
+            spectra[0]._check_binning_units(spec)
+        if spectra[0]._units != cls._units:
+            raise RuntimeError("The units of these spectra are not the "
+                               "same as the units of this stack!")
+        flux = np.array([spec.flux.value for spec in spectra])
+        return cls(spectra[0].ebins, flux)
+
+    def to_spectra(self):
+        """
+        Return the spectra in this stack as a list of
+        :class:`~soxs.spectra.Spectrum` objects.
+        """
+        return [self[i] for i in range(self.nspec)]
+
+    def __len__(self):
+        return self.nspec
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return Spectrum(self.ebins, self.flux[item])
+        return SpectrumStack(self.ebins, self.flux[item])
+
+    def __mul__(self, other):
+        if hasattr(other, "eff_area"):
+            return ConvolvedSpectrumStack.convolve(self, other)
+        else:
+            other = np.asarray(other)
+            if other.ndim == 1:
+                other = other[:, np.newaxis]
+            return SpectrumStack(self.ebins, other*self.flux)
+
+    __rmul__ = __mul__
+
+    def __repr__(self):
+        return "SpectrumStack (%s - %s, %d spectra)\n" % (self.ebins[0], 
+                                                          self.ebins[-1],
+                                                          self.nspec)
+
+    @property
+    def total_flux(self):
+        return (self.flux*self.de).sum(axis=1)
+
+    @property
+    def total_energy_flux(self):
+        return (self.flux*self.emid.to("erg")*self.de).sum(axis=1)/(1.0*u.photon)
+
+    def _band_idxs(self, emin, emax):
+        if emin is None:
+            emin = self.ebins[0].value
+        if emax is None:
+            emax = self.ebins[-1].value
+        emin = parse_value(emin, "keV")
+        emax = parse_value(emax, "keV")
+        return np.logical_and(self.emid.value >= emin, self.emid.value <= emax)
+
+    def get_flux_in_band(self, emin, emax):
+        """
+        Determine the total flux of each spectrum within a band
+        specified by an energy range.
+
+        Parameters
+        ----------
+        emin : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`
+            The minimum energy in the band, in keV.
+        emax : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`
+            The maximum energy in the band, in keV.
+
+        Returns
+        -------
+        A tuple of arrays of values for the flux/intensity in the
+        band: the first is in terms of the photon rate, the second 
+        is in terms of the energy rate.
+        """
+        idxs = self._band_idxs(emin, emax)
+        pflux = (self.flux*self.de)[:, idxs].sum(axis=1)
+        eflux = (self.flux*self.emid.to("erg")*self.de)[:, idxs].sum(axis=1)/(1.0*u.photon)
+        return pflux, eflux
+
+    def rescale_flux(self, new_flux, emin=None, emax=None, flux_type="photons"):
+        """
+        Rescale the fluxes of the spectra, optionally using
+        a specific energy band.
+
+        Parameters
+        ----------
+        new_flux : float or array-like
+            The new flux or fluxes in units of photons/s/cm**2.
+            If an array, it must have one value per spectrum.
+        emin : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`, optional
+            The minimum energy of the band to consider,
+            in keV. Default: Use the minimum energy of
+            the entire spectrum.
+        emax : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`, optional
+            The maximum energy of the band to consider,
+            in keV. Default: Use the maximum energy of
+            the entire spectrum.
+        flux_type : string, optional
+            The units of the flux to use in the rescaling:
+                "photons": photons/s/cm**2
+                "energy": erg/s/cm**2
+        """
+        idxs = self._band_idxs(emin, emax)
+        if flux_type == "photons":
+            f = (self.flux*self.de)[:, idxs].sum(axis=1)
+        elif flux_type == "energy":
+            f = (self.flux*self.emid.to("erg")*self.de)[:, idxs].sum(axis=1)
+        self.flux *= (np.asarray(new_flux)/f.value)[:, np.newaxis]
+
+    def apply_foreground_absorption(self, nH, model="wabs", redshift=0.0):
+        """
+        Given hydrogen column densities, apply galactic
+        foreground absorption to the spectra.
+
+        Parameters
+        ----------
+        nH : float, array-like, or :class:`~astropy.units.Quantity`
+            The hydrogen column in units of 10**22 atoms/cm**2.
+            If an array, it must have one value per spectrum.
+        model : string, optional
+            The model for absorption to use. Options are "wabs"
+            (Wisconsin, Morrison and McCammon; ApJ 270, 119) or
+            "tbabs" (Tuebingen-Boulder, Wilms, J., Allen, A., &
+            McCray, R. 2000, ApJ, 542, 914). Default: "wabs".
+        redshift : float or array-like, optional
+            The redshift of the absorbing material. If an array, 
+            it must have one value per spectrum. Default: 0.0
+        """
+        if isinstance(nH, u.Quantity):
+            nH = nH.to_value("1.0e22*cm**-2")
+        elif isinstance(nH, (list, np.ndarray)):
+            nH = np.asarray(nH, dtype="float64")
+        else:
+            nH = parse_value(nH, "1.0e22*cm**-2")
+        self.flux *= get_absorb(self.emid.value, nH, model=model,
+                                redshift=redshift, cache=True)
+
+    def _generate_energies(self, t_exp, rate, prng, quiet, ordered):
+        # Poisson draws for every bin of every spectrum at once, 
+        # then the photons for all of the spectra are placed in 
+        # their bins in a single pass over the flattened grid
+        pflux = (self.flux*self.de).value
+        tot = pflux.sum(axis=1)
+        lam = np.zeros_like(pflux)
+        nonzero = tot > 0.0
+        lam[nonzero] = t_exp*(rate/tot)[nonzero, np.newaxis]*pflux[nonzero]
+        counts = prng.poisson(lam=lam)
+        n_ph = counts.sum(axis=1)
+        if not quiet:
+            mylog.info(f"Creating {n_ph.sum()} energies from {self.nspec} spectra.")
+        elo = np.tile(self.ebins.value[:-1], self.nspec)
+        de = np.tile(self.de.value, self.nspec)
+        e = _sample_in_bins(elo, de, counts, prng)
+        energies = np.split(e, np.cumsum(n_ph)[:-1])
+        if ordered:
+            for energy in energies:
+                energy.sort()
+        if not quiet:
+            mylog.info("Finished creating energies.")
+        return energies
+
+    def generate_energies(self, t_exp, area, prng=None, quiet=False,
+                          ordered=False):
+        """
+        Generate photon energies from all of the spectra in this
+        stack given an exposure time and effective area.
+
+        Parameters
+        ----------
+        t_exp : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`
+            The exposure time in seconds.
+        area : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`
+            The effective area in cm**2.
+        prng : :class:`~numpy.random.RandomState` object, integer, or None
+            A pseudo-random number generator. Typically will only 
+            be specified if you have a reason to generate the same 
+            set of random numbers, such as for a test. Default is None, 
+            which sets the seed based on the system time. 
+        quiet : boolean, optional
+            If True, log messages will not be displayed when 
+            creating energies. Default: False
+        ordered : boolean, optional
+            If True, the energies will be returned sorted in 
+            increasing order. Otherwise, they are grouped by 
+            energy bin but not sorted within each bin, which is 
+            faster. Default: False
+
+        Returns
+        -------
+        A list of :class:`~soxs.spectra.Energies` objects, one
+        for each spectrum in the stack.
+        """
+        t_exp = parse_value(t_exp, "s")
+        area = parse_value(area, "cm**2")
+        prng = parse_prng(prng)
+        rate = area*self.total_flux.value
+        energies = []
+        for energy in self._generate_energies(t_exp, rate, prng, quiet, ordered):
+            flux = np.sum(energy)*erg_per_keV/t_exp/area
+            energies.append(Energies(energy, flux))
+        return energies
+
+
+class ConvolvedSpectrumStack(SpectrumStack):
+    r"""
+    A stack of spectra which share the same energy binning
+    and which have been convolved with the same ARF.
+
+    Parameters
+    ----------
+    ebins : array-like or :class:`~astropy.units.Quantity`
+        The energy bin edges of the spectra in keV.
+    flux : array-like or :class:`~astropy.units.Quantity`
+        The count rate spectra, with shape (N, nbins).
+    arf : string or :class:`~soxs.response.AuxiliaryResponseFile`
+        The ARF the spectra were convolved with.
+    """
+    _units = "photon/(s*keV)"
+
+    def __init__(self, ebins, flux, arf):
+        from soxs.response import AuxiliaryResponseFile
+        super(ConvolvedSpectrumStack, self).__init__(ebins, flux)
+        if isinstance(arf, str):
+            arf = AuxiliaryResponseFile(arf)
+        self.arf = arf
+
+    @classmethod
+    def from_spectra(cls, spectra):
+        """
+        Create a stack from a list of convolved spectra.
+
+        Parameters
+        ----------
+        spectra : list of :class:`~soxs.spectra.ConvolvedSpectrum` objects
+            The spectra to stack. All must have the same energy
+            binning and ARF.
+        """
+        for spec in spectra[1:]:
+            spectra[0]._check_binning_units(spec)
+            if spec.arf._cache_key != spectra[0].arf._cache_key:
+                raise RuntimeError("The ARFs for these spectra are "
+                                   "not the same!")
+        flux = np.array([spec.flux.value for spec in spectra])
+        return cls(spectra[0].ebins, flux, spectra[0].arf)
+
+    @classmethod
+    def convolve(cls, stack, arf):
+        """
+        Generate a stack of convolved spectra by convolving 
+        a stack of spectra with an ARF.
+
+        Parameters
+        ----------
+        stack : :class:`~soxs.spectra.SpectrumStack` object
+            The input stack of spectra to convolve with.
+        arf : string or :class:`~soxs.instrument.AuxiliaryResponseFile`
+            The ARF to use in the convolution.
+        """
+        from soxs.response import AuxiliaryResponseFile
+        if not isinstance(arf, AuxiliaryResponseFile):
+            arf = AuxiliaryResponseFile(arf)
+        earea = arf._area_on_grid(stack.emid.value)
+        rate = stack.flux.value * earea
+        return cls(stack.ebins, rate, arf)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return ConvolvedSpectrum(self.ebins, self.flux[item], self.arf)
+        return ConvolvedSpectrumStack(self.ebins, self.flux[item], self.arf)
+
+    def __mul__(self, other):
+        other = np.asarray(other)
+        if other.ndim == 1:
+            other = other[:, np.newaxis]
+        return ConvolvedSpectrumStack(self.ebins, other*self.flux, self.arf)
+
+    __rmul__ = __mul__
+
+    def deconvolve(self):
+        """
+        Return the deconvolved :class:`~soxs.spectra.SpectrumStack`
+        object associated with this stack of convolved spectra.
+        """
+        earea = self.arf._area_on_grid(self.emid.value)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            flux = np.nan_to_num(self.flux.value / earea)
+        return SpectrumStack(self.ebins.value, flux)
+
+    def generate_energies(self, t_exp, prng=None, quiet=False, ordered=False):
+        """
+        Generate photon energies from all of the convolved spectra 
+        in this stack given an exposure time.
+
+        Parameters
+        ----------
+        t_exp : float, (value, unit) tuple, or :class:`~astropy.units.Quantity`
+            The exposure time in seconds.
+        prng : :class:`~numpy.random.RandomState` object, integer, or None
+            A pseudo-random number generator. Typically will only 
+            be specified if you have a reason to generate the same 
+            set of random numbers, such as for a test. Default is None, 
+            which sets the seed based on the system time.
+        quiet : boolean, optional
+            If True, log messages will not be displayed when 
+            creating energies. Default: False
+        ordered : boolean, optional
+            If True, the energies will be returned sorted in 
+            increasing order. Otherwise, they are grouped by 
+            energy bin but not sorted within each bin, which is 
+            faster. Default: False
+
+        Returns
+        -------
+        A list of :class:`~soxs.spectra.Energies` objects, one
+        for each spectrum in the stack.
+        """
+        t_exp = parse_value(t_exp, "s")
+        prng = parse_prng(prng)
+        rate = self.total_flux.value
+        energies = []
+        for energy in self._generate_energies(t_exp, rate, prng, quiet, ordered):
+            earea = self.arf.interpolate_area(energy).value
+            flux = np.sum(energy)*erg_per_keV/t_exp/earea.sum()
+            energies.append(Energies(energy, flux))
+        return energies
+
+    def apply_foreground_absorption(self, nH, model="wabs", redshift=0.0):
+        raise NotImplementedError
@@ -0,0 +1,128 @@
+from soxs.cosmology import make_tiled_halo_catalog, halos_cat_file, \
+    _read_halo_tiles, _generate_halo_energies, h0, omega_m, abund, \
+    emin, emax
+from soxs.spatial import BetaModel, construct_wcs, \
+    _generate_beta_model_coords
+from astropy.cosmology import FlatLambdaCDM
+from scipy.stats import ks_2samp
+import numpy as np
+import h5py
+import os
+import tempfile
+import shutil
+
+
+def test_tiled_halo_catalog():
+    cosmo = FlatLambdaCDM(H0=100.0*h0, Om0=omega_m)
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    make_tiled_halo_catalog(halos_cat_file, "tiled_halos.h5", tile_size=20.0)
+
+    with h5py.File(halos_cat_file, "r") as f:
+        all_halos = {k: f[k][()] for k in f}
+    with h5py.File("tiled_halos.h5", "r") as f:
+        xmin, ymin = f.attrs["xmin"], f.attrs["ymin"]
+        tile_size = f.attrs["tile_size"]
+        x = f["x"][()]
+        z = f["redshift"][()]
+        assert f["tile_offsets"][-1] == x.size == all_halos["x"].size
+        assert np.allclose(np.sort(z), np.sort(all_halos["redshift"]))
+        for xlo, ylo, width in [(-12.0, 37.0, 22.0), (-300.0, -300.0, 15.0),
+                                (xmin+tile_size, ymin, 2.0*tile_size)]:
+            xhi = xlo+width
+            yhi = ylo+width
+            halos = _read_halo_tiles(f, xlo, xhi, ylo, yhi)
+            assert halos["x"].size < x.size
+            # Every halo in the box must come from the tiles that were read
+            for h in [halos, all_halos]:
+                scale = cosmo.kpc_comoving_per_arcmin(h["redshift"])
+                scale = scale.to_value("Mpc/arcmin")
+                hx = h["x"].astype("float64")/(h0*scale)
+                hy = h["y"].astype("float64")/(h0*scale)
+                idxs = (hx >= xlo) & (hx <= xhi) & (hy >= ylo) & (hy <= yhi)
+                h["in_box"] = np.sort(h["M500c"][idxs])
+            assert halos["in_box"].size > 0
+            np.testing.assert_array_equal(halos["in_box"], 
+                                          all_halos["in_box"])
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+
+def test_halo_energies():
+    from soxs.spectra import ApecGenerator
+    prng = np.random.RandomState(34)
+    kT = np.array([1.0, 3.0, 7.5])
+    z = np.array([0.1, 0.4, 0.9])
+    flux_kcorr = np.array([1.0e-14, 2.0e-14, 5.0e-15])
+    exp_time = 50000.0
+    area = 40000.0
+    nH = 0.05
+    ee, halo_id = _generate_halo_energies(kT, z, flux_kcorr, exp_time, area,
+                                          nH, "wabs", prng)
+    assert np.all(np.diff(halo_id) >= 0)
+    # Compare with generating the photons one halo at a time
+    agen = ApecGenerator(0.1, 10.0, 10000, broadening=False)
+    for i in range(kT.size):
+        spec = agen.get_spectrum(kT[i], abund, z[i], 1.0)
+        spec.rescale_flux(flux_kcorr[i], emin=emin, emax=emax,
+                          flux_type="energy")
+        spec.apply_foreground_absorption(nH, model="wabs")
+        e = spec.generate_energies(exp_time, area, prng=prng, quiet=True)
+        e1 = ee[halo_id == i]
+        n = e.size
+        assert np.abs(e1.size-n) < 4.0*np.sqrt(n)
+        assert np.abs(e1.mean()/e.value.mean()-1.0) < 4.0*e.value.std()/(
+            e.value.mean()*np.sqrt(n))
+        assert ks_2samp(e1, e.value).pvalue > 0.001
+    # Halos outside the range of the tables do not emit photons
+    ee, halo_id = _generate_halo_energies(np.array([3.0, 1000.0]), 
+                                          np.array([0.1, 0.1]),
+                                          np.array([1.0e-14]*2), exp_time,
+                                          area, nH, "wabs", prng)
+    assert ee.size > 0
+    assert np.all(halo_id == 0)
+
+
+def test_halo_coords():
+    prng = np.random.RandomState(35)
+    ra0 = np.array([30.0, 30.1, 200.0])
+    dec0 = np.array([45.0, 45.05, -80.0])
+    r_c = np.array([5.0, 20.0, 60.0])
+    beta = np.array([0.5, 2.0/3.0, 0.8])
+    ellip = np.array([1.0, 0.7, 0.5])
+    theta = np.array([0.0, 30.0, 120.0])
+    n_ph = np.array([20000, 30000, 25000])
+    halo_id = np.repeat(np.arange(3), n_ph)
+    ra, dec = _generate_beta_model_coords(ra0[halo_id], dec0[halo_id],
+                                          r_c[halo_id], beta[halo_id],
+                                          ellip[halo_id], theta[halo_id], 
+                                          prng)
+    # Compare with generating the positions one halo at a time
+    for i in range(3):
+        bm = BetaModel(ra0[i], dec0[i], r_c[i], beta[i], 
+                       ellipticity=ellip[i], theta=theta[i])
+        ra1, dec1 = bm.generate_coords(n_ph[i], prng=prng)
+        w = construct_wcs(ra0[i], dec0[i])
+        radii = []
+        for rr, dd in [(ra[halo_id == i], dec[halo_id == i]), 
+                       (ra1.value, dec1.value)]:
+            x, y = w.wcs_world2pix(rr, dd, 1)
+            t = np.deg2rad(theta[i])
+            xx = x*np.cos(t)+y*np.sin(t)
+            yy = (-x*np.sin(t)+y*np.cos(t))/ellip[i]
+            radii.append(np.hypot(xx, yy))
+            phi = np.arctan2(yy, xx)
+            assert np.abs(np.mean(np.cos(phi))) < 0.03
+            assert np.abs(np.mean(np.sin(phi))) < 0.03
+        assert ks_2samp(radii[0], radii[1]).pvalue > 0.001
+        # The radii follow the beta-model profile, truncated at 3000 arcsec
+        r = np.linspace(0.0, 3000.0, 300001)
+        rmid = 0.5*(r[1:]+r[:-1])
+        pdf = rmid*(1.0+(rmid/r_c[i])**2)**(-3.0*beta[i]+0.5)
+        cdf = np.concatenate([[0.0], np.cumsum(pdf)])/pdf.sum()
+        for q in [0.1, 0.5, 0.9]:
+            rq = np.interp(q, cdf, r)
+            assert np.abs((radii[0] <= rq).mean()-q) < 0.01
@@ -0,0 +1,333 @@
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+import astropy.io.fits as pyfits
+import pytest
+import tempfile
+import os
+import shutil
+from soxs.background.events import add_background_from_file
+from soxs.events import write_event_file, EventFile, write_products, \
+    ImageProduct, RadialProfileProduct, write_image, write_image_cube, \
+    make_tile_index, write_radial_profile, make_exposure_map
+from soxs.instrument_registry import add_instrument_to_registry, \
+    instrument_registry
+
+nx = 256
+parameters = {"exposure_time": 1000.0, "sky_center": [30.0, 45.0],
+              "plate_scale": 1.0/3600.0, "pix_center": [nx+0.5]*2,
+              "num_pixels": nx, "chan_lim": [1, 1024], "rmf": "fake.rmf",
+              "arf": "fake.arf", "nchan": 1024, "channel_type": "PI",
+              "mission": "none", "telescope": "none", "instrument": "none",
+              "roll_angle": 0.0, "aimpt_coords": [0.0, 0.0],
+              "aimpt_shift": [0.0, 0.0], "dither_params": {"dither_on": False}}
+
+
+def make_events(n, prng):
+    events = {"xpix": prng.uniform(0.5, 2*nx+0.5, size=n),
+              "ypix": prng.uniform(0.5, 2*nx+0.5, size=n),
+              "energy": prng.uniform(0.1, 10.0, size=n),
+              "detx": prng.uniform(-0.5*nx, 0.5*nx, size=n),
+              "dety": prng.uniform(-0.5*nx, 0.5*nx, size=n),
+              "chip_id": prng.randint(0, 4, size=n),
+              "pi": prng.randint(1, 1025, size=n),
+              "time": prng.uniform(0.0, parameters["exposure_time"], size=n)}
+    return events
+
+
+def test_event_file_read():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    prng = np.random.RandomState(25)
+    events = make_events(10000, prng)
+    write_event_file(events, parameters, "evt.fits", overwrite=True)
+    e = (events["energy"]*1000.0).astype("float32")
+
+    with EventFile("evt.fits", chunk_size=999) as ef:
+        assert len(ef) == 10000
+        assert ef.exposure_time == parameters["exposure_time"]
+        assert ef.chantype == "PI"
+        assert not ef.dither_params["dither_on"]
+        assert_array_equal(ef.wcs.wcs.crval, parameters["sky_center"])
+        all_evts = ef.read(["X", "PI"])
+        assert_array_equal(all_evts["X"], events["xpix"])
+        assert_array_equal(all_evts["PI"], events["pi"])
+        idxs = (e > 500.0) & (e < 2000.0) & (events["time"] >= 100.0) & \
+            (events["time"] < 500.0) & np.isin(events["chip_id"], [0, 2])
+        evts = ef.read(["X", "Y", "ENERGY"], emin=0.5, emax=(2.0, "keV"),
+                       tmin=100.0, tmax=500.0, chips=[0, 2])
+        assert_array_equal(evts["X"], events["xpix"][idxs])
+        assert_array_equal(evts["Y"], events["ypix"][idxs])
+        assert_array_equal(evts["ENERGY"], e[idxs])
+        n = sum(chunk["Y"].size for chunk in
+                ef.iter_chunks(["Y"], emin=0.5, emax=2.0, tmin=100.0,
+                               tmax=500.0, chips=[0, 2]))
+        assert n == idxs.sum()
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+
+def test_write_products():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    prng = np.random.RandomState(47)
+    events = make_events(20000, prng)
+    write_event_file(events, parameters, "evt.fits", overwrite=True)
+    e = (events["energy"]*1000.0).astype("float32")
+    x = events["xpix"]
+    y = events["ypix"]
+    bins1 = np.linspace(0.5, 2*nx+0.5, 2*nx+1)
+    bins2 = np.linspace(0.5, 2*nx+0.5, nx+1)
+
+    region = "image;circle(256.5,256.5,100)"
+    products = [ImageProduct("img1.fits", emin=0.5, emax=2.0),
+                ImageProduct("img2.fits", reblock=2, region=region),
+                RadialProfileProduct("prof.fits", [nx+0.5]*2, 0.0, 100.0, 10,
+                                     ctr_type="physical", emin=2.0)]
+    write_products("evt.fits", products, overwrite=True)
+    write_image("evt.fits", "img3.fits", emin=0.5, emax=2.0, overwrite=True)
+
+    idxs = (e > 500.0) & (e < 2000.0)
+    H1 = np.histogram2d(x[idxs], y[idxs], bins=[bins1]*2)[0]
+    idxs = (x-256.5)**2+(y-256.5)**2 < 100.0**2
+    H2 = np.histogram2d(x[idxs], y[idxs], bins=[bins2]*2)[0]
+    idxs = e > 2000.0
+    r = np.sqrt((x[idxs]-nx-0.5)**2+(y[idxs]-nx-0.5)**2)
+    C = np.histogram(r, bins=np.linspace(0.0, 100.0, 11))[0]
+    with pyfits.open("img1.fits") as f1, pyfits.open("img3.fits") as f3:
+        assert_array_equal(f1["IMAGE"].data, H1.T)
+        assert_array_equal(f3["IMAGE"].data, H1.T)
+    with pyfits.open("img2.fits") as f:
+        assert_array_equal(f["IMAGE"].data, H2.T)
+        assert_allclose(f["IMAGE"].header["CDELT2"], 2.0/3600.0)
+    with pyfits.open("prof.fits") as f:
+        assert_array_equal(f["PROFILE"].data["NET_COUNTS"], C)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+
+def test_write_image_cube():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    prng = np.random.RandomState(48)
+    events = make_events(20000, prng)
+    write_event_file(events, parameters, "evt.fits", overwrite=True)
+    e = (events["energy"]*1000.0).astype("float32")*1.0e-3
+    ebins = np.array([0.1, 0.5, 2.0, 7.0])
+    bins = np.linspace(0.5, 2*nx+0.5, nx+1)
+
+    write_image_cube("evt.fits", "cube.fits", ebins, reblock=2, 
+                     overwrite=True)
+    write_image_cube("evt.fits", "cube_det.fits", ebins, coord_type="det",
+                     overwrite=True)
+
+    expmap = np.tile(np.arange(1.0, 4.0)[:,None,None], (1, nx, nx))
+    fits_expmap = pyfits.ImageHDU(expmap, name="EXPMAP")
+    fits_expmap.writeto("expmap_cube.fits", overwrite=True)
+    write_image_cube("evt.fits", "flux_cube.fits", ebins, reblock=2, 
+                     expmap_file="expmap_cube.fits", overwrite=True)
+
+    with pyfits.open("cube.fits") as f, pyfits.open("flux_cube.fits") as ff, \
+            pyfits.open("cube_det.fits") as fd:
+        cube = f["IMAGE"].data
+        assert cube.shape == (3, nx, nx)
+        assert fd["IMAGE"].data.shape == (3, nx, nx)
+        assert_array_equal(f["EBOUNDS"].data["E_MIN"], ebins[:-1])
+        assert_array_equal(f["EBOUNDS"].data["E_MAX"], ebins[1:])
+        assert_array_equal(f["EBOUNDS"].data["CHANNEL"], np.arange(1, 4))
+        for i in range(3):
+            idxs = (e >= ebins[i]) & (e < ebins[i+1])
+            H = np.histogram2d(events["xpix"][idxs], events["ypix"][idxs],
+                               bins=[bins]*2)[0]
+            assert_array_equal(cube[i], H.T)
+            assert fd["IMAGE"].data[i].sum() == idxs.sum()
+            assert_allclose(ff["IMAGE"].data[i], cube[i]/(i+1.0))
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+
+def test_image_cube_expmap():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    # An ARF whose area varies strongly across the bands
+    ebins_arf = np.linspace(0.05, 12.0, 1001)
+    emid = 0.5*(ebins_arf[1:]+ebins_arf[:-1])
+    cols = [pyfits.Column(name="ENERG_LO", format="E", array=ebins_arf[:-1]),
+            pyfits.Column(name="ENERG_HI", format="E", array=ebins_arf[1:]),
+            pyfits.Column(name="SPECRESP", format="E", 
+                          array=100.0+400.0*np.exp(-0.5*(emid-1.5)**2))]
+    arf_hdu = pyfits.BinTableHDU.from_columns(cols)
+    arf_hdu.name = "SPECRESP"
+    pyfits.HDUList([pyfits.PrimaryHDU(), arf_hdu]).writeto("cube.arf")
+
+    if "cube_test" not in instrument_registry:
+        add_instrument_to_registry({"name": "cube_test", "arf": "cube.arf",
+                                    "rmf": "fake.rmf", "bkgnd": None,
+                                    "fov": 20.0, "num_pixels": nx, 
+                                    "aimpt_coords": [0.0, 0.0],
+                                    "chips": [["Box", 0, 0, nx, nx]],
+                                    "focal_length": 10.0, "dither": True,
+                                    "psf": ["gaussian", 1.0], 
+                                    "imaging": True, "grating": False})
+    params = parameters.copy()
+    params["instrument"] = "cube_test"
+    params["arf"] = "cube.arf"
+    params["dither_params"] = {"dither_on": True, "x_amp": 8.0, 
+                               "y_amp": 8.0, "x_period": 1000.0, 
+                               "y_period": 707.0}
+    prng = np.random.RandomState(148)
+    events = make_events(20000, prng)
+    write_event_file(events, params, "evt.fits", overwrite=True)
+
+    ebins = np.array([0.1, 0.5, 2.0, 7.0])
+    make_exposure_map("evt.fits", "expmap.fits", 1.0, reblock=2, 
+                      overwrite=True)
+    write_image_cube("evt.fits", "cube.fits", ebins, reblock=2, 
+                     overwrite=True)
+    write_image_cube("evt.fits", "flux_cube.fits", ebins, reblock=2, 
+                     expmap_file="expmap.fits", overwrite=True)
+
+    with pyfits.open("expmap.fits") as f:
+        expmap = f["EXPMAP"].data
+        eff_area = f["EXPMAP"].header["EFFAREA"]
+    e = (events["energy"]*1000.0).astype("float32")*1.0e-3
+    arf_area = np.interp(e, emid, cols[2].array)
+    with pyfits.open("cube.fits") as f, pyfits.open("flux_cube.fits") as ff:
+        cube = f["IMAGE"].data
+        for i in range(3):
+            # The exposure map in each band is rescaled to the
+            # counts-weighted mean area of the band
+            idxs = (e >= ebins[i]) & (e < ebins[i+1])
+            band_area = idxs.sum()/(1.0/arf_area[idxs]).sum()
+            band_expmap = expmap*band_area/eff_area
+            flux = np.zeros_like(band_expmap)
+            np.divide(cube[i], band_expmap, out=flux, where=band_expmap > 0.0)
+            assert flux.sum() > 0.0
+            assert_allclose(ff["IMAGE"].data[i], flux, rtol=1.0e-5)
+
+    # Exposure maps without the effective area cannot be rescaled
+    with pyfits.open("expmap.fits") as f:
+        del f["EXPMAP"].header["EFFAREA"]
+        f.writeto("expmap_noarea.fits")
+    with pytest.raises(RuntimeError):
+        write_image_cube("evt.fits", "flux_cube2.fits", ebins, reblock=2,
+                         expmap_file="expmap_noarea.fits", overwrite=True)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+
+def test_tile_index():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    prng = np.random.RandomState(49)
+    events = make_events(20000, prng)
+    write_event_file(events, parameters, "evt.fits", overwrite=True)
+    write_event_file(events, parameters, "evt_idx.fits", overwrite=True,
+                     tile_size=32)
+    make_tile_index("evt.fits", tile_size=32, out_file="evt_idx2.fits")
+
+    with pyfits.open("evt_idx.fits") as f, pyfits.open("evt_idx2.fits") as f2:
+        idx = f["TILEIDX"].data
+        assert idx["NROWS"].sum() == 20000
+        assert_array_equal(idx["START"][1:], np.cumsum(idx["NROWS"])[:-1])
+        x = f["EVENTS"].data["X"]
+        y = f["EVENTS"].data["Y"]
+        for i in prng.choice(idx.size, size=10, replace=False):
+            start = idx["START"][i]
+            stop = start+idx["NROWS"][i]
+            assert np.all(np.floor((x[start:stop]-0.5)/32) == idx["TILEX"][i])
+            assert np.all(np.floor((y[start:stop]-0.5)/32) == idx["TILEY"][i])
+        for col in f["EVENTS"].columns.names:
+            assert_array_equal(f["EVENTS"].data[col], f2["EVENTS"].data[col])
+        assert f2["STDGTI"].header["TSTOP"] == parameters["exposure_time"]
+
+    bounds = (100.0, 180.0, 300.0, 420.0)
+    inside = (events["xpix"] >= bounds[0]) & (events["xpix"] <= bounds[1]) & \
+        (events["ypix"] >= bounds[2]) & (events["ypix"] <= bounds[3])
+    with EventFile("evt_idx.fits", chunk_size=100) as ef:
+        assert ef.tile_index is not None
+        evts = ef.read(["X", "TIME"], bounds=bounds)
+        assert_array_equal(np.sort(evts["TIME"]), np.sort(events["time"][inside]))
+        assert len(ef._row_ranges(bounds)) < ef.tile_index["start"].size
+
+    region = "image;circle(140,360,30);image;box(400,100,40,60,30)"
+    for fn in ["evt.fits", "evt_idx.fits"]:
+        write_image(fn, f"img_{fn}", region=region, overwrite=True)
+        write_radial_profile(fn, f"prof_{fn}", [140.0, 360.0], 0.0, 40.0, 8,
+                             ctr_type="physical", region=region, 
+                             overwrite=True)
+    with pyfits.open("img_evt.fits") as f1, pyfits.open("img_evt_idx.fits") as f2:
+        assert f1["IMAGE"].data.sum() > 0
+        assert_array_equal(f1["IMAGE"].data, f2["IMAGE"].data)
+    with pyfits.open("prof_evt.fits") as f1, pyfits.open("prof_evt_idx.fits") as f2:
+        assert f1["PROFILE"].data["NET_COUNTS"].sum() > 0
+        assert_array_equal(f1["PROFILE"].data["NET_COUNTS"], 
+                           f2["PROFILE"].data["NET_COUNTS"])
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+
+def test_time_sorted():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    prng = np.random.RandomState(50)
+    events = make_events(20000, prng)
+    write_event_file(events, parameters, "evt.fits", overwrite=True)
+    order = np.argsort(events["time"])
+    sorted_events = {key: events[key][order] for key in events}
+    write_event_file(sorted_events, parameters, "bkg_evt.fits", overwrite=True)
+    make_tile_index("bkg_evt.fits", out_file="bkg_evt_idx.fits")
+
+    tmin, tmax = 250.0, 400.0
+    idxs = (events["time"] >= tmin) & (events["time"] < tmax)
+    for fn, time_sorted in [("evt.fits", False), ("bkg_evt.fits", True),
+                            ("bkg_evt_idx.fits", False)]:
+        with EventFile(fn, chunk_size=1000) as ef:
+            assert ef.time_sorted == time_sorted
+            evts = ef.read(["TIME", "X"], tmin=tmin, tmax=tmax)
+            assert_array_equal(np.sort(evts["TIME"]),
+                               np.sort(events["time"][idxs]))
+
+    event_params = {"exposure_time": 200.0, "roll_angle": 0.0,
+                    "aimpt_coords": [0.0, 0.0], "aimpt_shift": [0.0, 0.0]}
+    for key in ["telescope", "mission", "instrument", "channel_type",
+                "nchan", "rmf", "arf"]:
+        event_params[key] = parameters[key]
+    src_events = {key: np.array([]) for key in
+                  ["xpix", "ypix", "energy", "detx", "dety", "chip_id", "PI",
+                   "time"]}
+    bkg = add_background_from_file(src_events, event_params, "bkg_evt.fits",
+                                   time_offset=600.0)
+    idxs = (events["time"] >= 600.0) & (events["time"] < 800.0)
+    assert_allclose(np.sort(bkg["time"]), np.sort(events["time"][idxs])-600.0)
+    assert_array_equal(np.sort(bkg["chip_id"]), np.sort(events["chip_id"][idxs]))
+    bkg1 = add_background_from_file(src_events, event_params, "bkg_evt.fits",
+                                    time_offset="random", prng=1)
+    bkg2 = add_background_from_file(src_events, event_params, "bkg_evt.fits",
+                                    time_offset="random", prng=2)
+    for b in [bkg1, bkg2]:
+        assert b["time"].min() >= 0.0
+        assert b["time"].max() < event_params["exposure_time"]
+    assert not np.array_equal(bkg1["energy"], bkg2["energy"])
+    with pytest.raises(RuntimeError):
+        add_background_from_file(src_events, event_params, "bkg_evt.fits",
+                                 time_offset=900.0)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,197 @@
+import numpy as np
+from numpy.testing import assert_allclose
+import astropy.io.fits as pyfits
+import astropy.wcs as pywcs
+from scipy.special import erf
+import tempfile
+import os
+import shutil
+from soxs.image_plane import _image_plane_events, _psf_kernel
+from soxs.instrument import instrument_simulator, make_expected_counts
+from soxs.instrument_registry import get_instrument_from_registry
+from soxs.psf import psf_model_registry
+from soxs.response import FlatResponse
+from soxs.simput import SimputSpectrum, SimputCatalog, SimputPhotonList
+from soxs.spatial import BetaModel, PointSourceModel
+from soxs.spectra import Spectrum
+from soxs.utils import get_rot_mat
+
+ra0 = 30.0
+dec0 = 45.0
+nx = 600
+plate_scale = 20.0/nx/60.0
+inst = {"fov": 20.0, "num_pixels": nx, "aimpt_coords": [0.0, 0.0],
+        "psf": ["gaussian", 4.0]}
+event_params = {"num_pixels": nx, "pix_center": np.array([0.5*(2*nx+1)]*2),
+                "aimpt_coords": [0.0, 0.0], "aimpt_shift": np.zeros(2)}
+
+
+def test_fast_image():
+    prng = np.random.RandomState(29)
+    exp_time = 50000.0
+    refband = [0.5, 7.0]
+    spec = Spectrum.from_powerlaw(1.5, 0.0, 1.0e-3, 0.1, 10.0, 1000)
+    arf = FlatResponse(0.1, 10.0, 500.0, 1000)
+    bm = BetaModel(ra0, dec0, 20.0, 0.67, ellipticity=0.7, theta=20.0)
+    src = SimputSpectrum.from_models("beta", spec, bm, 10.0, 512)
+
+    w = pywcs.WCS(naxis=2)
+    w.wcs.crval = [ra0, dec0]
+    w.wcs.crpix = event_params["pix_center"]
+    w.wcs.cdelt = [-plate_scale, plate_scale]
+    w.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    w.wcs.cunit = ["deg"]*2
+    rot_mat = get_rot_mat(30.0)
+    psf = psf_model_registry["gaussian"](inst, prng=prng)
+
+    fast = _image_plane_events(src, exp_time, refband, arf, psf, w,
+                               rot_mat, event_params, prng=prng)
+
+    # Scatter every photon through the PSF for comparison
+    slow = arf.detect_events_spec(src, exp_time, refband, prng=prng)
+    x, y = w.wcs_world2pix(slow["ra"], slow["dec"], 1)
+    x -= event_params["pix_center"][0]
+    y -= event_params["pix_center"][1]
+    det = np.dot(rot_mat, np.array([x, y]))
+    detx, dety = psf.scatter(det[0], det[1], slow["energy"])
+    x, y = np.dot(rot_mat.T, np.array([detx, dety]))
+
+    n_fast = fast["energy"].size
+    n_slow = slow["energy"].size
+    assert np.abs(n_fast-n_slow) < 5.0*np.sqrt(n_slow)
+    assert fast["energy"].min() >= refband[0]
+    assert fast["energy"].max() <= refband[1]
+    assert np.abs(fast["energy"].mean()/slow["energy"].mean()-1.0) < 0.01
+    for a, b in [(fast["xpix"], x), (fast["ypix"], y)]:
+        for q in [0.1, 0.25, 0.5, 0.75, 0.9]:
+            assert np.abs(np.quantile(a, q)-np.quantile(b, q)) < 0.5
+
+
+def test_psf_kernel():
+    # The kernel of a gaussian PSF is the integral of the gaussian 
+    # over each pixel
+    psf = psf_model_registry["gaussian"](inst)
+    shift = (0.2, -0.3)
+    kernel, k = _psf_kernel(psf, 10.0, 20.0, 1.0, np.identity(2), nx,
+                            shift=shift)
+    edges = np.arange(-k, k+2)-0.5
+    px = np.diff(erf((edges-shift[0])/(np.sqrt(2.0)*psf.sigma)))
+    py = np.diff(erf((edges-shift[1])/(np.sqrt(2.0)*psf.sigma)))
+    assert_allclose(kernel, np.outer(py, px)/(px.sum()*py.sum()), 
+                    atol=1.0e-3)
+
+    # Without dithering, a source 0.3 pixels from the edge of a
+    # detector pixel has its events spread evenly over the pixel
+    ep = {"exposure_time": 10000.0, "dither_params": {"dither_on": False}}
+    kernel, k = _psf_kernel(None, 10.3, 20.3, 1.0, np.identity(2), nx,
+                            event_params=ep)
+    p1 = np.zeros(2*k+1)
+    p1[k:k+2] = [0.8, 0.2]
+    assert_allclose(kernel, np.outer(p1, p1), atol=1.0e-12)
+
+
+def box_moments(img, xc, yc, hw):
+    # Counts and centroid of an image within a box around (xc, yc)
+    ny, nx = img.shape
+    ix, iy = int(xc), int(yc)
+    sub = img[iy-hw:iy+hw+1, ix-hw:ix+hw+1]
+    yy, xx = np.mgrid[iy-hw:iy+hw+1, ix-hw:ix+hw+1]
+    n = sub.sum()
+    return n, (sub*xx).sum()/n, (sub*yy).sum()/n, \
+        (sub*xx*xx).sum()/n, (sub*yy*yy).sum()/n
+
+
+def test_expected_counts():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    instrument = "lynx_hdxi"
+    exp_time = 50000.0
+    roll_angle = 20.0
+    reblock = 4
+    ebins = [0.5, 2.0, 7.0]
+
+    # Place the sources using the same sky and detector frames as 
+    # the simulator
+    inst_spec = get_instrument_from_registry(instrument)
+    nxi = inst_spec["num_pixels"]
+    pix_center = 0.5*(2*nxi+1)
+    w = pywcs.WCS(naxis=2)
+    w.wcs.crval = [ra0, dec0]
+    w.wcs.crpix = [pix_center]*2
+    w.wcs.cdelt = [-inst_spec["fov"]/nxi/60.0, inst_spec["fov"]/nxi/60.0]
+    w.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    w.wcs.cunit = ["deg"]*2
+    rot_mat = get_rot_mat(roll_angle)
+    # A beta model away from the center of the field, and a point 
+    # source close enough to the edge of the chip that it is
+    # dithered on and off it
+    bm_pix = np.array([0.1, -0.05])*nxi
+    pt_pix = np.dot(rot_mat.T, [0.5*nxi-10.0, 0.25*nxi])
+    bm_ra, bm_dec = w.wcs_pix2world(*(bm_pix+pix_center), 1)
+    pt_ra, pt_dec = w.wcs_pix2world(*(pt_pix+pix_center), 1)
+
+    spec = Spectrum.from_powerlaw(1.5, 0.0, 1.0e-3, 0.1, 10.0, 1000)
+    bm = BetaModel(bm_ra, bm_dec, 5.0, 0.67)
+    src1 = SimputSpectrum.from_models("beta", spec, bm, 5.0, 512)
+    src2 = SimputPhotonList.from_models("pt", 0.1*spec, 
+                                        PointSourceModel(pt_ra, pt_dec),
+                                        exp_time, (3.0, "m**2"), prng=30)
+    SimputCatalog.from_sources("sources_simput.fits", [src1, src2],
+                               overwrite=True)
+
+    img, cspec = make_expected_counts("sources_simput.fits", exp_time,
+                                      instrument, [ra0, dec0], ebins=ebins,
+                                      ptsrc_bkgnd=False, 
+                                      roll_angle=roll_angle,
+                                      reblock=reblock, img_file="expected.fits",
+                                      spec_file="expected.pi")
+    instrument_simulator("sources_simput.fits", "sources_evt.fits", exp_time,
+                         instrument, [ra0, dec0], ptsrc_bkgnd=False,
+                         roll_angle=roll_angle, prng=29)
+
+    with pyfits.open("sources_evt.fits") as f:
+        e = f["EVENTS"].data["ENERGY"]*1.0e-3
+        x = f["EVENTS"].data["X"]
+        y = f["EVENTS"].data["Y"]
+        chan = f["EVENTS"].data[f["EVENTS"].header["CHANTYPE"]]
+    for i in range(len(ebins)-1):
+        n = np.logical_and(e >= ebins[i], e < ebins[i+1]).sum()
+        assert np.abs(n-img[i].sum()) < 3.0*np.sqrt(img[i].sum())
+    assert np.abs(chan.size-cspec.sum()) < 3.0*np.sqrt(cspec.sum())
+
+    # Compare the spatial distributions of the counts on the same grid
+    nxo = 2*nxi//reblock
+    edges = np.linspace(0.5, 2*nxi+0.5, nxo+1)
+    idxs = np.logical_and(e >= ebins[0], e < ebins[-1])
+    sim_img = np.histogram2d(y[idxs], x[idxs], bins=[edges, edges])[0]
+    exp_img = img.sum(axis=0)
+    for pix in [bm_pix, pt_pix]:
+        xc, yc = (pix+pix_center-0.5)/reblock
+        n1, x1, y1, xx1, yy1 = box_moments(exp_img, xc, yc, 12)
+        n2, x2, y2, _, _ = box_moments(sim_img, xc, yc, 12)
+        assert np.abs(n1-n2) < 5.0*np.sqrt(n1)
+        assert np.abs(x1-x2) < 5.0*np.sqrt((xx1-x1*x1)/n1)
+        assert np.abs(y1-y2) < 5.0*np.sqrt((yy1-y1*y1)/n1)
+    # The radial profile of the beta model
+    yy, xx = np.mgrid[0:nxo, 0:nxo]+0.5
+    xc, yc = (bm_pix+pix_center-0.5)/reblock
+    rr = np.hypot(xx-xc, yy-yc)
+    rbins = np.array([0.0, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0])
+    p1 = np.histogram(rr, bins=rbins, weights=exp_img)[0]
+    p2 = np.histogram(rr, bins=rbins, weights=sim_img)[0]
+    assert np.all(np.abs(p1-p2) < 5.0*np.sqrt(p1))
+
+    with pyfits.open("expected.fits") as f:
+        assert_allclose(f["IMAGE"].data, img)
+        ebounds = f["EBOUNDS"].data
+        assert_allclose(ebounds["E_MIN"], ebins[:-1])
+        assert_allclose(ebounds["E_MAX"], ebins[1:])
+        assert_allclose(ebounds["CHANNEL"], np.arange(1, ebins.size))
+        assert f["IMAGE"].header["CTYPE3"] == "CHANNEL"
+    with pyfits.open("expected.pi") as f:
+        assert_allclose(f["SPECTRUM"].data["COUNTS"], cspec)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,94 @@
+from soxs.psf import psf_model_registry
+import astropy.io.fits as pyfits
+import numpy as np
+import os
+import tempfile
+import shutil
+
+inst = {"fov": 20.0, "num_pixels": 1200, "aimpt_coords": [0.0, 0.0]}
+plate_scale = inst["fov"]/inst["num_pixels"]*60.0
+
+
+def king_eef(r, r_c, alpha):
+    return 1.0-(1.0+(r/r_c)**2)**(1.0-alpha)
+
+
+def check_radii(r, r_c, alpha):
+    for q in [0.25, 0.5, 0.75]:
+        rq = np.quantile(r, q)
+        assert np.abs(king_eef(rq, r_c, alpha)-q) < 0.01
+
+
+def test_king_psf():
+    psf_inst = inst.copy()
+    psf_inst["psf"] = ["king", 2.0, 1.5]
+    psf = psf_model_registry["king"](psf_inst, prng=25)
+    n = 100000
+    x, y = psf.scatter(np.zeros(n), np.zeros(n), np.ones(n))
+    r = np.sqrt(x*x+y*y)*plate_scale
+    check_radii(r, 2.0, 1.5)
+
+
+def write_eef_file(filename, params):
+    radius = np.linspace(0.0, 1000.0, 100001)
+    hdus = [pyfits.PrimaryHDU()]
+    for (energy, theta), (r_c, alpha) in params.items():
+        cols = [pyfits.Column(name="RADIUS", format="D", unit="arcsec",
+                              array=radius),
+                pyfits.Column(name="EEF", format="D", 
+                              array=king_eef(radius, r_c, alpha))]
+        hdu = pyfits.BinTableHDU.from_columns(cols)
+        hdu.header["ENERGY"] = energy
+        hdu.header["THETA"] = theta
+        hdus.append(hdu)
+    pyfits.HDUList(hdus).writeto(filename)
+
+
+def test_eef_psf():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    # Two energies, with the PSF getting broader at higher energy
+    params = {1.0: (2.0, 1.5), 6.0: (4.0, 1.8)}
+    write_eef_file("eef.fits", {(energy, 0.0): p 
+                                for energy, p in params.items()})
+
+    psf_inst = inst.copy()
+    psf_inst["psf"] = ["eef", "eef.fits"]
+    psf = psf_model_registry["eef"](psf_inst, prng=26)
+    n = 100000
+    e = np.concatenate([np.full(n, 0.9), np.full(n, 7.0)])
+    x, y = psf.scatter(np.zeros(2*n), np.zeros(2*n), e)
+    r = np.sqrt(x*x+y*y)*plate_scale
+    # Each event uses the table nearest to it in energy
+    check_radii(r[:n], *params[1.0])
+    check_radii(r[n:], *params[6.0])
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+
+def test_eef_psf_missing_table():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    # There is no table for 6 keV at 5 arcmin off-axis
+    params = {(1.0, 0.0): (2.0, 1.5), (6.0, 0.0): (4.0, 1.8),
+              (1.0, 5.0): (8.0, 2.0)}
+    write_eef_file("eef.fits", params)
+
+    psf_inst = inst.copy()
+    psf_inst["psf"] = ["eef", "eef.fits"]
+    psf = psf_model_registry["eef"](psf_inst, prng=27)
+    n = 100000
+    x0 = np.full(n, 5.0*60.0/plate_scale)
+    x, y = psf.scatter(x0.copy(), np.zeros(n), np.full(n, 7.0))
+    r = np.sqrt((x-x0)**2+y*y)*plate_scale
+    # These events use the table at the same off-axis angle
+    assert np.all(r > 0.0)
+    check_radii(r, *params[1.0, 5.0])
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
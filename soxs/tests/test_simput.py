@@ -1,6 +1,11 @@
-from soxs.spatial import PointSourceModel
-from soxs.spectra import Spectrum
-from soxs.simput import SimputPhotonList, SimputCatalog
+from soxs.spatial import PointSourceModel, BetaModel
+from soxs.spectra import Spectrum, ConvolvedSpectrum
+from soxs.simput import SimputPhotonList, SimputCatalog, \
+    SimputSpectrum, read_simput_catalog
+from soxs.response import FlatResponse
+from soxs.constants import erg_per_keV
+from numpy.testing import assert_allclose
+import numpy as np
 import astropy.io.fits as pyfits
 import tempfile 
 import os
@@ -48,3 +53,198 @@ def test_append():
     os.chdir(curdir)
     shutil.rmtree(tmpdir)
 
+
+
+def test_read_sources():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    ra0 = 30.0
+    dec0 = 45.0
+
+    spec = Spectrum.from_powerlaw(1.1, 0.05, 1.0e-4, 0.1, 10.0, 10000)
+    pos = PointSourceModel(ra0, dec0)
+    pl = SimputPhotonList.from_models("pt_src", spec, pos, (50.0, "ks"),
+                                      (4.0, "m**2"), prng=prng)
+    sc = SimputCatalog.from_source("many_simput.fits", pl, overwrite=True)
+    for i in range(20):
+        src = SimputSpectrum.from_spectrum(f"spec{i}", spec*(i+1), ra0, dec0)
+        sc.append(src, src_filename="many_spectra.fits")
+
+    sources, parameters = read_simput_catalog("many_simput.fits")
+    assert len(sources) == 21
+    assert_allclose(sources[0].events["energy"].value, 
+                    pl.events["energy"].value)
+    for i in [19, 3, 11]:
+        src = sources[i+1]
+        assert src.name == f"spec{i}"
+        assert_allclose(src.spec.flux.value, (i+1)*spec.flux.value, 
+                        rtol=1.0e-6)
+    sources.close()
+
+    with SimputCatalog.from_file("many_simput.fits") as sc:
+        src = sc.read_source("./many_spectra.fits[SPECTRUM,5]")
+        assert src.name == "spec4"
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+
+def test_from_sources():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    ra0 = 30.0
+    dec0 = 45.0
+
+    spec1 = Spectrum.from_powerlaw(1.1, 0.05, 1.0e-4, 0.1, 10.0, 10000)
+    spec2 = Spectrum.from_powerlaw(2.0, 0.0, 1.0e-4, 0.5, 7.0, 1000)
+    pos = PointSourceModel(ra0, dec0)
+    bm = BetaModel(ra0, dec0, 20.0, 0.67)
+    pl = SimputPhotonList.from_models("pt_src", spec1, pos, (50.0, "ks"),
+                                      (4.0, "m**2"), prng=prng)
+    sources = [SimputSpectrum.from_spectrum(f"spec{i}", spec1*(i+1), 
+                                            ra0+0.01*i, dec0)
+               for i in range(5)]
+    sources.insert(2, pl)
+    sources.append(SimputSpectrum.from_models("beta", spec2, bm, 10.0, 64))
+    sources.append(SimputSpectrum.from_spectrum("other", spec2, ra0, dec0))
+
+    sc = SimputCatalog.from_sources("bulk_simput.fits", sources[:4],
+                                    overwrite=True)
+    sc.extend(sources[4:], src_filename="bulk_sources.fits", overwrite=True)
+
+    with pyfits.open("bulk_sources.fits") as f:
+        assert len(f) == 4
+    sc2 = SimputCatalog.from_file("bulk_simput.fits")
+    assert list(sc2.spectra[:4]) == ["[SPECTRUM,1][#row==1]", 
+                                     "[SPECTRUM,1][#row==2]", 
+                                     "[PHLIST,1]", "[SPECTRUM,1][#row==3]"]
+    assert sc2.images[2] == "[PHLIST,1]"
+    assert sc2.images[6] == "./bulk_sources.fits[IMAGE,1]"
+    for i, src in enumerate(sources):
+        src2 = sc2._read_source(i)
+        assert src2.name == src.name
+        if src.src_type == "phlist":
+            assert_allclose(src2.events["energy"].value, 
+                            src.events["energy"].value)
+        else:
+            assert_allclose(src2.spec.flux.value, src.spec.flux.value,
+                            rtol=1.0e-6)
+            assert_allclose(src2.spec.ebins.value, src.spec.ebins.value,
+                            rtol=1.0e-6)
+            assert src2.ra == src.ra
+    assert_allclose(sc2._read_source(6).imhdu.data, sources[6].imhdu.data)
+    assert_allclose(sc2.fluxes, [src.flux for src in sources])
+    sc2.close()
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+
+def test_detect_phlist_chunks():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    spec = Spectrum.from_powerlaw(1.1, 0.05, 1.0e-4, 0.1, 10.0, 10000)
+    bm = BetaModel(30.0, 45.0, 20.0, 0.67)
+    pl = SimputPhotonList.from_models("beta", spec, bm, (100.0, "ks"),
+                                      (1.0, "m**2"), prng=prng)
+    SimputCatalog.from_source("phlist_simput.fits", pl, overwrite=True)
+    arf = FlatResponse(0.1, 10.0, 2000.0, 1000)
+    exp_time = 40000.0
+    e_all = np.asarray(pl["energy"])
+    earea = arf.interpolate_area(e_all).value
+    n_exp = pl.flux/(e_all.sum()*erg_per_keV)*earea.sum()*exp_time
+
+    with SimputCatalog.from_file("phlist_simput.fits") as sc:
+        src = sc.read_source("[PHLIST,1]")
+        events = arf.detect_events_phlist(src.events, exp_time, pl.flux, 
+                                          [0.1, 10.0], prng=prng, 
+                                          chunk_size=30000)
+        e_file = np.sort(src.events["energy"].value)
+    n_evt = events["energy"].size
+    assert np.abs(n_evt-n_exp) < 3.0*np.sqrt(n_exp)
+    # The detected photons are distinct photons from the list
+    idxs = np.searchsorted(e_file, events["energy"])
+    assert np.all(e_file[idxs] == events["energy"])
+    assert np.unique(events["ra"]).size == n_evt
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+
+def test_phlist_from_arf():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    prng = RandomState(33)
+    spec = Spectrum.from_powerlaw(1.1, 0.05, 1.0e-4, 0.1, 10.0, 10000)
+    bm = BetaModel(30.0, 45.0, 20.0, 0.67)
+    arf = FlatResponse(0.1, 10.0, 1.0, 1000)
+    arf.eff_area = 500.0*np.exp(-0.5*((arf.emid-1.5)/1.0)**2)
+    arf.max_area = arf.eff_area.max()
+    exp_time = 50000.0
+
+    pl_flat = SimputPhotonList.from_models("beta", spec, bm, (100.0, "ks"),
+                                           arf.max_area, prng=prng)
+    pl = SimputPhotonList.from_models("beta", spec, bm, (100.0, "ks"),
+                                      arf.max_area, prng=prng, arf=arf)
+    assert pl.num_events < 0.5*pl_flat.num_events
+    SimputCatalog.from_source("arf_simput.fits", pl, overwrite=True)
+
+    cspec = ConvolvedSpectrum.convolve(spec, arf)
+    n_exp = cspec.total_flux.value*exp_time
+    with SimputCatalog.from_file("arf_simput.fits") as sc:
+        src = sc.read_source("[PHLIST,1]")
+        assert_allclose(src["area"].value, pl["area"].value, rtol=1.0e-6)
+        events = arf.detect_events_phlist(src.events, exp_time, 
+                                          sc.fluxes[0], [0.1, 10.0], 
+                                          prng=prng)
+    assert "area" not in events
+    n_evt = events["energy"].size
+    assert np.abs(n_evt-n_exp) < 3.0*np.sqrt(n_exp)
+    e_mean = np.sum(cspec.emid.value*cspec.flux.value)/cspec.flux.value.sum()
+    assert np.abs(events["energy"].mean()/e_mean-1.0) < 0.02
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+
+def test_prefetch():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    spec = Spectrum.from_powerlaw(1.1, 0.05, 1.0e-4, 0.1, 10.0, 1000)
+    sources = [SimputSpectrum.from_spectrum(f"spec{i}", spec*(i+1), 
+                                            30.0, 45.0)
+               for i in range(10)]
+    SimputCatalog.from_sources("prefetch_simput.fits", sources, 
+                               overwrite=True)
+
+    src_list, _ = read_simput_catalog("prefetch_simput.fits", prefetch=3)
+    names = [src.name for src in src_list]
+    assert names == [src.name for src in sources]
+    # Stopping early should not leave the reader blocked
+    for i, src in enumerate(src_list):
+        if i == 1:
+            break
+    assert [src.name for src in src_list][-1] == "spec9"
+    # Errors in the reader are raised when iterating
+    src_list.src_cat._index[1][5] = (("", "spectrum", 9, None), None)
+    names = []
+    try:
+        for src in src_list:
+            names.append(src.name)
+    except KeyError:
+        pass
+    assert len(names) == 5
+    src_list.close()
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
@@ -218,3 +218,69 @@ def test_beta_model_flux(answer_store, answer_dir):
 
     os.chdir(curdir)
     shutil.rmtree(tmpdir)
+
+
+def test_radial_samplers():
+    from soxs.spatial import RadialArrayModel
+    prng = np.random.RandomState(24)
+    r = np.linspace(0.0, 3000.0, 3000001)
+    rmid = 0.5*(r[1:]+r[:-1])
+    models = [BetaModel(ra0, dec0, 5.0, 0.6),
+              DoubleBetaModel(ra0, dec0, 10.0, 0.67, 100.0, 0.8, 0.1),
+              AnnulusModel(ra0, dec0, 20.0, 60.0),
+              RadialArrayModel(ra0, dec0, np.array([0.0, 10.0, 20.0, 40.0, 80.0]),
+                               np.array([0.0, 0.0, 5.0, 1.0, 0.0]))]
+    for model in models:
+        radius = model._sample_radii(200000, prng)
+        # The sampler is only built once
+        cdf = model._cdf
+        model._sample_radii(10, prng)
+        assert model._cdf is cdf
+        # Compare with the CDF of the profile on a very fine grid
+        pdf = model.func(rmid)*rmid
+        cdf = np.concatenate([[0.0], np.cumsum(pdf)])/pdf.sum()
+        for q in [0.1, 0.5, 0.9]:
+            rq = np.interp(q, cdf, r)
+            assert np.abs((radius <= rq).mean()-q) < 0.005
+
+
+def test_radial_cdf_step():
+    from soxs.spatial import _radial_cdf, _invert_cdf
+    prng = np.random.RandomState(36)
+    func = lambda r: np.where(r < 50.0, 1.0, 0.2)*(1.0+(r/100.0)**2)**-1.5
+    # The grid has not converged after so few refinements
+    r, cdf = _radial_cdf(func, max_iter=2)
+    assert r.size == cdf.size
+    radius = _invert_cdf(r, cdf, prng.uniform(size=400000))
+    rr = np.linspace(0.0, 3000.0, 3000001)
+    rmid = 0.5*(rr[1:]+rr[:-1])
+    pdf = func(rmid)*rmid
+    cdf = np.concatenate([[0.0], np.cumsum(pdf)])/pdf.sum()
+    for q in [0.1, 0.5, 0.9]:
+        rq = np.interp(q, cdf, rr)
+        assert np.abs((radius <= rq).mean()-q) < 0.002
+
+
+def test_batched_coords():
+    from soxs.spatial import generate_beta_model_coords, \
+        generate_point_source_coords
+    ra, dec = generate_point_source_coords([30.0, 31.0], [45.0, 44.0], [3, 2])
+    np.testing.assert_array_equal(ra.value, [30.0, 30.0, 30.0, 31.0, 31.0])
+    np.testing.assert_array_equal(dec.value, [45.0, 45.0, 45.0, 44.0, 44.0])
+    # A single source gives the same positions as a BetaModel
+    bm = BetaModel(ra0, dec0, 10.0, 0.67, ellipticity=0.8, theta=30.0)
+    ra1, dec1 = bm.generate_coords(10000, prng=prng)
+    ra2, dec2 = generate_beta_model_coords(ra0, dec0, 10.0, 0.67, [10000],
+                                           ellipticity=0.8, theta=30.0, 
+                                           prng=prng)
+    np.testing.assert_allclose(ra1.value, ra2.value, rtol=0.0, atol=1.0e-10)
+    np.testing.assert_allclose(dec1.value, dec2.value, rtol=0.0, atol=1.0e-10)
+    # Many sources are grouped in order
+    ra, dec = generate_beta_model_coords([30.0, 60.0], [45.0, -10.0], 
+                                         Quantity([5.0, 0.5], "arcmin"), 
+                                         [0.6, 0.8], [4000, 6000], 
+                                         prng=prng)
+    assert ra.size == 10000
+    assert np.all(np.abs(dec[:4000].value-45.0) < 1.0)
+    assert np.all(np.abs(ra[4000:].value-60.0) < 1.0)
+    assert np.all(np.abs(dec[4000:].value+10.0) < 1.0)
@@ -1,6 +1,10 @@
-from soxs.spectra import Spectrum, ConvolvedSpectrum
-from soxs.response import AuxiliaryResponseFile
+from soxs.spectra import Spectrum, ConvolvedSpectrum, SpectrumStack, \
+    ConvolvedSpectrumStack
+from soxs.response import AuxiliaryResponseFile, FlatResponse
+from numpy.random import RandomState
 from numpy.testing import assert_allclose, assert_array_equal
+import numpy as np
+import pytest
 import os
 import tempfile
 import shutil
@@ -76,4 +80,258 @@ def test_convolved_spectra():
     assert_array_equal(cspec1.ebins.value, cspec2.ebins.value)
     assert_array_equal(spec1.ebins.value, spec2.ebins.value)
     assert_array_equal(cspec1.flux.value, cspec2.flux.value)
-    assert_allclose(spec1.flux.value, spec2.flux.value)
\ No newline at end of file
+    assert_allclose(spec1.flux.value, spec2.flux.value)
+
+def test_spectrum_stack():
+    prng = RandomState(24)
+    spectra = [Spectrum.from_powerlaw(alpha, 0.05, 1.0e-3, 0.1, 10.0, 2000)
+               for alpha in [1.0, 1.5, 2.0, 2.5]]
+    nH = np.array([0.01, 0.02, 0.05, 0.1])
+    redshift = np.array([0.0, 0.1, 0.1, 0.5])
+    new_flux = np.array([1.0e-12, 2.0e-12, 3.0e-12, 4.0e-12])
+
+    stack = SpectrumStack.from_spectra(spectra)
+    assert len(stack) == 4
+
+    stack.rescale_flux(new_flux, emin=0.5, emax=2.0, flux_type="energy")
+    stack.apply_foreground_absorption(nH, model="tbabs", redshift=redshift)
+    for i, spec in enumerate(spectra):
+        spec.rescale_flux(new_flux[i], emin=0.5, emax=2.0, flux_type="energy")
+        spec.apply_foreground_absorption(nH[i], model="tbabs", 
+                                         redshift=redshift[i])
+
+    pflux, eflux = stack.get_flux_in_band(0.5, 7.0)
+    for i, spec in enumerate(stack.to_spectra()):
+        assert_allclose(spec.flux.value, spectra[i].flux.value)
+        pf, ef = spectra[i].get_flux_in_band(0.5, 7.0)
+        assert_allclose(pflux[i].value, pf.value)
+        assert_allclose(eflux[i].value, ef.value)
+
+    arf = FlatResponse(0.1, 10.0, 1000.0, 2000)
+    cstack = stack*arf
+    for i, cspec in enumerate(cstack.to_spectra()):
+        assert_allclose(cspec.flux.value, (spectra[i]*arf).flux.value)
+    cspectra = cstack.to_spectra()
+    cstack2 = ConvolvedSpectrumStack.from_spectra(cspectra)
+    assert_allclose(cstack2.flux.value, cstack.flux.value)
+    # Spectra convolved with different ARFs cannot be stacked
+    cspectra[1] = spectra[1]*FlatResponse(0.1, 10.0, 2000.0, 2000)
+    with pytest.raises(RuntimeError):
+        ConvolvedSpectrumStack.from_spectra(cspectra)
+
+    t_exp = 1.0e6
+    energies = stack.generate_energies(t_exp, 1000.0, prng=prng)
+    cenergies = cstack.generate_energies(t_exp, prng=prng)
+    for i, spec in enumerate(spectra):
+        n_ph = spec.total_flux.value*t_exp*1000.0
+        assert np.abs(energies[i].size-n_ph) < 5.0*np.sqrt(n_ph)
+        assert np.abs(cenergies[i].size-n_ph) < 5.0*np.sqrt(n_ph)
+        assert energies[i].min().value >= 0.1
+        assert energies[i].max().value <= 10.0
+        assert_allclose(energies[i].flux.value, spec.total_energy_flux.value,
+                        rtol=0.05)
+
+
+def test_lazy_flux():
+    spec = Spectrum.from_powerlaw(2.0, 0.01, 1.0, 0.1, 10.0, 10000)
+    tot_flux = spec.total_flux.value
+    tot_eflux = spec.total_energy_flux.value
+    assert_allclose(spec.cumspec[-1], 1.0)
+
+    spec.flux *= 2.0
+    assert_allclose(spec.total_flux.value, 2.0*tot_flux)
+    assert_allclose(spec.total_energy_flux.value, 2.0*tot_eflux)
+
+    spec.rescale_flux(1.0e-4, emin=0.5, emax=7.0)
+    assert_allclose(spec.get_flux_in_band(0.5, 7.0)[0].value, 1.0e-4)
+    assert spec.total_flux.value < 2.0*tot_flux
+
+    cumspec = np.insert(np.cumsum((spec.flux*spec.de).value), 0, 0.0)
+    spec.add_emission_line(1.0, 0.02, 1.0e-3)
+    assert_allclose(spec.total_flux.value, cumspec[-1]+1.0e-3, rtol=1.0e-4)
+    assert spec.cumspec[np.searchsorted(spec.ebins.value, 0.9)] < \
+        cumspec[np.searchsorted(spec.ebins.value, 0.9)]/cumspec[-1]
+
+    flux = spec.flux.value.copy()
+    spec2 = Spectrum(spec.ebins, flux)
+    spec2.apply_foreground_absorption(0.1)
+    assert_array_equal(flux, spec.flux.value)
+    assert spec2.total_flux < spec.total_flux
+
+
+def test_generate_energies():
+    prng = RandomState(33)
+    spec = Spectrum.from_powerlaw(1.5, 0.0, 1.0e-2, 0.1, 10.0, 100)
+    spec.add_emission_line(3.0, 0.1, 1.0e-2)
+    t_exp = 1.0e3
+    area = 1000.0
+
+    e = spec.generate_energies(t_exp, area, prng=prng)
+    n_ph = spec.total_flux.value*t_exp*area
+    assert np.abs(e.size-n_ph) < 5.0*np.sqrt(n_ph)
+    # Energies are grouped by bin
+    counts = np.histogram(e.value, spec.ebins.value)[0]
+    bin_idxs = np.searchsorted(spec.ebins.value, e.value)
+    assert np.all(np.diff(bin_idxs) >= 0)
+    expected = e.size*np.diff(spec.cumspec)
+    chi2 = ((counts-expected)**2/expected).sum()
+    assert chi2 < 2.0*spec.nbins
+
+    e2 = spec.generate_energies(t_exp, area, prng=prng, ordered=True)
+    assert np.all(np.diff(e2.value) >= 0.0)
+    # Uniform distribution within the bins
+    frac = (e2.value-0.1)/spec.de.value[0] % 1.0
+    assert np.abs(frac.mean()-0.5) < 5.0/np.sqrt(12.0*e2.size)
+
+
+def test_energy_chunks():
+    spec = Spectrum.from_powerlaw(1.5, 0.0, 1.0e-2, 0.1, 10.0, 1000)
+    t_exp = 1.0e3
+    area = 1000.0
+    e1 = spec.generate_energies(t_exp, area, prng=21)
+    chunks = list(spec.generate_energy_chunks(t_exp, area, chunk_size=1000,
+                                              prng=21))
+    assert np.all([chunk.size <= 1000 for chunk in chunks])
+    e2 = np.concatenate([chunk.value for chunk in chunks])
+    assert_allclose(e1.value, e2)
+    flux = np.sum([chunk.flux.value for chunk in chunks])
+    assert_allclose(e1.flux.value, flux)
+
+    arf = FlatResponse(0.05, 11.0, 1000.0, 1000)
+    cspec = spec*arf
+    ce1 = cspec.generate_energies(t_exp, prng=22)
+    chunks = list(cspec.generate_energy_chunks(t_exp, chunk_size=777,
+                                               prng=22))
+    ce2 = np.concatenate([chunk.value for chunk in chunks])
+    assert_allclose(ce1.value, ce2)
+    flux = np.sum([chunk.flux.value for chunk in chunks])
+    assert_allclose(ce1.flux.value, flux)
+
+
+def test_absorption():
+    from soxs.absorption import get_absorb, get_cross_section, \
+        wabs_cross_section, tbabs_cross_section, get_wabs_absorb, \
+        get_tbabs_absorb
+    spec = Spectrum.from_powerlaw(1.5, 0.0, 1.0e-2, 0.1, 10.0, 1000)
+    e = spec.emid.value
+    nH = np.array([0.01, 0.05, 0.1])
+    redshift = np.array([0.0, 0.2, 0.2])
+    for model, xsect in [("wabs", wabs_cross_section), 
+                         ("tbabs", tbabs_cross_section)]:
+        sigma = get_cross_section(e, model=model, cache=True)
+        assert get_cross_section(e.copy(), model=model, cache=True) is sigma
+        # Grids with the same shape but different contents are not 
+        # confused, and arrays are not cached unless asked
+        e2 = e.copy()
+        e2[0] *= 1.01
+        assert get_cross_section(e2, model=model, cache=True) is not sigma
+        assert get_cross_section(e, model=model) is not sigma
+        assert_allclose(get_cross_section(e, model=model), sigma)
+        absorb = get_absorb(e, nH, model=model, redshift=redshift)
+        assert absorb.shape == (3, e.size)
+        for i in range(3):
+            sigma_z = xsect(e*(1.0+redshift[i]))
+            assert_allclose(absorb[i], np.exp(-nH[i]*1.0e22*sigma_z))
+            spec2 = Spectrum(spec.ebins, spec.flux)
+            spec2.apply_foreground_absorption(nH[i], model=model, 
+                                              redshift=redshift[i])
+            assert_allclose(spec2.flux.value, spec.flux.value*absorb[i])
+    # The model-specific functions broadcast nH against the energies
+    nH = np.linspace(0.01, 0.1, e.size)
+    for func, xsect in [(get_wabs_absorb, wabs_cross_section), 
+                        (get_tbabs_absorb, tbabs_cross_section)]:
+        absorb = func(e, nH)
+        assert absorb.shape == e.shape
+        assert_allclose(absorb, np.exp(-nH*1.0e22*xsect(e)))
+
+
+def test_arf_area_cache():
+    spec = Spectrum.from_powerlaw(1.5, 0.0, 1.0e-2, 0.1, 10.0, 1000)
+    arf1 = FlatResponse(0.05, 11.0, 1000.0, 1000)
+    arf2 = FlatResponse(0.05, 11.0, 2000.0, 1000)
+    earea1 = arf1._area_on_grid(spec.emid.value)
+    assert arf1._area_on_grid(spec.emid.value.copy()) is earea1
+    assert FlatResponse(0.05, 11.0, 1000.0, 1000)._area_on_grid(
+        spec.emid.value) is earea1
+    earea2 = arf2._area_on_grid(spec.emid.value)
+    assert_allclose(earea2, 2.0*earea1)
+    cspec1 = spec*arf1
+    cspec2 = spec*arf2
+    assert_allclose(cspec2.flux.value, 2.0*cspec1.flux.value)
+    assert_allclose(cspec1.deconvolve().flux.value, spec.flux.value)
+
+
+xspec_stub = """#!{python}
+# A stand-in for XSPEC which understands just enough of the
+# commands SOXS sends it: each model is a constant equal to its
+# first parameter
+import sys
+import numpy as np
+with open("{calls}", "a") as f:
+    f.write("call\\n")
+norm = 0.0
+ebins = None
+fp = None
+for line in open(sys.argv[2]):
+    words = line.split()
+    if words[0] == "model":
+        norm = float(words[3])
+    elif words[0] == "dummyrsp":
+        ebins = np.linspace(float(words[1]), float(words[2]),
+                            int(words[3])+1)
+    elif words[0] == "set":
+        fp = open(words[3], "w")
+    elif words[0] == "close":
+        fp.write(" ".join(str(e) for e in ebins)+"\\n")
+        fp.write(" ".join(str(v) for v in norm*np.diff(ebins))+"\\n")
+        fp.close()
+"""
+
+
+def test_xspec_cache():
+    import sys
+    from soxs.utils import soxs_cfg
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+    calls = os.path.join(tmpdir, "calls")
+    bindir = os.path.join(tmpdir, "bin")
+    os.mkdir(bindir)
+    xspec = os.path.join(bindir, "xspec")
+    with open(xspec, "w") as f:
+        f.write(xspec_stub.format(python=sys.executable, calls=calls))
+    os.chmod(xspec, 0o755)
+    old_path = os.environ["PATH"]
+    os.environ["PATH"] = bindir + os.pathsep + old_path
+    soxs_cfg.set("soxs", "xspec_cache_dir", 
+                 os.path.join(tmpdir, "xspec_cache"))
+
+    def ncalls():
+        if not os.path.exists(calls):
+            return 0
+        return len(open(calls).readlines())
+
+    try:
+        spec1 = Spectrum.from_xspec_model("const", [2.0], 0.1, 10.0, 100)
+        assert ncalls() == 1
+        assert_allclose(spec1.flux.value, 2.0)
+        spec2 = Spectrum.from_xspec_model("const", [2.0], 0.1, 10.0, 100)
+        assert ncalls() == 1
+        assert_array_equal(spec1.flux.value, spec2.flux.value)
+        spec3 = Spectrum.from_xspec_model("const", [2.0], 0.1, 10.0, 100,
+                                          use_cache=False)
+        assert ncalls() == 2
+        assert_array_equal(spec1.flux.value, spec3.flux.value)
+        # Only the parameter sets which are not in the cache are run,
+        # and they are run in a single session
+        specs = Spectrum.from_xspec_models("const", [[1.0], [2.0], [3.0]],
+                                           0.1, 10.0, 100)
+        assert ncalls() == 3
+        for norm, spec in zip([1.0, 2.0, 3.0], specs):
+            assert_allclose(spec.flux.value, norm)
+        assert os.getcwd() == tmpdir
+    finally:
+        os.environ["PATH"] = old_path
+        soxs_cfg.remove_option("soxs", "xspec_cache_dir")
+        os.chdir(curdir)
+        shutil.rmtree(tmpdir)
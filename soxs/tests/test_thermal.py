@@ -211,3 +211,33 @@ def test_thermal_nei(answer_store, answer_dir):
 
     os.chdir(curdir)
     shutil.rmtree(tmpdir)
+
+
+def test_apec_table():
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    agen_table = ApecGenerator(0.1, 10.0, 2000, var_elem=["O", "Fe"],
+                               broadening=True)
+    cspec, mspec, vspec = agen_table.make_table(redshift=redshift, nproc=2,
+                                                filename="apec_table.h5")
+    assert cspec.shape == (agen_table.nT, 2000)
+    assert vspec.shape == (2, agen_table.nT, 2000)
+
+    agen_serial = ApecGenerator(0.1, 10.0, 2000, var_elem=["O", "Fe"],
+                                broadening=True)
+    c, m, v = agen_serial._get_table([10, 50], redshift, 0.0)
+    assert_allclose(cspec[[10, 50], :], c)
+    assert_allclose(mspec[[10, 50], :], m)
+    assert_allclose(vspec[:, [10, 50], :], v)
+
+    agen_serial.read_table("apec_table.h5")
+    spec1 = agen_serial.get_spectrum(kT_sim, abund_sim, redshift, norm_sim,
+                                     elem_abund={"O": O_sim, "Fe": Fe_sim})
+    spec2 = agen_table.get_spectrum(kT_sim, abund_sim, redshift, norm_sim,
+                                    elem_abund={"O": O_sim, "Fe": Fe_sim})
+    assert_allclose(spec1.flux.value, spec2.flux.value)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)